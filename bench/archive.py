@@ -0,0 +1,35 @@
+# /archive of a big week: per-row ArchivedTopics.create() against one
+# INSERT ... SELECT. Default is 10k topics and 500k votes
+import sys
+from time import perf_counter
+from common import temp_db, populate, sorted_topics
+
+from models import ArchivedTopics, SuggestedTopics, Votes, write_transaction
+from helpers import _archive_topics
+
+
+def per_row_archive(episode):
+    started = perf_counter()
+    with write_transaction():
+        for topic in sorted_topics():
+            ArchivedTopics.create(user=topic.user, username=topic.username, title=topic.title,
+                                  body=topic.body, votes=topic.votes, episode=episode)
+        Votes.delete().execute()
+        SuggestedTopics.delete().execute()
+    return perf_counter() - started
+
+
+if __name__ == '__main__':
+    topics = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    voters = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    for label in ('per-row create()', 'INSERT ... SELECT'):
+        with temp_db():
+            populate(topics=topics, voters=voters, votes_per_voter=50)
+            votes = Votes.select().count()
+            if label == 'INSERT ... SELECT':
+                _, _, elapsed = _archive_topics(1)
+            else:
+                elapsed = per_row_archive(1)
+            assert ArchivedTopics.select().count() == topics
+            print(f'{label:<20} {topics} topics, {votes} votes: {elapsed * 1000:8.1f}ms ' +
+                  'write transaction')
@@ -0,0 +1,81 @@
+# /stats from the aggregates of stats.py against the same numbers computed
+# from ArchivedTopics on every request, on an archive of 10 years of weekly
+# episodes. Also checks that counting every archived episode gives the same
+# aggregates as counting the whole archive again, and how much it adds to /archive
+#
+#   python archive_stats.py [episodes] [topics_per_episode]
+import sys
+import random
+from time import time
+from common import temp_db, populate, measure, report
+
+from peewee import fn
+from models import (ArchivedTopics, SuggestedTopics, EpisodeStats, YearStats, ProposerStats,
+                    write_transaction)
+from helpers import _archive_topics
+from stats import (ALL_TIME, rebuild_stats, year_stats, stats_years, recent_episodes,
+                   top_proposers, episode_stats, best_topics)
+
+WEEK = 7 * 24 * 60 * 60
+
+
+def from_aggregates():
+    year_stats(ALL_TIME)
+    years = stats_years()
+    recent_episodes()
+    top_proposers(years[0].year)
+    top_proposers(ALL_TIME)
+
+
+def from_archive(since):
+    topic = ArchivedTopics
+    topic.select(fn.COUNT(fn.DISTINCT(topic.episode)), fn.COUNT(topic.id),
+                 fn.SUM(topic.votes), fn.COUNT(fn.DISTINCT(topic.user))).scalar(as_tuple=True)
+    list(topic.select(topic.episode, fn.COUNT(topic.id), fn.SUM(topic.votes)).group_by(
+        topic.episode).order_by(topic.episode.desc()).limit(5).tuples())
+    for where in (topic.archived >= since, True):
+        list(topic.select(topic.user, fn.SUM(topic.votes).alias('votes')).where(where).group_by(
+            topic.user).order_by(fn.SUM(topic.votes).desc()).limit(5).tuples())
+
+
+def snapshot():
+    return [sorted(model.select().tuples()) for model in (EpisodeStats, YearStats, ProposerStats)]
+
+
+if __name__ == '__main__':
+    episodes = int(sys.argv[1]) if len(sys.argv) > 1 else 520
+    per_episode = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    rnd = random.Random(42)
+    with temp_db():
+        populate(archived=episodes * per_episode, episodes=episodes)
+        # Weekly episodes up to now, proposers come back
+        started = time() - episodes * WEEK
+        with write_transaction():
+            ArchivedTopics.update(archived=started + ArchivedTopics.episode * WEEK,
+                                  user=fn.MOD(ArchivedTopics.id, 700)).execute()
+        count, elapsed = rebuild_stats()
+        print(f'{episodes * per_episode} archived topics of {count} episodes, ' +
+              f'rebuild_stats() {elapsed * 1000:.0f}ms')
+
+        year = stats_years()[0].year
+        since = ArchivedTopics.select(fn.MIN(ArchivedTopics.archived)).where(
+            ArchivedTopics.archived >= time() - 365 * 24 * 60 * 60).scalar()
+        report('/stats', [('aggregates', measure(from_aggregates)),
+                          ('scanning ArchivedTopics', measure(lambda: from_archive(since)))])
+        report('/stats N', [('aggregates', measure(lambda: (episode_stats(episodes // 2),
+                                                            best_topics(episodes // 2))))])
+
+        # A few more weeks archived one by one, some users propose several topics
+        timings = []
+        for episode in range(episodes + 1, episodes + 11):
+            populate(topics=per_episode, voters=300, votes_per_voter=5, seed=episode)
+            with write_transaction():
+                SuggestedTopics.update(user=rnd.randrange(700) + fn.MOD(SuggestedTopics.uid, 3)).execute()
+            _, _, elapsed = _archive_topics(episode)
+            timings.append(elapsed * 1000)
+        incremental = snapshot()
+        rebuild_stats()
+        print(f'/archive of {per_episode} topics with the aggregates: ' +
+              f'{sorted(timings)[len(timings) // 2]:.1f}ms p50')
+        print('counted episode by episode == counted again:', incremental == snapshot())
+        assert incremental == snapshot()
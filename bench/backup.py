@@ -0,0 +1,157 @@
+# Latency of votes while the database (300MB by default) is backed up: with no
+# backup, with the backup API in steps (backup.py), in one step and with a plain
+# copy of the file. Checks that the snapshots are consistent (the vote counters
+# match the votes, which change in the same transactions) and that a corrupt
+# database is restored from the newest good snapshot
+#
+#   python backup.py [megabytes]
+import os
+import sys
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import statistics
+from time import perf_counter, sleep
+from common import temp_db, populate
+
+from models import db, ArchivedTopics
+from helpers import _toggle_vote
+from backup import (backup_database, restore_database, check_database, snapshots, _unpack,
+                    COPY_CHUNK)
+
+WRITERS = 4
+TOPICS = 300
+# Between the votes of a writer
+INTERVAL = 0.005
+IDLE = 5
+
+
+def fill(megabytes, path):
+    rnd = random.Random(42)
+    # Without the search index triggers, they only slow the insert down
+    for trigger in ('insert', 'delete', 'update'):
+        db.execute_sql(f'DROP TRIGGER IF EXISTS "archivedtopics_search_{trigger}"')
+    episode = 0
+    while os.path.getsize(path) < megabytes * 2 ** 20:
+        episode += 1
+        with db.atomic():
+            ArchivedTopics.insert_many([
+                {'user': rnd.randrange(700), 'username': 'user', 'votes': rnd.randrange(200),
+                 'episode': episode, 'title': f'Topic {i} of episode {episode}',
+                 'body': ''.join(rnd.choice('абвгдежзийклмнопрстуфхцчшщ    ') for _ in range(1500))}
+                for i in range(1000)]).execute()
+        db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+# Votes from WRITERS threads until stop is set, returns the latencies in ms
+def vote(stop):
+    timings = []
+    lock = threading.Lock()
+
+    def writer(seed):
+        rnd = random.Random(seed)
+        own = []
+        with db.connection_context():
+            while not stop.is_set():
+                started = perf_counter()
+                _toggle_vote(rnd.randrange(1, 5000), rnd.randrange(1, TOPICS + 1))
+                own.append((perf_counter() - started) * 1000)
+                sleep(INTERVAL)
+        with lock:
+            timings.extend(own)
+
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(WRITERS)]
+    for thread in threads:
+        thread.start()
+    return threads, timings
+
+
+def during(task):
+    stop = threading.Event()
+    threads, timings = vote(stop)
+    sleep(0.5)
+    started = perf_counter()
+    result = task()
+    elapsed = perf_counter() - started
+    stop.set()
+    for thread in threads:
+        thread.join()
+    timings.sort()
+    return result, elapsed, timings
+
+
+def show(label, elapsed, timings, note=''):
+    print(f'  {label:<22} {elapsed:6.1f}s {len(timings):>6} votes ' +
+          f'p50={statistics.median(timings):6.2f}ms p95={timings[int(len(timings) * 0.95)]:6.2f}ms ' +
+          f'p99={timings[int(len(timings) * 0.99)]:7.2f}ms max={timings[-1]:7.1f}ms {note}')
+
+
+def check(label, ok):
+    print(f'{"ok" if ok else "FAILED":<7} {label}')
+    return ok
+
+
+# Every vote changes the counter of its topic in the same transaction
+def consistent(path):
+    database = sqlite3.connect(path)
+    try:
+        return database.execute(
+            'SELECT COUNT(*) FROM suggestedtopics t WHERE t.votes != ' +
+            '(SELECT COUNT(*) FROM votes v WHERE v.topic_id = t.uid)').fetchone()[0] == 0
+    finally:
+        database.close()
+
+
+def plain_copy(path, copy):
+    with open(path, 'rb') as data, open(copy, 'wb') as target:
+        shutil.copyfileobj(data, target, COPY_CHUNK)
+
+
+if __name__ == '__main__':
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    with temp_db(), tempfile.TemporaryDirectory() as directory:
+        path = db.obj.database
+        populate(topics=TOPICS)
+        started = perf_counter()
+        fill(megabytes, path)
+        print(f'{os.path.getsize(path) / 2 ** 20:.0f}MB database in ' +
+              f'{perf_counter() - started:.0f}s, {WRITERS} threads vote every {INTERVAL * 1000:.0f}ms')
+
+        _, elapsed, timings = during(lambda: sleep(IDLE))
+        show('no backup', elapsed, timings)
+        for label, pages, pause in (('backup API, steps', 256, 0.005),
+                                    ('backup API, one step', -1, 0)):
+            (snapshot, size, seconds, restarts), elapsed, timings = during(
+                lambda: backup_database(path, directory, pages=pages, pause=pause))
+            show(label, elapsed, timings, f'{size / 2 ** 20:.0f}MB gzipped, {restarts} restarts')
+        copy = os.path.join(directory, 'copy.db')
+        _, elapsed, timings = during(lambda: plain_copy(path, copy))
+        show('plain copy of the file', elapsed, timings)
+        print(f'  the plain copy: {check_database(copy) or "ok"}, ' +
+              f'consistent: {check_database(copy) is None and consistent(copy)}, ' +
+              'the votes in the WAL are not there')
+
+        taken = snapshots(path, directory)
+        unpacked = os.path.join(directory, 'unpacked.db')
+        check('snapshots pass integrity_check and their counters match the votes',
+              len(taken) == 2 and all(_unpack(snapshot, unpacked) is None and
+                                      consistent(unpacked) for snapshot in taken))
+        check('old snapshots are removed',
+              len(backup_database(path, directory, keep=1)) == 4 and
+              len(snapshots(path, directory)) == 1)
+
+        # A page in the middle of a copy of the database is overwritten
+        os.mkdir(os.path.join(directory, 'broken'))
+        broken = os.path.join(directory, 'broken', os.path.basename(path))
+        plain_copy(path, broken)
+        with open(broken, 'r+b') as data:
+            data.seek(os.path.getsize(broken) // 2 // 4096 * 4096)
+            data.write(os.urandom(4096 * 8))
+        print(f'  the broken copy: {check_database(broken, quick=True)}')
+        started = perf_counter()
+        restored = restore_database(broken, directory)
+        check(f'a corrupt database is restored in {perf_counter() - started:.1f}s',
+              restored is not None and check_database(broken) is None and consistent(broken))
+        check('a good database is left as is', restore_database(broken, directory) is None)
@@ -0,0 +1,47 @@
+# Ballot build latency (/vote) against the number of topics.
+# Compares the old per-topic count() loop with the pages of _ballot_page
+from common import temp_db, populate, measure, report
+
+from models import SuggestedTopics, Votes
+from helpers import _format_topic
+import devzen_bot
+
+VOTER = 1
+
+
+def per_topic_ballot():
+    texts, keyboard = [], []
+    for topic in SuggestedTopics.select():
+        texts.append(_format_topic(topic.title, topic.username, topic.body))
+        title = topic.title
+        if Votes.select().where((Votes.user == VOTER) &
+                                (Votes.topic == topic)).count() > 0:
+            title = '✅ ' + title
+        keyboard.append(title)
+    return texts, keyboard
+
+
+# Every page of the ballot with the next buttons, returns the number of pages
+def paged_ballot():
+    pages, cursor = 0, ()
+    while True:
+        _, markup = devzen_bot._ballot_page(VOTER, *cursor)
+        pages += 1
+        following = [button.callback_data for row in markup.inline_keyboard for button in row
+                     if button.callback_data.startswith('vote_next_')]
+        if not following:
+            return pages
+        cursor = devzen_bot._page_cursor(following[0])
+
+
+if __name__ == '__main__':
+    for topics in (10, 100, 300, 1000):
+        with temp_db():
+            populate(topics=topics, voters=200, votes_per_voter=10)
+            devzen_bot.render_cache.invalidate()
+            pages = paged_ballot()
+            report(f'{topics} topics ({topics} messages before, {pages} pages after)', [
+                ('per-topic count()', measure(per_topic_ballot)),
+                ('_ballot_page, first page', measure(lambda: devzen_bot._ballot_page(VOTER))),
+                ('_ballot_page, every page', measure(paged_ballot)),
+            ])
@@ -0,0 +1,41 @@
+# Weekly reminder throughput against a fake Bot with 50ms latency and a
+# 30 msg/s limit. Compares the old sleep(0.05) loop with the broadcast engine
+import sys
+from time import monotonic, sleep
+from common import temp_db, populate
+from fakes import FakeBot
+
+from models import SubscibedUsers
+from broadcast import broadcast
+
+
+def sequential(bot, chat_ids, text):
+    started = monotonic()
+    for chat_id in chat_ids:
+        try:
+            bot.send_message(chat_id, text)
+        except Exception:
+            pass
+        sleep(0.05)
+    return monotonic() - started
+
+
+if __name__ == '__main__':
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 600
+    with temp_db():
+        populate(subscribers=subscribers)
+        chat_ids = [user.user for user in SubscibedUsers.select()]
+        blocked = set(chat_ids[::50])
+
+        bot = FakeBot(blocked=blocked)
+        elapsed = sequential(bot, chat_ids, 'Time to vote')
+        print(f'sleep(0.05) loop: {len(bot.sent)} sent in {elapsed:.1f}s ' +
+              f'({len(bot.sent) / elapsed:.1f} msg/s), 429s: {bot.calls["429"]}')
+
+        for rate, workers in ((30, 8), (40, 16)):
+            bot = FakeBot(blocked=blocked)
+            stats = broadcast(bot, chat_ids, 'Time to vote', rate=rate, workers=workers)
+            assert sorted(bot.sent) == sorted(set(chat_ids) - blocked)
+            assert sorted(stats.blocked) == sorted(blocked)
+            print(f'broadcast rate={rate} workers={workers}: {stats}, ' +
+                  f'429s: {bot.calls["429"]}')
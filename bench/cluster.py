@@ -0,0 +1,194 @@
+# Several instances of the bot (separate processes) on one SQLite database in
+# webhook mode, all talking to one Bot API stub. Checks what has to hold for
+# them to work as one bot:
+#  - /propose goes through to the end with every step sent to another instance
+#  - an update delivered to all the instances is answered once
+#  - /vote taps work on an instance other than the one that opened the ballot,
+#    also after an instance is killed
+#  - the weekly reminder is sent once to every subscriber
+#
+#   python cluster.py [instances]
+import os
+import sys
+import json
+import socket
+import tempfile
+import threading
+import multiprocessing
+import urllib.request
+from collections import Counter
+from datetime import datetime, timedelta
+from time import monotonic, sleep
+from common import populate, load_config
+from stub_api import StubApi, command_update, text_update, callback_update
+from webhook import free_port
+
+from models import db, init_database, SuggestedTopics, Votes
+from devzen_bot import NOTIFY_MESSAGE
+from migrations import migrate_database
+
+USERS = 30
+SUBSCRIBERS = 200
+# Seconds until the reminder, the instances have to be up by then
+NOTIFY_IN = 25
+
+CONFIG = '''adminIds: [1]
+botApiToken: "123:stub"
+votes:
+  notifyToVoteOnDay: {day}
+  notifyToVoteOnTime: "{time}"
+server:
+  mode: webhook
+  webhookUrl: {url}
+cluster:
+  enabled: true
+flood:
+  enabled: false
+'''
+
+
+def instance(path, port, stub_url, notify_at, stop):
+    import devzen_bot
+    devzen_bot.config = load_config(CONFIG.format(day=notify_at.weekday(),
+                                                  time=notify_at.strftime('%H:%M:%S'),
+                                                  url=stub_url))
+    init_database({'path': path})
+    updater = devzen_bot.create_updater(base_url=stub_url)
+    updater.start_webhook(listen='127.0.0.1', port=port, url_path='hook',
+                          webhook_url=stub_url + '/hook')
+    stop.wait()
+    updater.stop()
+
+
+def wait_port(port, timeout=30):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.2)
+    raise TimeoutError(f'Instance on port {port} has not started')
+
+
+def check(label, ok):
+    print(f'{"ok" if ok else "FAILED":<7} {label}')
+    return ok
+
+
+if __name__ == '__main__':
+    instances = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cluster.db')
+        init_database({'path': path})
+        db.connect()
+        migrate_database()
+        populate(topics=10, subscribers=SUBSCRIBERS)
+        uid = SuggestedTopics.select(SuggestedTopics.uid).scalar()
+        db.close()
+
+        stub = StubApi(0.005).start()
+        ports = [free_port() for _ in range(instances)]
+        context = multiprocessing.get_context('spawn')
+        stop = context.Event()
+        notify_at = datetime.utcnow() + timedelta(seconds=NOTIFY_IN)
+        processes = [context.Process(target=instance,
+                                     args=(path, port, stub.base_url, notify_at, stop))
+                     for port in ports]
+        for process in processes:
+            process.start()
+        for port in ports:
+            wait_port(port)
+        print(f'{instances} instances are up')
+
+        update_ids = iter(range(1, 10 ** 9))
+        lock = threading.Lock()
+
+        def deliver(index, update):
+            request = urllib.request.Request(f'http://127.0.0.1:{ports[index]}/hook',
+                                             data=json.dumps(update).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request).read()
+
+        def sent_to(user_id):
+            with stub._condition:
+                return sum(str(params.get('chat_id')) == str(user_id) for _, params in stub.sent)
+
+        def wait_for(predicate, timeout=10):
+            deadline = monotonic() + timeout
+            while not predicate() and monotonic() < deadline:
+                sleep(0.02)
+            return predicate()
+
+        def step(index, user_id, make, *args, answers=1, **kwargs):
+            with lock:
+                update_id = next(update_ids)
+            before = sent_to(user_id)
+            deliver(index % len(ports), make(update_id, user_id, *args, **kwargs))
+            answered = wait_for(lambda: sent_to(user_id) >= before + answers)
+            # The conversation moves on right after the answer, a user doesn't tap that fast
+            sleep(0.1)
+            return answered
+
+        # Every step of /propose goes to the next instance
+        def propose(user_id):
+            return (step(user_id, user_id, command_update, '/propose') and
+                    step(user_id + 1, user_id, text_update, f'Тема пользователя {user_id}') and
+                    step(user_id + 2, user_id, text_update, f'Ссылки и текст {user_id} ' * 5) and
+                    step(user_id + 3, user_id, callback_update, '0', answers=0))
+        users = range(10 ** 6, 10 ** 6 + USERS)
+        threads = [threading.Thread(target=propose, args=(user_id,)) for user_id in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db.connect()
+
+        def proposed():
+            return SuggestedTopics.select().where(SuggestedTopics.user.in_(list(users))).count()
+        check(f'/propose of {USERS} users across the instances',
+              wait_for(lambda: proposed() == USERS))
+
+        # Telegram retries a webhook that didn't answer in time, possibly on another instance
+        user_id = 2 * 10 ** 6
+        update = command_update(next(update_ids), user_id, '/help')
+        for index in range(len(ports)):
+            deliver(index, update)
+        sleep(1)
+        check('an update delivered to every instance is answered once', sent_to(user_id) == 1)
+
+        # The ballot is opened on one instance and the tap goes to another one
+        processes[0].kill()
+        alive = range(1, len(ports))
+        markup = {'inline_keyboard': [[{'text': 'Тема', 'callback_data': str(uid)}]]}
+        voters = range(3 * 10 ** 6, 3 * 10 ** 6 + 10)
+        for i, voter in enumerate(voters):
+            step(alive[i % len(alive)], voter, command_update, '/vote', answers=2)
+            step(alive[(i + 1) % len(alive)], voter, callback_update, str(uid),
+                 answers=0, reply_markup=markup)
+
+        def voted():
+            return Votes.select().where(Votes.user.in_(list(voters))).count()
+        check('/vote taps on another instance with instance 0 killed',
+              wait_for(lambda: voted() == len(voters)))
+        db.close()
+
+        wait = (notify_at - datetime.utcnow()).total_seconds()
+        print(f'Waiting {max(wait, 0):.0f}s for the reminder')
+        sleep(max(wait, 0))
+
+        def reminders():
+            with stub._condition:
+                return Counter(params['chat_id'] for _, params in stub.sent
+                               if params.get('text') == NOTIFY_MESSAGE)
+        # 30 messages per second, and then a bit longer for a second broadcast to show up
+        wait_for(lambda: len(reminders()) == SUBSCRIBERS, timeout=SUBSCRIBERS / 30 + 10)
+        sleep(2)
+        reminders = reminders()
+        check(f'the reminder is sent once to each of {SUBSCRIBERS} subscribers',
+              len(reminders) == SUBSCRIBERS and set(reminders.values()) == {1})
+
+        stop.set()
+        for process in processes:
+            process.join(10)
+        stub.stop()
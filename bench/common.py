@@ -0,0 +1,115 @@
+# Shared helpers for the benchmarks. Every benchmark runs against a throwaway
+# SQLite database, so it is safe to run them next to the real db_data/
+import os
+import sys
+import random
+import tempfile
+import statistics
+from contextlib import contextmanager
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from models import (db, init_database, SubscibedUsers, SuggestedTopics,  # noqa: E402
+                    ArchivedTopics, Votes)
+from helpers import _rebuild_vote_counters  # noqa: E402
+from migrations import migrate_database  # noqa: E402
+
+
+@contextmanager
+def temp_db(**storage):
+    with tempfile.TemporaryDirectory() as directory:
+        init_database({'path': os.path.join(directory, 'bench.db'), **storage})
+        db.connect()
+        migrate_database()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def populate(topics=0, voters=0, votes_per_voter=0, subscribers=0,
+             archived=0, episodes=1, seed=42):
+    rnd = random.Random(seed)
+    with db.atomic():
+        rows = [{'uid': i + 1,
+                 'user': rnd.randrange(1, 10 ** 6),
+                 'username': f'user{i}',
+                 'title': f'Topic number {i} about something interesting',
+                 'body': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3}
+                for i in range(topics)]
+        for batch in _batches(rows, 500):
+            SuggestedTopics.insert_many(batch).execute()
+
+        votes = []
+        for voter in range(1, voters + 1):
+            for topic in rnd.sample(range(1, topics + 1), min(votes_per_voter, topics)):
+                votes.append({'user': voter, 'topic': topic})
+        for batch in _batches(votes, 500):
+            Votes.insert_many(batch).execute()
+        _rebuild_vote_counters()
+
+        users = [{'user': i} for i in range(1, subscribers + 1)]
+        for batch in _batches(users, 500):
+            SubscibedUsers.insert_many(batch).execute()
+
+        rows = [{'user': rnd.randrange(1, 10 ** 6),
+                 'username': f'user{i}',
+                 'title': f'Archived topic {i} about something that was discussed',
+                 'body': 'Sed ut perspiciatis unde omnis iste natus error sit voluptatem. ' * 2,
+                 'votes': rnd.randrange(0, 200),
+                 'episode': 1 + i % episodes}
+                for i in range(archived)]
+        for batch in _batches(rows, 500):
+            ArchivedTopics.insert_many(batch).execute()
+
+
+# Every topic with its votes counter, the most voted first, the way /list and
+# /archive read them before keyset pages and INSERT ... SELECT
+def sorted_topics():
+    return list(SuggestedTopics.select(SuggestedTopics.uid,
+                                       SuggestedTopics.username,
+                                       SuggestedTopics.user,
+                                       SuggestedTopics.title,
+                                       SuggestedTopics.body,
+                                       SuggestedTopics.votes
+                                       ).order_by(SuggestedTopics.votes.desc()).namedtuples())
+
+
+def _batches(rows, size):
+    for i in range(0, len(rows), size):
+        yield rows[i:i + size]
+
+
+def measure(fn, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn()
+        timings.append((perf_counter() - start) * 1000)
+    timings.sort()
+    return {'min': timings[0],
+            'p50': statistics.median(timings),
+            'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+            'max': timings[-1]}
+
+
+def report(title, rows):
+    print(title)
+    for label, stats in rows:
+        print(f'  {label:<32} ' +
+              ' '.join(f'{k}={v:8.3f}ms' for k, v in stats.items()))
+
+
+# Parse a config.yaml with the given text the same way the bot does
+def load_config(text='adminIds: [1]\nbotApiToken: "123:stub"\ndrafts:\n  persistent: false\n'):
+    from helpers import _parse_config
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        with open(os.path.join(directory, 'config.yaml'), 'w') as c:
+            c.write(text)
+        os.chdir(directory)
+        try:
+            return _parse_config()
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,70 @@
+# Several dispatcher-like threads toggling votes while others read the ranking.
+# Counts "database is locked" errors with the old defaults (rollback journal,
+# deferred transactions) and with WAL + write_transaction()
+import random
+import threading
+from time import perf_counter
+from common import temp_db, populate, sorted_topics
+
+from models import db, SuggestedTopics, Votes, write_transaction
+from peewee import OperationalError
+from helpers import withConnection
+
+WRITERS = 8
+READERS = 4
+OPERATIONS = 300
+TOPICS = 100
+
+
+def toggle(user, topic, transaction):
+    with transaction():
+        if Votes.select().where((Votes.user == user) & (Votes.topic == topic)).count() > 0:
+            Votes.delete().where((Votes.user == user) & (Votes.topic == topic)).execute()
+            SuggestedTopics.update(votes=SuggestedTopics.votes - 1).where(
+                SuggestedTopics.uid == topic).execute()
+        else:
+            Votes.create(user=user, topic=topic)
+            SuggestedTopics.update(votes=SuggestedTopics.votes + 1).where(
+                SuggestedTopics.uid == topic).execute()
+
+
+def run(transaction):
+    errors = []
+
+    def writer(user):
+        rnd = random.Random(user)
+        for _ in range(OPERATIONS):
+            try:
+                withConnection(toggle)(user, rnd.randrange(1, TOPICS + 1), transaction)
+            except OperationalError as e:
+                errors.append(str(e))
+
+    def reader():
+        for _ in range(OPERATIONS):
+            try:
+                withConnection(sorted_topics)()
+            except OperationalError as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=writer, args=(user,)) for user in range(1, WRITERS + 1)] + \
+        [threading.Thread(target=reader) for _ in range(READERS)]
+    started = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors, perf_counter() - started
+
+
+if __name__ == '__main__':
+    modes = (
+        ('rollback journal, db.atomic()', {'journalMode': 'delete', 'synchronous': 'full'}, db.atomic),
+        ('WAL, write_transaction()', {}, write_transaction),
+    )
+    for label, storage, transaction in modes:
+        with temp_db(**storage):
+            populate(topics=TOPICS)
+            db.close()
+            errors, elapsed = run(transaction)
+            print(f'{label:<32} {len(errors):5} lock errors, ' +
+                  f'{WRITERS * OPERATIONS / elapsed:7.0f} writes/s')
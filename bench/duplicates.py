@@ -0,0 +1,48 @@
+# Near-duplicate lookups at /propose time: how long similar() takes with
+# thousands of indexed topics and how many reworded copies it finds.
+# Default is 10k indexed topics of 30-60 words from a 3000 word vocabulary
+import sys
+import random
+from common import measure, report
+
+from similarity import DuplicateIndex, _shingles, _signature
+
+
+def reword(rnd, words, vocabulary, share):
+    words = [rnd.choice(vocabulary) if rnd.random() < share else word for word in words]
+    rnd.shuffle(words)
+    return words
+
+
+if __name__ == '__main__':
+    topics = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rnd = random.Random(42)
+    # Distinct within the first letters, which are all the index looks at
+    letters = 'абвгдежзиклмнопрстуфхцчшщэюя'
+    vocabulary = sorted({''.join(rnd.choice(letters) for _ in range(rnd.randrange(5, 10)))
+                         for _ in range(3000)})
+    texts = [[rnd.choice(vocabulary) for _ in range(rnd.randrange(30, 60))]
+             for _ in range(topics)]
+
+    index = DuplicateIndex(threshold=0.5)
+    for i, words in enumerate(texts):
+        index.add(i, ' '.join(words[:8]), ' '.join(words[8:]), episode=i // 50)
+
+    rows = []
+    for label, share in (('exact copy', 0), ('10% of words replaced', 0.1),
+                         ('25% of words replaced', 0.25), ('50% of words replaced', 0.5)):
+        queries = [reword(rnd, texts[rnd.randrange(topics)], vocabulary, share)
+                   for _ in range(200)]
+        found = sum(len(index.similar(' '.join(q[:8]), ' '.join(q[8:]))) > 0 for q in queries)
+        query = queries[0]
+        rows.append((f'{label} (found {found / len(queries):.0%})',
+                     measure(lambda: index.similar(' '.join(query[:8]), ' '.join(query[8:])),
+                             repeat=200)))
+    unrelated = [[rnd.choice(vocabulary) for _ in range(45)] for _ in range(200)]
+    false = sum(len(index.similar(' '.join(q[:8]), ' '.join(q[8:]))) > 0 for q in unrelated)
+    rows.append((f'unrelated text (found {false / len(unrelated):.0%})',
+                 measure(lambda: index.similar(' '.join(unrelated[0][:8]),
+                                               ' '.join(unrelated[0][8:])), repeat=200)))
+    shingles = _shingles(' '.join(texts[0][:8]), ' '.join(texts[0][8:]))
+    rows.append(('signature only', measure(lambda: _signature(shingles), repeat=200)))
+    report(f'DuplicateIndex.similar() over {len(index)} topics', rows)
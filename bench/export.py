@@ -0,0 +1,87 @@
+# /export of the whole archive, 1M archived topics by default: time, size of
+# the document and the peak of Python memory (tracemalloc) against reading the
+# same rows into a list first. The peak of the export should stay the same as
+# the archive grows, so it is measured on a tenth of the archive as well
+#
+#   python export.py [archived]
+import sys
+import random
+import tracemalloc
+from time import perf_counter
+from common import temp_db, populate
+
+from models import ArchivedTopics, db
+from export import topic_rows, export_topics, SPOOL_SIZE
+
+WORDS = ['базы', 'данных', 'postgres', 'sqlite', 'kubernetes', 'rust', 'go', 'python',
+         'тестирование', 'микросервисы', 'кэширование', 'компиляторы', 'сети', 'linux']
+TOPICS_PER_EPISODE = 40
+
+
+def generate(rnd, vocabulary, words):
+    return ' '.join(rnd.choice(vocabulary) for _ in range(words))
+
+
+def insert_archive(count):
+    rnd = random.Random(42)
+    vocabulary = WORDS * 200 + [f'слово{i}' for i in range(5000)]
+    for start in range(0, count, 500):
+        with db.atomic():
+            ArchivedTopics.insert_many([
+                {'user': i % 700, 'username': f'user{i % 700}', 'votes': rnd.randrange(0, 200),
+                 'episode': 1 + i // TOPICS_PER_EPISODE, 'archived': 1.5e9 + i // TOPICS_PER_EPISODE * 7 * 86400,
+                 'title': generate(rnd, vocabulary, 6),
+                 'body': generate(rnd, vocabulary, 25) + f' https://example.com/{i}'}
+                for i in range(start, min(start + 500, count))]).execute()
+
+
+# Returns the seconds, the number of rows, the size and the peak of memory in bytes
+def run(export, traced):
+    if traced:
+        tracemalloc.start()
+    started = perf_counter()
+    document, count, size = export()
+    elapsed = perf_counter() - started
+    document.close()
+    peak = tracemalloc.get_traced_memory()[1] if traced else 0
+    tracemalloc.stop()
+    return elapsed, count, size, peak
+
+
+def materialized(first, last, format):
+    return export_topics(list(topic_rows(first, last)), format)
+
+
+def show(label, elapsed, count, size, peak):
+    print(f'  {label:<34} {count:>8} rows {elapsed:6.2f}s {count / elapsed:>8.0f} rows/s ' +
+          f'{size / 2 ** 20:6.1f}MB' + (f', peak {peak / 2 ** 20:7.1f}MB' if peak else ''))
+
+
+if __name__ == '__main__':
+    archived = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with temp_db():
+        populate(topics=300)
+        started = perf_counter()
+        # Without the search index triggers, they only slow the insert down
+        for trigger in ('insert', 'delete', 'update'):
+            db.execute_sql(f'DROP TRIGGER IF EXISTS "archivedtopics_search_{trigger}"')
+        insert_archive(archived)
+        print(f'Inserted {archived} archived topics in {perf_counter() - started:.0f}s')
+        episodes = archived // TOPICS_PER_EPISODE
+        tenth = episodes // 10
+
+        print(*db.execute_sql('EXPLAIN QUERY PLAN ' + ArchivedTopics.select().where(
+            ArchivedTopics.episode <= 10).order_by(ArchivedTopics.episode,
+                                                   ArchivedTopics.votes.desc(),
+                                                   ArchivedTopics.id).sql()[0],
+            [10]).fetchall(), sep='\n')
+        print(f'Exports (documents over {SPOOL_SIZE >> 20}MB go to a temp file)')
+        for format in ('csv', 'json'):
+            for label, first, last in ((f'{episodes} episodes', None, None),
+                                       (f'{tenth} episodes', 1, tenth),
+                                       ('1 episode', tenth, tenth)):
+                export = (lambda: export_topics(topic_rows(first, last), format))
+                show(f'{format}, {label}', *run(export, traced=False))
+                show(f'{format}, {label}, traced', *run(export, traced=True))
+        show(f'csv, {tenth} episodes in a list, traced',
+             *run(lambda: materialized(1, tenth, 'csv'), traced=True))
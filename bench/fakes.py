@@ -0,0 +1,109 @@
+# A local stand-in for telegram.Bot. Simulates network latency, the global
+# 30 msg/s limit (answers with RetryAfter when exceeded) and users who have
+# blocked the bot
+import threading
+from collections import Counter, deque
+from time import monotonic, sleep
+from datetime import datetime
+from telegram import Update, CallbackQuery, InlineQuery, Message, MessageEntity, Chat, User
+from telegram.error import RetryAfter, Unauthorized
+
+
+class FakeBot:
+    defaults = None
+
+    def __init__(self, latency=0.05, rate_limit=30, blocked=(), retry_after=1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.blocked = set(blocked)
+        self.retry_after = retry_after
+        self.sent = []
+        # (chat_id, filename, content) of the uploaded documents
+        self.documents = []
+        self.calls = Counter()
+        self._thread = threading.local()
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def _request(self, method):
+        if self.latency:
+            sleep(self.latency)
+        self._thread.calls = self.calls_in_thread() + 1
+        with self._lock:
+            self.calls[method] += 1
+            if self.rate_limit is None:
+                return
+            now = monotonic()
+            while self._window and now - self._window[0] > 1:
+                self._window.popleft()
+            if len(self._window) >= self.rate_limit:
+                self.calls['429'] += 1
+                raise RetryAfter(self.retry_after)
+            self._window.append(now)
+
+    # API calls made from the current thread so far
+    def calls_in_thread(self):
+        return getattr(self._thread, 'calls', 0)
+
+    def send_message(self, chat_id, text, **kwargs):
+        self._request('sendMessage')
+        if chat_id in self.blocked:
+            raise Unauthorized('Forbidden: bot was blocked by the user')
+        with self._lock:
+            self.sent.append(chat_id)
+
+    def send_chat_action(self, chat_id, action, **kwargs):
+        self._request('sendChatAction')
+        return True
+
+    def send_document(self, chat_id, document, filename=None, **kwargs):
+        self._request('sendDocument')
+        with self._lock:
+            self.documents.append((chat_id, filename, document.read()))
+
+    def answer_callback_query(self, callback_query_id, *args, **kwargs):
+        self._request('answerCallbackQuery')
+        return True
+
+    def edit_message_text(self, text, chat_id=None, message_id=None, *args, **kwargs):
+        self._request('editMessageText')
+        return True
+
+    def edit_message_reply_markup(self, chat_id=None, message_id=None, *args, **kwargs):
+        self._request('editMessageReplyMarkup')
+        return True
+
+    def answer_inline_query(self, inline_query_id, results, *args, **kwargs):
+        self._request('answerInlineQuery')
+        return True
+
+
+def _user(user_id):
+    return User(user_id, f'User{user_id}', False, username=f'user{user_id}')
+
+
+# A real telegram.Update with a text message (or a command) which talks to bot
+def message_update(bot, user_id, text):
+    entities = []
+    if text.startswith('/'):
+        entities.append(MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text.split()[0])))
+    message = Message(user_id, datetime.now(), Chat(user_id, Chat.PRIVATE),
+                      from_user=_user(user_id), text=text, entities=entities, bot=bot)
+    return Update(0, message=message)
+
+
+# A real telegram.Update with a callback query which talks to bot
+def callback_update(bot, user_id, data, reply_markup, message_id=1, query_id=None):
+    user = _user(user_id)
+    message = Message(message_id, datetime.now(), Chat(user_id, Chat.PRIVATE),
+                      text='ballot', reply_markup=reply_markup, bot=bot)
+    query = CallbackQuery(query_id or f'{user_id}-{data}-{monotonic()}', user, 'chat',
+                          message=message, data=data, bot=bot)
+    return Update(0, callback_query=query)
+
+
+# A real telegram.Update with an inline query (@bot query) which talks to bot
+def inline_update(bot, user_id, query, offset=''):
+    inline_query = InlineQuery(f'{user_id}-{monotonic()}', _user(user_id), query, offset,
+                               bot=bot)
+    return Update(0, inline_query=inline_query)
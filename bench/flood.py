@@ -0,0 +1,54 @@
+# Flood control under a synthetic load: a few spammers repeating /list as fast
+# as they can, regular users listing, searching and voting, and an admin.
+# The load ramps up to several times server overload. Prints what happened
+# to every kind of request and how long a decision takes
+import random
+from collections import Counter
+from time import perf_counter
+from common import load_config
+from fakes import FakeBot, message_update, callback_update
+
+from flood import FloodGuard
+
+SECONDS = 30
+ADMIN = 1
+
+
+if __name__ == '__main__':
+    config = load_config()['flood']
+    guard = FloodGuard({name: (config[name]['rate'], config[name]['burst'])
+                        for name in ('list', 'vote', 'inline', 'default')},
+                       admins={ADMIN}, overload=config['overload'])
+    bot = FakeBot(latency=0, rate_limit=None)
+    rnd = random.Random(42)
+    kinds = (('spammer /list', lambda: message_update(bot, rnd.randrange(10, 13), '/list')),
+             ('user /list', lambda: message_update(bot, rnd.randrange(1000, 9000), '/list')),
+             ('user /search', lambda: message_update(bot, rnd.randrange(1000, 9000),
+                                                     '/search базы')),
+             ('user vote tap', lambda: callback_update(bot, rnd.randrange(1000, 9000),
+                                                       str(rnd.randrange(1, 100)), None)),
+             ('admin /archive', lambda: message_update(bot, ADMIN, '/archive')))
+    results = {kind: Counter() for kind, _ in kinds}
+    guard._updated = 0
+    now = 0
+    elapsed = 0
+    decisions = 0
+    for second in range(SECONDS):
+        # From a quiet start to 4x overload
+        rate = config['overload'] * 4 * (second + 1) / SECONDS
+        for _ in range(int(rate)):
+            now += 1 / rate
+            kind, make = kinds[rnd.choices(range(len(kinds)), (30, 30, 10, 28, 2))[0]]
+            update = make()
+            started = perf_counter()
+            _, decision, _ = guard.decide(update, now)
+            elapsed += perf_counter() - started
+            decisions += 1
+            results[kind][decision] += 1
+
+    print(f'{decisions} updates in {SECONDS}s ramping up to {config["overload"] * 4}/s, ' +
+          f'{elapsed / decisions * 1e6:.1f}us per decision')
+    for kind, counts in results.items():
+        total = sum(counts.values())
+        print(f'{kind:<16} ' + ' '.join(f'{decision} {counts[decision] / total:>4.0%}'
+                                        for decision in ('allowed', 'throttled', 'shed')))
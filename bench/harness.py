@@ -0,0 +1,286 @@
+# Offline load generator for the bot handlers. Replays traffic mixes against
+# a fake Bot and a synthetic temp database and reports handler latency
+# percentiles, DB queries and Telegram API calls per update.
+#
+#   python harness.py                          # all scenarios
+#   python harness.py vote_storm list_flood    # some of them
+#   python harness.py --scale 5 --json out.json
+#
+# Compare the JSON output of two commits to see what a change did
+import json
+import random
+import argparse
+import threading
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from common import temp_db, populate, load_config
+from fakes import FakeBot, message_update, callback_update, inline_update
+
+from telegram import InlineKeyboardMarkup
+from models import db, SuggestedTopics
+from helpers import withConnection
+from inline import TopicIndex
+import devzen_bot
+
+
+# Counts the statements executed by the database, in total and per thread
+class QueryCounter:
+    def __init__(self, database):
+        self.total = 0
+        self._thread = threading.local()
+        self._lock = threading.Lock()
+        execute_sql = database.execute_sql
+
+        def counting_execute_sql(*args, **kwargs):
+            self._thread.count = self.in_thread() + 1
+            with self._lock:
+                self.total += 1
+            return execute_sql(*args, **kwargs)
+        database.execute_sql = counting_execute_sql
+
+    def in_thread(self):
+        return getattr(self._thread, 'count', 0)
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Run:
+    def __init__(self, bot, queries, threads):
+        self.bot = bot
+        self.queries = queries
+        self.threads = threads
+        self.updates = 0
+        self.started = perf_counter()
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    # Called by scenarios once the data is generated, so that it isn't counted
+    def start(self):
+        self.queries.total = 0
+        self.bot.calls.clear()
+        self.started = perf_counter()
+
+    # Call a handler the way the dispatcher does and record what it cost
+    def call(self, handler, update, args=()):
+        context = SimpleNamespace(bot=self.bot, args=list(args))
+        queries, api_calls = self.queries.in_thread(), self.bot.calls_in_thread()
+        started = perf_counter()
+        result = withConnection(handler)(update, context)
+        elapsed = (perf_counter() - started) * 1000
+        with self._lock:
+            self.updates += 1
+            self._samples[handler.__name__].append(
+                (elapsed, self.queries.in_thread() - queries,
+                 self.bot.calls_in_thread() - api_calls))
+        return result
+
+    def parallel(self, fn, items):
+        with ThreadPoolExecutor(self.threads) as pool:
+            list(pool.map(fn, items))
+
+    def report(self, elapsed, queries, api_calls):
+        handlers = {}
+        for name, samples in sorted(self._samples.items()):
+            latencies = [s[0] for s in samples]
+            handlers[name] = {
+                'calls': len(samples),
+                'p50_ms': round(_percentile(latencies, 50), 3),
+                'p95_ms': round(_percentile(latencies, 95), 3),
+                'p99_ms': round(_percentile(latencies, 99), 3),
+                'queries_per_call': round(sum(s[1] for s in samples) / len(samples), 2),
+                'api_calls_per_call': round(sum(s[2] for s in samples) / len(samples), 2),
+            }
+        # Totals include work done outside of handler threads (broadcast
+        # senders, delayed keyboard edits)
+        return {'updates': self.updates,
+                'elapsed_s': round(elapsed, 3),
+                'updates_per_s': round(self.updates / elapsed, 1) if elapsed > 0 else None,
+                'queries_per_update': round(queries / max(self.updates, 1), 2),
+                'api_calls_per_update': round(api_calls / max(self.updates, 1), 2),
+                'handlers': handlers}
+
+
+def _ballot_markup(user_id):
+    _, markup = withConnection(devzen_bot._ballot_page)(user_id)
+    return markup
+
+
+# Jobs get only the context
+def notify_subscribed_users(update, context):
+    devzen_bot.notify_subscribed_users(context)
+
+
+# The weekly reminder goes out and subscribers come to vote: each of them
+# opens /vote and taps a few topics
+def vote_storm(run, scale):
+    populate(topics=100, voters=200 * scale, votes_per_voter=5, subscribers=500 * scale)
+    run.start()
+    run.call(notify_subscribed_users, None)
+
+    def voter(user_id):
+        rnd = random.Random(user_id)
+        run.call(devzen_bot.start_vote, message_update(run.bot, user_id, '/vote'))
+        markup = _ballot_markup(user_id)
+        # Taps on the first page of the ballot
+        uids = [int(row[0].callback_data) for row in markup.inline_keyboard
+                if row[0].callback_data.lstrip('-').isdigit()]
+        for uid in rnd.sample(uids, 5):
+            run.call(devzen_bot.vote, callback_update(run.bot, user_id, str(uid), markup))
+        run.call(devzen_bot.stop_vote, callback_update(run.bot, user_id, 'STOP', markup))
+    run.parallel(voter, range(10 ** 6, 10 ** 6 + 300 * scale))
+
+
+# A few users (or a stuck client) spamming /list and /list N
+def list_flood(run, scale):
+    populate(topics=300, voters=500, votes_per_voter=10, archived=3000, episodes=30)
+    run.start()
+
+    def lister(i):
+        args = [str(1 + i % 30)] if i % 3 == 0 else []
+        run.call(devzen_bot.list_topics,
+                 message_update(run.bot, 10 + i % 5, '/list ' + ' '.join(args)), args)
+    run.parallel(lister, range(200 * scale))
+
+
+# An admin archives the episode while people are still voting
+def archive_during_voting(run, scale):
+    populate(topics=500, voters=2000 * scale, votes_per_voter=20)
+    uids = [t.uid for t in SuggestedTopics.select(SuggestedTopics.uid)]
+    run.start()
+    admin = next(iter(devzen_bot.config['adminIds']))
+    taps = [(10 ** 6 + i, uid) for i in range(100 * scale) for uid in random.sample(uids, 10)]
+    markup = InlineKeyboardMarkup([])
+
+    def tap(item):
+        run.call(devzen_bot.vote, callback_update(run.bot, item[0], str(item[1]), markup))
+
+    def archive():
+        sleep(0.05)
+        run.call(devzen_bot.confirm_archive, callback_update(run.bot, admin, '100_0', markup))
+    archiver = threading.Thread(target=archive)
+    archiver.start()
+    run.parallel(tap, taps)
+    archiver.join()
+
+
+# Users going through /propose to the confirmation
+def propose(run, scale):
+    run.start()
+
+    def proposer(user_id):
+        run.call(devzen_bot.start_propose, message_update(run.bot, user_id, '/propose'))
+        run.call(devzen_bot.add_title, message_update(run.bot, user_id, f'Topic from {user_id}'))
+        run.call(devzen_bot.add_body, message_update(run.bot, user_id, 'Some links and text ' * 10))
+        run.call(devzen_bot.confirm_topic, callback_update(run.bot, user_id, '0', None))
+    run.parallel(proposer, range(10 ** 6, 10 ** 6 + 100 * scale))
+
+
+# Users looking topics up with @bot as they type while others vote. The
+# index is turned off in the other scenarios
+def inline_typing(run, scale):
+    populate(topics=300, voters=500, votes_per_voter=10, archived=5000, episodes=100)
+    devzen_bot.topic_index = TopicIndex()
+    devzen_bot.topic_index.load()
+    run.start()
+    markup = InlineKeyboardMarkup([])
+    texts = ['Topic number 12', 'archived topic 42', 'something discussed', 'lorem']
+
+    def typist(user_id):
+        text = texts[user_id % len(texts)]
+        for i in range(1, len(text) + 1):
+            run.call(devzen_bot.inline_query, inline_update(run.bot, user_id, text[:i]))
+        run.call(devzen_bot.inline_query, inline_update(run.bot, user_id, text, '20'))
+        run.call(devzen_bot.vote, callback_update(run.bot, user_id, str(1 + user_id % 300),
+                                                  markup))
+    try:
+        run.parallel(typist, range(10 ** 6, 10 ** 6 + 100 * scale))
+    finally:
+        devzen_bot.topic_index = TopicIndex(enabled=False)
+
+
+# Admins export the whole archive while people vote
+def export_during_voting(run, scale):
+    populate(topics=300, voters=500, votes_per_voter=10, archived=5000 * scale, episodes=100)
+    run.start()
+    admin = next(iter(devzen_bot.config['adminIds']))
+    markup = InlineKeyboardMarkup([])
+
+    def task(i):
+        if i % 100 == 0:
+            run.call(devzen_bot.export, message_update(run.bot, admin, '/export'))
+        else:
+            run.call(devzen_bot.vote, callback_update(run.bot, 10 ** 6 + i, str(1 + i % 300),
+                                                      markup))
+    run.parallel(task, range(500 * scale))
+
+
+SCENARIOS = {
+    'vote_storm': vote_storm,
+    'list_flood': list_flood,
+    'archive_during_voting': archive_during_voting,
+    'propose': propose,
+    'inline_typing': inline_typing,
+    'export_during_voting': export_during_voting,
+}
+
+
+def run_scenario(scenario, scale, threads, latency):
+    with temp_db():
+        bot = FakeBot(latency=latency, rate_limit=None)
+        queries = QueryCounter(db.obj)
+        run = Run(bot, queries, threads)
+        SCENARIOS[scenario](run, scale)
+        elapsed = perf_counter() - run.started
+        # Let delayed keyboard edits go out
+        sleep(devzen_bot.keyboard_edits.window * 2)
+        return run.report(elapsed, queries.total, sum(
+            count for method, count in bot.calls.items() if method != '429'))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', help=', '.join(SCENARIOS))
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=4,
+                        help='concurrent updates, like dispatcher workers')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds every fake Bot API call takes')
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f'unknown scenario {scenario}')
+
+    devzen_bot.config = load_config(
+        'adminIds: [1]\nbotApiToken: "123:stub"\ndrafts:\n  persistent: false\n' +
+        'broadcast:\n  rate: 100000\n  workers: 8\n')
+    results = {'commit': _commit(), 'scale': args.scale, 'threads': args.threads,
+               'latency': args.latency, 'scenarios': {}}
+    for scenario in args.scenarios or SCENARIOS:
+        result = run_scenario(scenario, args.scale, args.threads, args.latency)
+        results['scenarios'][scenario] = result
+        print(f'{scenario}: {result["updates"]} updates in {result["elapsed_s"]}s, ' +
+              f'{result["queries_per_update"]} queries and ' +
+              f'{result["api_calls_per_update"]} API calls per update')
+        for name, stats in result['handlers'].items():
+            print(f'  {name:<24} n={stats["calls"]:<6} p50={stats["p50_ms"]:8.2f}ms ' +
+                  f'p95={stats["p95_ms"]:8.2f}ms p99={stats["p99_ms"]:8.2f}ms ' +
+                  f'q={stats["queries_per_call"]:<6} api={stats["api_calls_per_call"]}')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
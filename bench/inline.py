@@ -0,0 +1,111 @@
+# Inline queries (@bot words) answered from the in-memory TopicIndex against
+# /search in SQLite, over 20k archived topics by default. Queries come letter by
+# letter: a burst of users typing from several threads while others vote, the
+# time is for the search and the results as they are sent to Telegram
+import sys
+import random
+import threading
+import statistics
+from time import perf_counter
+from common import temp_db, populate, measure, report
+
+from models import ArchivedTopics, db
+from search import search_topics, rebuild_search_index
+from inline import TopicIndex, article
+
+WORDS = ['базы', 'данных', 'postgres', 'sqlite', 'kubernetes', 'rust', 'go', 'python',
+         'тестирование', 'микросервисы', 'кэширование', 'компиляторы', 'сети', 'linux']
+THREADS = 8
+
+
+def generate(rnd, vocabulary, words):
+    return ' '.join(rnd.choice(vocabulary) for _ in range(words))
+
+
+def answer(index, text, offset=0):
+    topics, _ = index.search(text, offset)
+    return [article(key, topic) for key, topic in topics]
+
+
+# Every prefix of the words, as the clients send them
+def typed(text):
+    return [text[:i] for i in range(1, len(text) + 1)]
+
+
+def cold(index, text):
+    index._queries.clear()
+    answer(index, text)
+
+
+if __name__ == '__main__':
+    archived = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rnd = random.Random(42)
+    vocabulary = WORDS * 200 + [f'слово{i}' for i in range(5000)]
+
+    with temp_db():
+        populate(topics=200, voters=100, votes_per_voter=5)
+        with db.atomic():
+            rows = [{'user': i, 'username': f'user{i}', 'votes': rnd.randrange(0, 200),
+                     'episode': 1 + i // 20,
+                     'title': generate(rnd, vocabulary, 6),
+                     'body': generate(rnd, vocabulary, 40)} for i in range(archived)]
+            for i in range(0, len(rows), 500):
+                ArchivedTopics.insert_many(rows[i:i + 500]).execute()
+            rebuild_search_index()
+
+        index = TopicIndex()
+        started = perf_counter()
+        index.load()
+        print(f'Loaded {len(index)} topics into the index in {perf_counter() - started:.2f}s')
+
+        queries = [('rare word', 'слово4242'),
+                   ('two common words', 'базы данных'),
+                   ('prefix of common words', 'ком'),
+                   ('live topics', 'topic number'),
+                   ('no matches', 'несуществующее')]
+        rows = []
+        for label, text in queries:
+            rows.append((f'{label}, cached', measure(lambda: answer(index, text))))
+            rows.append((f'{label}, not cached', measure(lambda: cold(index, text))))
+            rows.append((f'{label}, /search', measure(lambda: search_topics(text, 0))))
+        report(f'A page of results over {archived} archived topics', rows)
+
+        # Users typing the queries while votes keep coming
+        typing = [prefix for text in ('базы данных', 'postgres', 'kubernetes сети',
+                                      'слово1 слово2', 'topic number 1', 'rust go')
+                  for prefix in typed(text)]
+        timings = []
+        lock = threading.Lock()
+        voting = threading.Event()
+
+        def user(seed):
+            own = []
+            for text in random.Random(seed).sample(typing, len(typing)) * 20:
+                start = perf_counter()
+                answer(index, text)
+                own.append((perf_counter() - start) * 1000)
+            with lock:
+                timings.extend(own)
+
+        def voter():
+            uid = 0
+            # About 1000 votes a second
+            while not voting.wait(0.001):
+                index.vote(uid % 200 + 1, 1)
+                uid += 1
+
+        votes = threading.Thread(target=voter)
+        votes.start()
+        users = [threading.Thread(target=user, args=(i,)) for i in range(THREADS)]
+        started = perf_counter()
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        elapsed = perf_counter() - started
+        voting.set()
+        votes.join()
+        timings.sort()
+        print(f'{len(timings)} queries from {THREADS} threads while voting: ' +
+              f'{len(timings) / elapsed:.0f}/s, p50={statistics.median(timings):.3f}ms ' +
+              f'p95={timings[int(len(timings) * 0.95)]:.3f}ms max={timings[-1]:.3f}ms')
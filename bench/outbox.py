@@ -0,0 +1,101 @@
+# The weekly reminder through the outbox with the sender killed (SIGKILL) twice
+# halfway, against a local Bot API stub. Every time a new process takes the
+# broadcast over once the lease of the dead one expires. Checks that:
+#  - a second sender doesn't start while the first one is alive
+#  - everyone but the users who blocked the bot gets the message, the ones
+#    in flight when the sender was killed too
+#  - the only ones who get it twice are those the stub had accepted but the
+#    sender hadn't written down yet, at most a message per worker and kill
+#  - every delivered message has its Deliveries row
+#  - the broadcast is finished and the users who blocked the bot unsubscribed
+#
+#   python outbox.py [subscribers]
+import os
+import sys
+import tempfile
+import multiprocessing
+from collections import Counter
+from time import monotonic, sleep
+from common import populate
+from stub_api import StubApi
+
+from telegram import Bot
+from telegram.utils.request import Request
+from models import db, init_database, SubscibedUsers, Outbox, Broadcasts, Deliveries
+from migrations import migrate_database
+from outbox import plan_broadcast, deliver
+
+RATE = 200
+WORKERS = 8
+LEASE_TTL = 2
+
+
+def sender(path, base_url, broadcast_id):
+    init_database({'path': path})
+    db.connect()
+    bot = Bot('123:stub', base_url=base_url, request=Request(con_pool_size=WORKERS))
+    deliver(bot, broadcast_id, rate=RATE, workers=WORKERS, lease_ttl=LEASE_TTL)
+
+
+def check(label, ok):
+    print(f'{"ok" if ok else "FAILED":<7} {label}')
+    return ok
+
+
+if __name__ == '__main__':
+    subscribers = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'outbox.db')
+        init_database({'path': path})
+        db.connect()
+        migrate_database()
+        populate(subscribers=subscribers)
+        blocked = set(range(1, subscribers + 1, 50))
+        broadcast_id = plan_broadcast('reminder:test', 'Время проголосовать')
+
+        stub = StubApi(0.01, blocked=blocked).start()
+        context = multiprocessing.get_context('spawn')
+        started = monotonic()
+        for run, kill_at in enumerate((subscribers // 3, subscribers * 2 // 3, None)):
+            process = context.Process(target=sender, args=(path, stub.base_url, broadcast_id))
+            process.start()
+            if kill_at is None:
+                process.join()
+                break
+            stub.wait_sent(kill_at, timeout=60)
+            if run == 0:
+                check('no second sender while the first one is alive',
+                      deliver(None, broadcast_id, lease_ttl=LEASE_TTL) is None)
+            process.kill()
+            process.join()
+            print(f'Sender {run + 1} killed after {len(stub.sent)} messages')
+            # Until the lease of the dead sender expires
+            sleep(LEASE_TTL + 0.5)
+        elapsed = monotonic() - started
+        stub.stop()
+
+        received = Counter(int(params['chat_id']) for _, params in stub.sent)
+        statuses = dict(Outbox.select(Outbox.user, Outbox.status).where(
+            Outbox.broadcast == broadcast_id).tuples())
+        by_status = Counter(statuses.values())
+        delivered = {user for user, in Deliveries.select(Deliveries.user).where(
+            Deliveries.broadcast == broadcast_id).tuples()}
+        twice = [user for user, count in received.items() if count > 1]
+        print(f'{len(received)} received in {elapsed:.1f}s, ' +
+              ', '.join(f'{status} {count}' for status, count in sorted(by_status.items())) +
+              f', {len(twice)} twice')
+
+        check('everyone but the blocked users got the message',
+              set(received) == set(statuses) - blocked)
+        check('only the messages in flight were sent twice',
+              max(received.values()) <= 2 and len(twice) <= WORKERS * 2)
+        check('every delivered message is written down',
+              delivered == set(received) == {user for user, status in statuses.items()
+                                             if status == 'sent'})
+        check('blocked users are marked and unsubscribed',
+              {user for user, status in statuses.items() if status == 'blocked'} == blocked and
+              not SubscibedUsers.select().where(SubscibedUsers.user.in_(list(blocked))).exists())
+        check('the broadcast is finished',
+              Broadcasts.get_by_id(broadcast_id).finished is not None and
+              by_status['pending'] == by_status['sending'] == 0)
+        db.close()
@@ -0,0 +1,155 @@
+# Long /list N answers next to everyone else's /vote on 4 dispatcher workers,
+# with _send_message() sleeping between the parts of a message on the worker
+# and with the parts queued to outgoing.MessageQueue. Reports how long /vote
+# waits and checks that the queue keeps the order and the intervals of every
+# chat. Also checks _split_html() on random topic lists
+#
+#   python outgoing.py [lists] [votes]
+import re
+import sys
+import random
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter, sleep
+from types import SimpleNamespace
+from common import temp_db, populate, load_config
+from peewee import fn
+from models import db, ArchivedTopics
+from fakes import FakeBot, message_update
+
+import helpers
+import devzen_bot
+from helpers import withConnection, _split_html, _format_topic, _set_message_queue
+from outgoing import MessageQueue
+
+WORKERS = 4
+LATENCY = 0.03
+CHAT_INTERVAL = 1
+
+
+# Remembers when every message went out
+class RecordingBot(FakeBot):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.messages = []
+
+    def send_message(self, chat_id, text, **kwargs):
+        super().send_message(chat_id, text, **kwargs)
+        with self._lock:
+            self.messages.append((chat_id, monotonic(), text))
+
+
+def run(lists, votes, queue):
+    # /vote answers directly, the limit of all the messages together isn't the point here
+    bot = RecordingBot(latency=LATENCY, rate_limit=None)
+    if queue is not None:
+        queue.start()
+    _set_message_queue(queue)
+    waits = {'list_topics': [], 'start_vote': []}
+    lock = threading.Lock()
+
+    def handle(handler, update, args, queued):
+        withConnection(handler)(update, SimpleNamespace(bot=bot, args=args))
+        with lock:
+            waits[handler.__name__].append((perf_counter() - queued) * 1000)
+
+    # /list N from a few users first, then voters keep coming at 20 a second
+    started = monotonic()
+    futures = []
+    with ThreadPoolExecutor(WORKERS) as dispatcher:
+        for i in range(lists):
+            user = 100 + i
+            futures.append(dispatcher.submit(handle, devzen_bot.list_topics,
+                                             message_update(bot, user, f'/list {1 + i % 5}'),
+                                             [str(1 + i % 5)], perf_counter()))
+        for i in range(votes):
+            futures.append(dispatcher.submit(handle, devzen_bot.start_vote,
+                                             message_update(bot, 10 ** 6 + i, '/vote'), [],
+                                             perf_counter()))
+            sleep(0.05)
+    for future in futures:
+        future.result()
+    handled = monotonic() - started
+    if queue is not None:
+        queue.stop(timeout=60)
+    _set_message_queue(None)
+    return waits, bot.messages, handled, monotonic() - started
+
+
+def check(label, ok):
+    print(f'{"ok" if ok else "FAILED":<7} {label}')
+    return ok
+
+
+def check_split():
+    rnd = random.Random(1)
+    words = ['тест', 'база', 'postgres', 'a&b', '<x>', 'https://example.com/' + 'a' * 50]
+    ok = True
+    for _ in range(300):
+        text = '\n\n'.join(
+            _format_topic(' '.join(rnd.choice(words) for _ in range(rnd.randrange(1, 12))),
+                          'user', ' '.join(rnd.choice(words) for _ in range(rnd.randrange(400)))
+                          if rnd.random() < 0.8 else 'x' * rnd.randrange(100, 5000),
+                          votes=rnd.randrange(9)) for _ in range(rnd.randrange(1, 40)))
+        if rnd.random() < 0.3:
+            text = f'<b><i>{text}</i></b>'
+        limit = rnd.choice([100, 500, 3000])
+        parts = _split_html(text, limit)
+        for part in parts:
+            opened = []
+            for tag in re.findall(r'<[^>]*>', part):
+                name = re.match(r'</?(\w+)', tag).group(1)
+                if not tag.startswith('</'):
+                    opened.append(name)
+                elif not opened or opened.pop() != name:
+                    ok = False
+            plain = re.sub(r'<[^>]*>', '', part)
+            ok = ok and len(part) <= limit and not opened and '<' not in plain and \
+                re.search(r'&#?\w*$', re.sub(r'&#?\w+;', '', plain)) is None
+        text_only = ''.join(re.sub(r'<[^>]*>|\s', '', part) for part in parts)
+        ok = ok and text_only == re.sub(r'<[^>]*>|\s', '', text)
+    check('_split_html() keeps parts under the limit, tags balanced and the text whole', ok)
+
+
+if __name__ == '__main__':
+    lists = int(sys.argv[1]) if len(sys.argv) > 1 else 12
+    votes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    devzen_bot.config = load_config()
+    with temp_db():
+        # About 10 messages per episode, a few topics don't fit into one
+        populate(topics=100, archived=5 * 100, episodes=5)
+        with db.atomic():
+            ArchivedTopics.update(body='Очень длинное описание темы. ' * 150).where(
+                fn.MOD(ArchivedTopics.id, 7) == 0).execute()
+        for label, queue in (('sleeping on the worker', None),
+                             ('queued', MessageQueue(chat_interval=CHAT_INTERVAL))):
+            waits, messages, handled, elapsed = run(lists, votes, queue)
+            print(f'{label}: {len(messages)} messages, handlers done in {handled:.1f}s, ' +
+                  f'messages sent in {elapsed:.1f}s')
+            for name, timings in waits.items():
+                timings.sort()
+                print(f'  {name:<12} n={len(timings):<4} ' +
+                      f'p50={statistics.median(timings):8.1f}ms ' +
+                      f'p95={timings[int(len(timings) * 0.95)]:8.1f}ms max={timings[-1]:8.1f}ms')
+            if queue is None:
+                expected = messages
+                continue
+
+            by_chat = {}
+            for chat_id, sent, text in messages:
+                by_chat.setdefault(chat_id, []).append((sent, text))
+            lists_by_chat = {chat: sent for chat, sent in by_chat.items() if chat < 10 ** 6}
+            expected_by_chat = {}
+            for chat_id, _, text in expected:
+                expected_by_chat.setdefault(chat_id, []).append(text)
+            check('every chat got the same messages in the same order',
+                  {chat: [text for _, text in sent] for chat, sent in by_chat.items()} ==
+                  expected_by_chat)
+            gaps = [b[0] - a[0] for sent in lists_by_chat.values()
+                    for a, b in zip(sent, sent[1:])]
+            check(f'queued messages of a chat are at least {CHAT_INTERVAL}s apart '
+                  f'(min {min(gaps):.2f}s)', min(gaps) >= CHAT_INTERVAL - 0.01)
+            check('nothing is left in the queue', len(queue) == 0 and queue.failed == 0)
+        assert helpers.message_queue is None
+    check_split()
@@ -0,0 +1,39 @@
+# Latency of one page of /vote, /list and /delete against the number of
+# topics, for the first page and for a page deep in the list. With keyset
+# pagination both should stay flat from 10 to 10k topics
+from common import temp_db, populate, measure, load_config
+
+import devzen_bot
+from helpers import _ranked_page
+from render import RenderCache, PAGE_SIZE
+
+VOTER = 1
+
+
+def deep_cursors():
+    # Cursors of a page in the middle, found the way a user would get there
+    uids = [uid for uid, in devzen_bot.SuggestedTopics.select(
+        devzen_bot.SuggestedTopics.uid).order_by(devzen_bot.SuggestedTopics.uid).tuples()]
+    after = uids[len(uids) // 2] if len(uids) > PAGE_SIZE else None
+    rows, _, _ = _ranked_page(len(uids) // 2 or 1)
+    return after, f'{rows[-1][1]}_{rows[-1][0]}' if len(uids) > PAGE_SIZE else None
+
+
+if __name__ == '__main__':
+    devzen_bot.config = load_config()
+    print(f'{"topics":>8} ' + ' '.join(f'{label:>14}' for label in (
+        '/vote first', '/vote middle', '/list first', '/list middle', '/delete middle')))
+    for topics in (10, 100, 1000, 10000):
+        with temp_db():
+            populate(topics=topics, voters=1000, votes_per_voter=5)
+            # Cold cache every time: the worst case, a page nobody has seen yet
+            devzen_bot.render_cache = RenderCache(enabled=False)
+            after, ranked_after = deep_cursors()
+            timings = [
+                measure(lambda: devzen_bot._ballot_page(VOTER)),
+                measure(lambda: devzen_bot._ballot_page(VOTER, after=after)),
+                measure(lambda: devzen_bot._list_page()),
+                measure(lambda: devzen_bot._list_page(after=ranked_after)),
+                measure(lambda: devzen_bot._delete_page(after=after)),
+            ]
+            print(f'{topics:>8} ' + ' '.join(f'{t["p50"]:>12.3f}ms' for t in timings))
@@ -0,0 +1,160 @@
+# Checks with EXPLAIN QUERY PLAN that the hot queries of the bot use indexes,
+# both on a fresh database and on one migrated from the oldest schema.
+# Exits with a non-zero code if any of them scans a table. tests/test_query_plans.py
+# runs the same checks
+#
+#   python query_plans.py
+import sys
+from time import time
+from common import temp_db, populate
+
+from peewee import Tuple
+from models import (db, SubscibedUsers, SuggestedTopics, ArchivedTopics, Votes, Leases,
+                    Broadcasts, Outbox, Deliveries, EpisodeStats, YearStats, ProposerStats)
+from migrations import migrate_database, schema_version, MIGRATIONS
+from render import PAGE_SIZE
+
+OLDEST_SCHEMA = '''
+DROP TABLE "votes";
+DROP TABLE "suggestedtopics";
+DROP TABLE "archivedtopics";
+DROP TABLE "schemaversion";
+CREATE TABLE "suggestedtopics" ("uid" INTEGER NOT NULL PRIMARY KEY, "user" INTEGER NOT NULL,
+    "title" VARCHAR(255) NOT NULL, "body" VARCHAR(255) NOT NULL, "username" VARCHAR(255) NOT NULL);
+CREATE TABLE "archivedtopics" ("id" INTEGER NOT NULL PRIMARY KEY, "user" INTEGER NOT NULL,
+    "title" VARCHAR(255) NOT NULL, "body" VARCHAR(255) NOT NULL, "username" VARCHAR(255) NOT NULL,
+    "votes" INTEGER NOT NULL, "episode" INTEGER NOT NULL);
+CREATE TABLE "votes" ("user" INTEGER NOT NULL, "topic_id" INTEGER NOT NULL,
+    PRIMARY KEY ("user", "topic_id"), FOREIGN KEY ("topic_id") REFERENCES "suggestedtopics" ("uid"));
+'''
+
+
+# Tables that grow with the users, a query on them never reads all of them
+NEVER_SCANNED = (SuggestedTopics, Votes, Outbox)
+# Queries that are only as fast as their own index, another one still reads a
+# lot: all the rows of a broadcast, all the topics with the same votes
+INDEXES = {
+    'page: ranked after': 'suggestedtopics_votes',
+    'page: ranked before': 'suggestedtopics_votes',
+    'outbox: claim': 'outbox_broadcast_id_status_user',
+    'outbox: mark sending': 'outbox_broadcast_id_status_user',
+    'outbox: resend': 'outbox_broadcast_id_status_user',
+    'outbox: unfinished': 'broadcasts_finished',
+    'stats: top proposers': 'proposerstats_year_votes',
+    'stats: best topics': 'archivedtopics_episode_votes',
+}
+# Walk a table in the order of its integer primary key, which SQLite shows as a
+# scan without an index: the latest episodes stop after the limit, and there is
+# a row of YearStats per year
+PRIMARY_KEY_ORDER = {'stats: years', 'stats: recent episodes'}
+
+
+# The queries as the bot builds them, with made up values
+def hot_queries():
+    topic = SuggestedTopics(uid=1)
+    uid, votes = SuggestedTopics.uid, SuggestedTopics.votes
+    outbox = (Outbox.broadcast == 1) & (Outbox.status == 'sending')
+    return {
+        'vote: find topic': SuggestedTopics.select().where(SuggestedTopics.uid == 1),
+        'vote: delete vote': Votes.delete().where((Votes.user == 1) & (Votes.topic == topic)),
+        'vote: bump counter': SuggestedTopics.update(votes=SuggestedTopics.votes + 1).where(
+            SuggestedTopics.uid == 1),
+        'start_vote: voted topics': Votes.select(Votes.topic).where(Votes.user == 1),
+        'delete_topic: votes': Votes.delete().where(Votes.topic == topic),
+        'list N': ArchivedTopics.select().where(ArchivedTopics.episode == 1).order_by(
+            ArchivedTopics.votes.desc()),
+        'set_episode_number': ArchivedTopics.select(ArchivedTopics.id).where(
+            ArchivedTopics.episode == 1),
+        'start': SubscibedUsers.select().where(SubscibedUsers.user == 1),
+        # Keyset pages of /vote, /delete and /list, see helpers._topic_page()
+        'page: topics after': SuggestedTopics.select(uid).where(uid > 1).order_by(
+            uid).limit(PAGE_SIZE + 1),
+        'page: topics before': SuggestedTopics.select(uid).where(uid < 100).order_by(
+            uid.desc()).limit(PAGE_SIZE + 1),
+        'page: voted topics': Votes.select(Votes.topic).where(
+            (Votes.user == 1) & Votes.topic.in_(list(range(1, PAGE_SIZE + 1)))),
+        'page: ranked after': SuggestedTopics.select(uid, votes).where(
+            Tuple(votes, uid) < Tuple(10, 1)).order_by(votes.desc(), uid.desc()).limit(
+            PAGE_SIZE + 1),
+        'page: ranked before': SuggestedTopics.select(uid, votes).where(
+            Tuple(votes, uid) > Tuple(10, 1)).order_by(votes, uid).limit(PAGE_SIZE + 1),
+        # The sender of a broadcast, see outbox.py
+        'outbox: claim': Outbox.select(Outbox.user).where(
+            (Outbox.broadcast == 1) & Outbox.status.in_(['pending'])).order_by(
+            Outbox.user).limit(8),
+        'outbox: mark sending': Outbox.update(status='sending').where(
+            (Outbox.broadcast == 1) & (Outbox.status == 'pending') &
+            Outbox.user.in_([1, 2, 3])),
+        'outbox: mark sent': Outbox.update(status='sent').where(outbox & (Outbox.user == 1)),
+        'outbox: resend': Outbox.update(status='pending').where(outbox & Outbox.user.not_in(
+            Deliveries.select(Deliveries.user).where(Deliveries.broadcast == 1))),
+        'outbox: unfinished': Broadcasts.select(Broadcasts.id).where(
+            Broadcasts.finished.is_null()),
+        'outbox: forget': Outbox.delete().where(Outbox.broadcast.in_(
+            Broadcasts.select(Broadcasts.id).where(Broadcasts.finished < 1))),
+        # Jobs and broadcasts of several instances, see cluster.py
+        'lease: renew': Leases.update(holder='b', expires=time()).where(
+            (Leases.name == 'job:notify') & ((Leases.holder == 'b') | (Leases.expires < time()))),
+        # /stats, see stats.py
+        'stats: year': YearStats.select().where(YearStats.year == 0),
+        'stats: years': YearStats.select().where(YearStats.year != 0).order_by(
+            YearStats.year.desc()),
+        'stats: episode': EpisodeStats.select().where(EpisodeStats.episode == 1),
+        'stats: recent episodes': EpisodeStats.select().order_by(
+            EpisodeStats.episode.desc()).limit(5),
+        'stats: top proposers': ProposerStats.select().where(ProposerStats.year == 0).order_by(
+            ProposerStats.votes.desc(), ProposerStats.topics.desc()).limit(5),
+        'stats: best topics': ArchivedTopics.select(ArchivedTopics.title,
+                                                    ArchivedTopics.votes).where(
+            ArchivedTopics.episode == 1).order_by(ArchivedTopics.votes.desc()).limit(3),
+    }
+
+
+# Turns the database of temp_db() into one created by the oldest version and migrated
+def migrate_oldest():
+    db.connection().executescript(OLDEST_SCHEMA)
+    migrate_database()
+    assert schema_version() == len(MIGRATIONS)
+
+
+def query_plan(query):
+    sql, params = query.sql()
+    return [row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+# Returns None if the plan of the query is fine, otherwise what is wrong with it
+def plan_problem(name, plan):
+    query = hot_queries()[name]
+    if query.model in NEVER_SCANNED and any(step.startswith('SCAN') for step in plan):
+        return f'scans {query.model._meta.table_name}'
+    if name not in PRIMARY_KEY_ORDER and any(
+            step.startswith('SCAN') and 'USING' not in step for step in plan):
+        return 'scans a table without an index'
+    if name in INDEXES and not any(f'INDEX {INDEXES[name]} ' in step for step in plan):
+        return f'does not use {INDEXES[name]}'
+    return None
+
+
+def check(label):
+    ok = True
+    print(label, f'(schema version {schema_version()})')
+    for name, query in hot_queries().items():
+        plan = query_plan(query)
+        problem = plan_problem(name, plan)
+        ok &= problem is None
+        print(f'  {"ok  " if problem is None else "FAIL"} {name:<28} {" / ".join(plan)}' +
+              (f' ({problem})' if problem is not None else ''))
+    return ok
+
+
+if __name__ == '__main__':
+    ok = True
+    with temp_db():
+        populate(topics=100, voters=100, votes_per_voter=10)
+        ok &= check('Fresh database')
+
+    with temp_db():
+        migrate_oldest()
+        ok &= check('Migrated database')
+
+    sys.exit(0 if ok else 1)
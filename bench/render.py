@@ -0,0 +1,37 @@
+# /list, /list N and /vote throughput with the render cache on and off.
+# Handlers are called directly with a fake Bot that answers instantly, so
+# the numbers are about rendering and queries only
+from types import SimpleNamespace
+from time import perf_counter
+from common import temp_db, populate, load_config
+from fakes import FakeBot, message_update
+
+import devzen_bot
+from render import RenderCache
+
+CALLS = 300
+
+
+def throughput(handler, bot, args=()):
+    context = SimpleNamespace(bot=bot, args=list(args))
+    started = perf_counter()
+    for i in range(CALLS):
+        handler(message_update(bot, 10 + i % 50, '/command'), context)
+    return CALLS / (perf_counter() - started)
+
+
+if __name__ == '__main__':
+    devzen_bot.config = load_config()
+    with temp_db():
+        populate(topics=200, voters=1000, votes_per_voter=10, archived=3000, episodes=30)
+        bot = FakeBot(latency=0, rate_limit=None)
+        print(f'{"":<12} {"cache off":>12} {"cache on":>12}')
+        for label, handler, args in (('/list', devzen_bot.list_topics, ()),
+                                     ('/list 7', devzen_bot.list_topics, ('7',)),
+                                     ('/vote', devzen_bot.start_vote, ())):
+            results = []
+            for enabled in (False, True):
+                devzen_bot.render_cache = RenderCache(enabled=enabled)
+                results.append(throughput(handler, bot, args))
+            print(f'{label:<12} {results[0]:>10.0f}/s {results[1]:>10.0f}/s')
+        print('hits/misses with the cache on:', devzen_bot.render_cache.metrics())
@@ -0,0 +1,95 @@
+# Concurrent users on the threaded Updater and on the asyncio runtime, against
+# a local Bot API stub that answers every call with a delay. Every user sends
+# /vote at the same time (a conversation, which the Updater handles on its
+# single dispatcher thread) and /list (a command on the pool of workers), the
+# time is measured until all the answers have reached the stub. Then an admin
+# exports the archive, the document has to reach the stub on both runtimes.
+#
+#   python runtimes.py [latency_ms]
+import sys
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+from common import temp_db, populate, load_config
+from stub_api import StubApi, command_update
+
+import devzen_bot
+
+USERS = (10, 50, 200)
+ADMIN = 1
+COMMANDS = (('/vote', 2), ('/list', 1))  # command and messages it sends
+
+
+# Returns the function that stops it. The Updater stops after the getUpdates in
+# flight, which waits up to timeout seconds
+def start(runtime, stub, timeout=10):
+    if runtime == 'threads':
+        updater = devzen_bot.create_updater(base_url=stub.base_url)
+        updater.start_polling(poll_interval=0, timeout=timeout)
+        return updater.stop
+    runtime = devzen_bot.create_runtime(base_url=stub.base_url)
+    thread = threading.Thread(target=runtime.run, kwargs={'handle_signals': False})
+    thread.start()
+
+    def stop():
+        runtime.stop()
+        thread.join()
+    return stop
+
+
+def run(runtime, users, command, messages, latency):
+    stub = StubApi(latency).start()
+    stop = start(runtime, stub)
+    sleep(0.5)
+    stub.sent.clear()
+    started = monotonic()
+    for i in range(users):
+        stub.push_update(command_update(i + 1, 10 ** 6 + i, command))
+    done = stub.wait_sent(users * messages, timeout=120)
+    elapsed = monotonic() - started
+    # Time until the last answer of every user
+    answered = defaultdict(float)
+    for at, params in stub.sent:
+        answered[params['chat_id']] = max(answered[params['chat_id']], at - started)
+    stop()
+    stub.stop()
+    latencies = sorted(answered.values())
+    return (done, elapsed, latencies[len(latencies) // 2],
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))])
+
+
+# Returns the time until the document of /export has reached the stub and its
+# size, None if it hasn't
+def export(runtime, latency):
+    stub = StubApi(latency).start()
+    stop = start(runtime, stub)
+    sleep(0.5)
+    started = monotonic()
+    stub.push_update(command_update(1, ADMIN, '/export'))
+    documents = stub.wait_calls('sendDocument', timeout=60)
+    elapsed = monotonic() - started
+    stop()
+    stub.stop()
+    return elapsed, len(documents[0]['document']['content']) if documents else None
+
+
+if __name__ == '__main__':
+    devzen_bot.config = load_config()
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.05
+    print(f'Bot API latency {latency * 1000:.0f}ms, ' +
+          f'{devzen_bot.config["server"]["workers"]} workers')
+    print(f'{"":<14} {"runtime":<8} {"total":>8} {"updates/s":>10} {"p50":>8} {"p95":>8}')
+    with temp_db():
+        populate(topics=100, voters=500, votes_per_voter=5, archived=20000, episodes=200)
+        for command, messages in COMMANDS:
+            for users in USERS:
+                for runtime in ('threads', 'asyncio'):
+                    done, elapsed, p50, p95 = run(runtime, users, command, messages, latency)
+                    print(f'{command + " x" + str(users):<14} {runtime:<8} ' +
+                          f'{elapsed:>7.2f}s {users / elapsed:>10.1f} ' +
+                          f'{p50 * 1000:>6.0f}ms {p95 * 1000:>6.0f}ms' +
+                          ('' if done else '  (timed out)'))
+        for runtime in ('threads', 'asyncio'):
+            elapsed, size = export(runtime, latency)
+            print(f'{"/export":<14} {runtime:<8} {elapsed:>7.2f}s ' +
+                  (f'{size >> 10}KB document' if size is not None else '  (no document)'))
@@ -0,0 +1,56 @@
+# /search latency over a big archive. Default is 100k archived topics with
+# titles and bodies made of a few thousand distinct words, so that some
+# queries match a handful of topics and some match tens of thousands
+import sys
+import random
+from time import perf_counter
+from common import temp_db, populate, measure, report
+
+from models import ArchivedTopics, db
+from search import search_topics, rebuild_search_index
+
+WORDS = ['базы', 'данных', 'postgres', 'sqlite', 'kubernetes', 'rust', 'go', 'python',
+         'тестирование', 'микросервисы', 'кэширование', 'компиляторы', 'сети', 'linux']
+
+
+def generate(rnd, vocabulary, words):
+    return ' '.join(rnd.choice(vocabulary) for _ in range(words))
+
+
+if __name__ == '__main__':
+    archived = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rnd = random.Random(42)
+    # Zipf-like: the first words are much more frequent than the rest
+    vocabulary = WORDS * 200 + [f'слово{i}' for i in range(5000)]
+
+    with temp_db():
+        populate(topics=200, voters=100, votes_per_voter=5)
+        started = perf_counter()
+        with db.atomic():
+            rows = [{'user': i, 'username': f'user{i}', 'votes': rnd.randrange(0, 200),
+                     'episode': 1 + i // 20,
+                     'title': generate(rnd, vocabulary, 6),
+                     'body': generate(rnd, vocabulary, 40)} for i in range(archived)]
+            for i in range(0, len(rows), 500):
+                ArchivedTopics.insert_many(rows[i:i + 500]).execute()
+        print(f'Inserted {archived} archived topics with index triggers in ' +
+              f'{perf_counter() - started:.1f}s')
+
+        with db.atomic():
+            topics, elapsed = rebuild_search_index()
+        print(f'Rebuilt the index of {topics} topics in {elapsed:.1f}s')
+
+        queries = [('rare word', 'слово4242', 0),
+                   ('two rare words', 'слово17 слово18', 0),
+                   ('common word', 'postgres', 0),
+                   ('common word, page 10', 'postgres', 90),
+                   ('two common words', 'базы данных', 0),
+                   ('prefix of common words', 'ком', 0),
+                   ('no matches', 'несуществующее', 0),
+                   ('live topics', 'topic number', 0)]
+        rows = []
+        for label, terms, offset in queries:
+            hits, more = search_topics(terms, offset)
+            rows.append((f'{label} ({len(hits)}{"+" if more else ""})',
+                         measure(lambda: search_topics(terms, offset))))
+        report(f'search_topics() over {archived} archived topics', rows)
@@ -0,0 +1,198 @@
+# A local stand-in for the Bot API server: answers getMe/setWebhook, serves
+# queued updates via long-polling getUpdates and records sent messages and
+# the other calls (with the files of uploads as {'filename', 'content'}).
+# latency is added to every response to simulate the network, messages to the
+# users in blocked are answered with 403 like for users who have blocked the bot.
+# Messages after the first hold_after are held unanswered and dropped when the
+# stub stops, like requests that never reached the server
+import json
+import threading
+from email.parser import BytesParser
+from email.policy import default
+from time import monotonic, time, sleep
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class StubApi:
+    def __init__(self, latency=0, blocked=(), hold_after=None):
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.hold_after = hold_after
+        self.updates = []
+        self.sent = []
+        # (time, method, params) of everything but getMe and getUpdates
+        self.calls = []
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        # Keep-alive and a listen backlog that takes a burst of new connections,
+        # like the real one
+        ThreadingHTTPServer.request_queue_size = 128
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        # Clients go away in the middle of a request when they are killed or stopped
+        self._server.handle_error = lambda request, client_address: None
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}/bot'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._server.shutdown()
+
+    def push_update(self, update):
+        with self._condition:
+            self.updates.append(update)
+            self._condition.notify_all()
+
+    def wait_sent(self, count, timeout=10):
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self.sent) >= count, timeout)
+
+    # Returns the params of the first count calls of method, fewer on timeout
+    def wait_calls(self, method, count=1, timeout=10):
+        def calls():
+            return [params for _, called, params in self.calls if called == method]
+        with self._condition:
+            self._condition.wait_for(lambda: len(calls()) >= count, timeout)
+            return calls()[:count]
+
+    def _get_updates(self, params):
+        offset = int(params.get('offset') or 0)
+        deadline = monotonic() + float(params.get('timeout') or 0)
+        with self._condition:
+            while True:
+                pending = [u for u in self.updates if u['update_id'] >= offset]
+                if pending or monotonic() >= deadline:
+                    return pending
+                self._condition.wait(deadline - monotonic())
+
+    def _call(self, method, params):
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+        if method == 'getUpdates':
+            return self._get_updates(params)
+        with self._condition:
+            if (method == 'sendMessage' and self.hold_after is not None and
+                    len(self.sent) >= self.hold_after):
+                return _HELD
+            self.calls.append((monotonic(), method, params))
+            if method == 'sendMessage':
+                self.sent.append((monotonic(), params))
+            self._condition.notify_all()
+            message_id = len(self.calls)
+        if method in ('sendMessage', 'sendDocument'):
+            return {'message_id': message_id, 'date': int(time()), 'text': params.get('text'),
+                    'chat': {'id': int(params['chat_id']), 'type': 'private'}}
+        return True
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                params = _params(self.headers.get('Content-Type', ''), body)
+                method = self.path.rsplit('/', 1)[-1]
+                status = 200
+                if method == 'sendMessage' and int(params.get('chat_id', 0)) in stub.blocked:
+                    status = 403
+                    result = {'ok': False, 'error_code': 403,
+                              'description': 'Forbidden: bot was blocked by the user'}
+                else:
+                    result = stub._call(method, params)
+                    if result is _HELD:
+                        stub._stopped.wait()
+                        self.close_connection = True
+                        return
+                    result = {'ok': True, 'result': result}
+                response = json.dumps(result).encode()
+                sleep(stub.latency)
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            do_GET = do_POST
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+_HELD = object()
+
+
+# Uploads come as multipart/form-data, everything else as JSON
+def _params(content_type, body):
+    if not body:
+        return {}
+    if not content_type.startswith('multipart/form-data'):
+        return json.loads(body)
+    message = BytesParser(policy=default).parsebytes(
+        f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+    params = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        content = part.get_payload(decode=True)
+        if part.get_filename() is None:
+            params[name] = content.decode()
+        else:
+            params[name] = {'filename': part.get_filename(), 'content': content}
+    return params
+
+
+# Recorded /help command from a private chat, with ids changed. The command may
+# have arguments
+def command_update(update_id, user_id, command='/help'):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': 'Ivan'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Ivan',
+                     'username': f'user{user_id}', 'language_code': 'ru'},
+            'text': command,
+            'entities': [{'offset': 0, 'length': len(command.split()[0]),
+                          'type': 'bot_command'}],
+        },
+    }
+
+
+# Plain text, e.g. the title of a topic in /propose
+def text_update(update_id, user_id, text):
+    update = command_update(update_id, user_id, text)
+    del update['message']['entities']
+    return update
+
+
+# A tap on an inline button of a message the bot has sent to the user
+def callback_update(update_id, user_id, data, message_id=1, reply_markup=None):
+    message = command_update(message_id, user_id)['message']
+    if reply_markup is not None:
+        message['reply_markup'] = reply_markup
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(user_id),
+            'from': message['from'],
+            'message': {**message, 'from': {'id': 1, 'is_bot': True, 'first_name': 'Stub'},
+                        'text': 'Опубликовать тему?', 'entities': []},
+            'data': data,
+        },
+    }
@@ -0,0 +1,36 @@
+# Topic ranking for /list and /archive: the old GROUP BY + LEFT OUTER JOIN UNION
+# against the materialized SuggestedTopics.votes counter
+from common import temp_db, populate, measure, report, sorted_topics
+
+from models import SuggestedTopics, Votes
+from peewee import fn, JOIN
+from helpers import _check_vote_counters
+
+
+def union_tally():
+    query = Votes.select(SuggestedTopics.username.alias('username'),
+                         SuggestedTopics.user.alias('user'),
+                         SuggestedTopics.title.alias('title'),
+                         SuggestedTopics.body.alias('body'),
+                         fn.COUNT(SuggestedTopics.title).alias('votes')
+                         ).join(SuggestedTopics).group_by(SuggestedTopics.title) | \
+        SuggestedTopics.select(SuggestedTopics.username,
+                               SuggestedTopics.user,
+                               SuggestedTopics.title,
+                               SuggestedTopics.body,
+                               0).join(Votes, JOIN.LEFT_OUTER).where(Votes.topic.is_null())
+    return sorted(list(query.namedtuples()), key=lambda x: x.votes, reverse=True)
+
+
+if __name__ == '__main__':
+    for topics, voters in ((100, 1000), (300, 5000), (1000, 5000)):
+        with temp_db():
+            populate(topics=topics, voters=voters, votes_per_voter=20)
+            votes = Votes.select().count()
+            assert [t.votes for t in union_tally()] == \
+                [t.votes for t in sorted_topics()]
+            report(f'{topics} topics, {votes} votes', [
+                ('GROUP BY + UNION', measure(union_tally, repeat=10)),
+                ('ORDER BY votes counter', measure(sorted_topics, repeat=10)),
+                ('consistency check', measure(_check_vote_counters, repeat=10)),
+            ])
@@ -0,0 +1,218 @@
+# Tally engines of /list against topics x voters: loading the ballots (the
+# pairwise matrix of all the ballots at once), a vote (a row and a column of it)
+# and the ranking after a change, which is what the first /list after a vote
+# waits for. The pairwise matrix and Schulze are also counted in plain Python
+# where it takes less than a minute. Checks the engines against that count, a
+# textbook Schulze election and the votes replayed through the database.
+# Requires numpy
+#
+#   python tally_engines.py
+import random
+from time import perf_counter, time
+from common import temp_db, populate, measure
+
+from models import db, SuggestedTopics, Votes
+from helpers import _toggle_vote, _rebuild_vote_counters
+from tally import CountTally, BordaTally, SchulzeTally, _pairwise
+
+SIZES = [(50, 1000), (50, 10000), (200, 1000), (200, 10000), (200, 50000),
+         (500, 10000), (500, 50000)]
+VOTES_PER_VOTER = (1, 15)
+# The plain Python counts are skipped above these
+PYTHON_PAIRS = 100 * 1000 * 1000
+PYTHON_SCHULZE = 200
+
+
+# Ballots of the topics 1..topics, some topics are much more popular than the
+# others. Returns {user: [uid]} the most preferred first
+def ballots(topics, voters, seed=42):
+    rnd = random.Random(seed)
+    uids = list(range(1, topics + 1))
+    weights = [1 / (uid ** 0.8) for uid in uids]
+    result = {}
+    for user in range(1, voters + 1):
+        ballot = []
+        for uid in rnd.choices(uids, weights, k=rnd.randint(*VOTES_PER_VOTER)):
+            if uid not in ballot:
+                ballot.append(uid)
+        result[user] = ballot
+    return result
+
+
+# Cast a day ago a vote a second, before the votes of the checks
+def insert(votes):
+    created = time() - 24 * 60 * 60
+    rows = [{'user': user, 'topic': uid, 'created': created + i}
+            for user, ballot in votes.items() for i, uid in enumerate(ballot)]
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            Votes.insert_many(rows[i:i + 500]).execute()
+        _rebuild_vote_counters()
+    return len(rows)
+
+
+def python_pairwise(ballots, n):
+    d = [[0] * n for _ in range(n)]
+    for ballot in ballots:
+        unranked = set(range(n)).difference(ballot)
+        for position, row in enumerate(ballot):
+            line = d[row]
+            for other in ballot[position + 1:]:
+                line[other] += 1
+            for other in unranked:
+                line[other] += 1
+    return d
+
+
+def python_schulze(d):
+    n = len(d)
+    p = [[d[i][j] if d[i][j] > d[j][i] else 0 for j in range(n)] for i in range(n)]
+    for k in range(n):
+        for i in range(n):
+            if i == k:
+                continue
+            for j in range(n):
+                if j != i and j != k:
+                    p[i][j] = max(p[i][j], min(p[i][k], p[k][j]))
+    return [sum(p[i][j] > p[j][i] for j in range(n) if j != i) for i in range(n)]
+
+
+def rerank(tally):
+    with tally._lock:
+        tally._ranking = None
+    return tally.ranking()
+
+
+def check(label, ok):
+    print(f'{"ok" if ok else "FAILED":<7} {label}')
+    return ok
+
+
+# The example of the Schulze method from Wikipedia: E > A > C > B > D
+def check_textbook():
+    groups = [(5, 'ACBED'), (5, 'ADECB'), (8, 'BEDAC'), (3, 'CABED'), (7, 'CAEBD'),
+              (2, 'CBADE'), (7, 'DCEBA'), (8, 'EBADC')]
+    tally = SchulzeTally()
+    d, _ = _pairwise(tally._np, [['ABCDE'.index(c) for c in order]
+                                 for count, order in groups for _ in range(count)], 5)
+    check('Schulze of the textbook election is E > A > C > B > D',
+          tally.scores(d).tolist() == [3, 1, 2, 0, 4] and d[3][4] == 14 and d[4][3] == 31)
+
+
+# Random taps through the database and the engine, then the engine against a
+# fresh load and against plain Python
+def check_votes(topics, voters):
+    with temp_db():
+        populate(topics=topics)
+        insert(ballots(topics, voters))
+        engines = [BordaTally(), SchulzeTally()]
+        for tally in engines:
+            tally.load()
+        rnd = random.Random(1)
+        for _ in range(3000):
+            user, uid = rnd.randint(1, voters + 20), rnd.randint(1, topics)
+            voted = _toggle_vote(user, uid)
+            for tally in engines:
+                tally.vote(user, uid, voted)
+        # A topic proposed after the votes and a vote for it
+        SuggestedTopics.insert(uid=topics + 1, user=1, username='user', title='New',
+                               body='New topic').execute()
+        for tally in engines:
+            tally.add(topics + 1)
+        _toggle_vote(1, topics + 1)
+        for tally in engines:
+            tally.vote(1, topics + 1, True)
+
+        for tally in engines:
+            loaded = type(tally)()
+            loaded.load()
+            n = topics + 1
+            check(f'{tally.method}: votes one by one give the matrix and the ranking of a load',
+                  (tally._d[:n, :n] == loaded._d[:n, :n]).all() and
+                  tally.ranking() == loaded.ranking())
+        tally = engines[1]
+        order = [[tally._rows[uid] for uid in topics_of]
+                 for topics_of in _ballots_from_db().values()]
+        d = python_pairwise(order, topics + 1)
+        check('the matrix is the plain Python count of the ballots',
+              tally._d[:topics + 1, :topics + 1].tolist() == d)
+        check('Schulze is the plain Python one',
+              tally.scores(tally._d[:topics + 1, :topics + 1]).tolist() == python_schulze(d))
+        check('Borda is the plain Python one',
+              engines[0].scores(engines[0]._d[:topics + 1, :topics + 1]).tolist() ==
+              [sum(line) for line in d])
+
+        # Pages forward and back cover the ranking once
+        ranking, pages, cursor = tally.ranking(), [], None
+        while True:
+            rows, has_prev, has_next = tally.page(7, after=cursor)
+            pages.extend(rows)
+            if not has_next:
+                break
+            cursor = tally.cursor(rows[-1])
+        back, cursor = [], tally.cursor(pages[-1])
+        while True:
+            rows, has_prev, _ = tally.page(7, before=cursor)
+            back = rows + back
+            if not has_prev:
+                break
+            cursor = tally.cursor(rows[0])
+        check('pages of /list go through the ranking both ways',
+              [(uid, votes) for uid, votes, _ in pages] == ranking and
+              [place for _, _, place in pages] == list(range(1, len(ranking) + 1)) and
+              back == pages[:-1])
+        rows, _, _ = CountTally().page(7)
+        check('the count ranks by votes', [votes for _, votes, _ in rows] ==
+              sorted((votes for _, votes in ranking), reverse=True)[:7])
+
+
+def _ballots_from_db():
+    result = {}
+    for user, uid in db.execute(Votes.select(Votes.user, Votes.topic).order_by(
+            Votes.user, Votes.created, Votes.topic)):
+        result.setdefault(user, []).append(uid)
+    return result
+
+
+def timed(fn):
+    started = perf_counter()
+    result = fn()
+    return (perf_counter() - started) * 1000, result
+
+
+if __name__ == '__main__':
+    check_textbook()
+    check_votes(40, 500)
+
+    print(f'{"topics":>6} {"voters":>6} {"votes":>7} {"load":>10} {"python":>10} ' +
+          f'{"vote":>9} {"count":>9} {"borda":>9} {"schulze":>9} {"python":>10}')
+    for topics, voters in SIZES:
+        with temp_db():
+            populate(topics=topics)
+            votes = insert(ballots(topics, voters))
+            count, borda, schulze = CountTally(), BordaTally(), SchulzeTally()
+            load = measure(schulze.load, repeat=3)['p50']
+            borda.load()
+
+            # The same taps back and forth, the ballot grows and shrinks by one
+            taps = iter(range(10 ** 9))
+
+            def tap():
+                schulze.vote(1, topics // 2, next(taps) % 2 == 0)
+
+            vote = measure(tap, repeat=200)['p50']
+            ranked = [measure(lambda: count.page(20), repeat=10)['p50'],
+                      measure(lambda: rerank(borda), repeat=10)['p50'],
+                      measure(lambda: rerank(schulze), repeat=5)['p50']]
+
+            python = python_schulze_ms = '-'
+            rows = [[schulze._rows[uid] for uid in ballot]
+                    for ballot in _ballots_from_db().values()]
+            if votes * topics <= PYTHON_PAIRS:
+                elapsed, d = timed(lambda: python_pairwise(rows, topics))
+                python = f'{elapsed:.0f}ms'
+                if topics <= PYTHON_SCHULZE:
+                    python_schulze_ms = f'{timed(lambda: python_schulze(d))[0]:.0f}ms'
+            print(f'{topics:>6} {voters:>6} {votes:>7} {load:>8.1f}ms {python:>10} ' +
+                  f'{vote * 1000:>7.1f}us ' + ' '.join(f'{t:>7.2f}ms' for t in ranked) +
+                  f' {python_schulze_ms:>10}')
@@ -0,0 +1,40 @@
+# Telegram API calls caused by a burst of vote taps: one user quickly taps
+# through the first page of the ballot, changes their mind a few times and
+# double taps some buttons
+from time import sleep
+from types import SimpleNamespace
+from common import temp_db, populate
+from fakes import FakeBot, callback_update
+
+from helpers import _get_voted_topic_uids
+import devzen_bot
+
+USER = 1
+
+
+def burst(topics):
+    # tap every topic, untap every other one, double tap half of those back
+    taps = [(str(uid), None) for uid in topics]
+    taps += [(str(uid), None) for uid in topics[::2]]
+    taps += [(str(uid), f'double-{uid}') for uid in topics[::4] for _ in range(2)]
+    return taps
+
+
+if __name__ == '__main__':
+    with temp_db():
+        populate(topics=20)
+        _, markup = devzen_bot._ballot_page(USER)
+        uids = [int(row[0].callback_data) for row in markup.inline_keyboard
+                if row[0].callback_data.lstrip('-').isdigit()]
+        taps = burst(uids)
+
+        bot = FakeBot(latency=0.001, rate_limit=None)
+        context = SimpleNamespace(bot=bot)
+        for data, query_id in taps:
+            devzen_bot.vote(callback_update(bot, USER, data, markup, query_id=query_id), context)
+        sleep(devzen_bot.keyboard_edits.window * 2)
+
+        print(f'{len(taps)} taps: {bot.calls["answerCallbackQuery"]} answers, ' +
+              f'{bot.calls["editMessageReplyMarkup"] + bot.calls["editMessageText"]} edits ' +
+              '(one edit per tap before)')
+        print(f'votes stored: {len(_get_voted_topic_uids(USER))} of {len(uids)} topics')
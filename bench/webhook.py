@@ -0,0 +1,64 @@
+# Update-to-reply latency of polling and webhook modes against a local Bot API
+# stub. Each update is a /help command, the latency is measured from handing
+# the update over (queued for getUpdates or POSTed to the webhook) to the
+# sendMessage request arriving at the stub. The stub answers every API call
+# with a delay to simulate the network between the bot and Telegram
+import sys
+import json
+import socket
+import statistics
+import urllib.request
+from time import monotonic, sleep
+from common import temp_db, load_config
+from stub_api import StubApi, command_update
+
+import devzen_bot
+
+UPDATES = 200
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def run(mode, latency):
+    stub = StubApi(latency).start()
+    updater = devzen_bot.create_updater(base_url=stub.base_url)
+    if mode == 'webhook':
+        port = free_port()
+        updater.start_webhook(listen='127.0.0.1', port=port, url_path='hook',
+                              webhook_url=stub.base_url + '/hook')
+        sleep(0.5)
+
+        def deliver(update):
+            request = urllib.request.Request(f'http://127.0.0.1:{port}/hook',
+                                             data=json.dumps(update).encode(),
+                                             headers={'Content-Type': 'application/json'})
+            urllib.request.urlopen(request).read()
+    else:
+        updater.start_polling(poll_interval=0, timeout=10)
+        sleep(0.5)
+        deliver = stub.push_update
+
+    latencies = []
+    for i in range(1, UPDATES + 1):
+        started = monotonic()
+        deliver(command_update(i, 1000 + i))
+        stub.wait_sent(i)
+        latencies.append((stub.sent[i - 1][0] - started) * 1000)
+    updater.stop()
+    stub.stop()
+    return latencies
+
+
+if __name__ == '__main__':
+    devzen_bot.config = load_config()
+    latency = float(sys.argv[1]) / 1000 if len(sys.argv) > 1 else 0.03
+    with temp_db():
+        for mode in ('polling', 'webhook'):
+            latencies = sorted(run(mode, latency))
+            print(f'{mode:<8} network {latency * 1000:.0f}ms p50={statistics.median(latencies):6.2f}ms ' +
+                  f'p95={latencies[int(len(latencies) * 0.95)]:6.2f}ms ' +
+                  f'max={latencies[-1]:6.2f}ms')
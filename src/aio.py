@@ -0,0 +1,409 @@
+import ssl
+import json
+import signal
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from urllib.parse import urlsplit
+from uuid import uuid4
+import certifi
+import tornado.web
+from telegram import Bot, Update, User, InputFile
+from telegram.error import (TelegramError, NetworkError, TimedOut, RetryAfter, ChatMigrated,
+                            Unauthorized, BadRequest, InvalidToken, Conflict)
+from telegram.ext import Dispatcher, JobQueue
+from helpers import logger, _iterate_handlers
+from metrics import API_SECONDS, API_ERRORS
+
+POLL_TIMEOUT = 10
+# Updates received but not handled yet. Polling stops and the webhook doesn't
+# answer Telegram beyond this
+MAX_PENDING_UPDATES = 1000
+MAX_RETRIES = 3
+# Time to finish the updates and messages already in flight on shutdown
+STOP_TIMEOUT = 10
+
+
+# Bot API over keep-alive HTTP/1.1 connections opened with asyncio streams.
+# PTB 13 only has a blocking client, and there is nothing in requirements.txt
+# to do it with, so it's written by hand: it only has to POST JSON (or a form
+# with files for uploads) and read a JSON answer. Errors are the ones
+# telegram.utils.request raises
+class BotApi:
+    def __init__(self, token, base_url='https://api.telegram.org/bot', connections=16,
+                 timeout=30):
+        url = urlsplit(base_url + token)
+        self.timeout = timeout
+        self._host = url.hostname
+        self._ssl = None
+        if url.scheme == 'https':
+            self._ssl = ssl.create_default_context(cafile=certifi.where())
+        self._port = url.port or (443 if self._ssl else 80)
+        self._path = url.path
+        self._idle = []
+        self._slots = asyncio.Semaphore(connections)
+
+    async def call(self, method, data=None, timeout=None):
+        data = {key: value for key, value in (data or {}).items() if value is not None}
+        if any(isinstance(value, InputFile) for value in data.values()):
+            body, content_type = _multipart(data)
+        else:
+            body, content_type = json.dumps(data).encode(), 'application/json'
+        started = perf_counter()
+        try:
+            async with self._slots:
+                status, response = await asyncio.wait_for(
+                    self._post(method, body, content_type), timeout or self.timeout)
+            return _parse(status, response)
+        except asyncio.TimeoutError:
+            API_ERRORS.inc(method, 'TimedOut')
+            raise TimedOut()
+        except TelegramError as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(perf_counter() - started, method)
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+    async def _post(self, method, body, content_type):
+        request = (f'POST {self._path}/{method} HTTP/1.1\r\n' +
+                   f'Host: {self._host}\r\n' +
+                   f'Content-Type: {content_type}\r\n' +
+                   f'Content-Length: {len(body)}\r\n\r\n').encode() + body
+        while True:
+            reused = len(self._idle) > 0
+            if reused:
+                reader, writer = self._idle.pop()
+            else:
+                try:
+                    reader, writer = await asyncio.open_connection(self._host, self._port,
+                                                                   ssl=self._ssl)
+                except OSError as e:
+                    raise NetworkError(f'Connection failed: {e}')
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, response, keep_alive = await _read_response(reader)
+            except asyncio.CancelledError:
+                writer.close()
+                raise
+            except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                writer.close()
+                # The server may close an idle connection at any time
+                if reused:
+                    continue
+                raise NetworkError(f'Connection failed: {e}')
+            if keep_alive:
+                self._idle.append((reader, writer))
+            else:
+                writer.close()
+            return status, response
+
+
+# sendDocument and the other uploads. The Bot has read the files into InputFile
+# by the time the call is queued, the other fields go as JSON values like
+# telegram.utils.request does
+def _multipart(data):
+    boundary = uuid4().hex
+    parts = []
+    for key, value in data.items():
+        if isinstance(value, InputFile):
+            filename = value.filename.replace('"', '')
+            header = (f'Content-Disposition: form-data; name="{key}"; filename="{filename}"\r\n' +
+                      f'Content-Type: {value.mimetype}\r\n')
+            content = value.input_file_content
+        else:
+            header = f'Content-Disposition: form-data; name="{key}"\r\n'
+            content = (value if isinstance(value, str) else json.dumps(value)).encode()
+        parts.append(f'--{boundary}\r\n{header}\r\n'.encode() + content + b'\r\n')
+    return (b''.join(parts) + f'--{boundary}--\r\n'.encode(),
+            f'multipart/form-data; boundary={boundary}')
+
+
+async def _read_response(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionResetError('Connection closed')
+    version, status = line.decode('latin-1').split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, value = line.decode('latin-1').split(':', 1)
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    if 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        body = b''.join(chunks)
+    else:
+        body = await reader.read()
+        keep_alive = False
+    return int(status), body, keep_alive
+
+
+def _parse(status, body):
+    try:
+        data = json.loads(body.decode('utf-8'))
+    except ValueError:
+        raise NetworkError(f'Invalid server response ({status})')
+    if 200 <= status <= 299 and data.get('ok'):
+        return data['result']
+
+    parameters = data.get('parameters') or {}
+    if 'migrate_to_chat_id' in parameters:
+        raise ChatMigrated(parameters['migrate_to_chat_id'])
+    if 'retry_after' in parameters:
+        raise RetryAfter(parameters['retry_after'])
+    message = data.get('description') or 'Unknown HTTPError'
+    if status in (401, 403):
+        raise Unauthorized(message)
+    if status == 400:
+        raise BadRequest(message)
+    if status == 404:
+        raise InvalidToken()
+    if status == 409:
+        raise Conflict(message)
+    if 200 <= status <= 299:
+        raise TelegramError(message)
+    raise NetworkError(f'{message} ({status})')
+
+
+# Stands in for telegram.utils.request.Request of the Bot the handlers get:
+# calls are queued to the runtime and return True right away, so a handler
+# never waits for Telegram. Nothing in the handlers uses what the Bot API
+# returns for them. Files to upload are already read into memory, a handler
+# may close them as soon as the call returns
+class _DeferredRequest:
+    def __init__(self, runtime):
+        self._runtime = runtime
+
+    def post(self, url, data, timeout=None):
+        self._runtime.submit(url.rsplit('/', 1)[-1], data, timeout)
+        return True
+
+    # _send_message() pauses between the parts of a long message with this
+    # instead of sleeping
+    def pause(self, chat_id, seconds):
+        self._runtime.submit(None, {'chat_id': chat_id, 'seconds': seconds})
+
+    def stop(self):
+        pass
+
+
+class _WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, runtime):
+        self.runtime = runtime
+
+    async def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            self.set_status(400)
+            return
+        await self.runtime._receive(data)
+
+
+# Runs the handlers of a PTB Dispatcher on asyncio instead of Updater threads:
+#  - updates are received with long polling or by the webhook on the event loop
+#  - the handlers themselves are synchronous (peewee), they run on the DB executor
+#    of workers threads. Updates of the same chat are handled one by one in
+#    order, just like the dispatcher thread does, different chats at the same time
+#  - Bot API calls made by the handlers are queued and sent by the event loop,
+#    in order for every chat, without holding an executor thread
+# Jobs still use PTB's JobQueue, coroutines can be run from them with
+# run_coroutine()
+class AsyncRuntime:
+    def __init__(self, token, base_url='https://api.telegram.org/bot', workers=4,
+                 persistence=None, connections=16):
+        self.api = BotApi(token, base_url, connections)
+        self.bot = Bot(token, base_url=base_url, request=_DeferredRequest(self))
+        self.job_queue = JobQueue()
+        self.dispatcher = Dispatcher(self.bot, None, workers=0, persistence=persistence,
+                                     job_queue=self.job_queue)
+        self.job_queue.set_dispatcher(self.dispatcher)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='db')
+        self.loop = None
+        if persistence is not None:
+            _lock_conversations(persistence)
+        # chat_id: deque of updates or Bot API calls waiting for their turn
+        self._incoming = {}
+        self._outgoing = {}
+        self._tasks = set()
+        self._pending = None
+        self._stopped = None
+
+    # Blocks until stop() or SIGINT/SIGTERM. mode is polling or webhook, the
+    # webhook is served on listen:port/url_path and registered as webhook_url
+    def run(self, mode='polling', listen='0.0.0.0', port=8443, url_path='',
+            webhook_url=None, max_connections=40, handle_signals=True):
+        asyncio.run(self._run(mode, listen, port, url_path, webhook_url, max_connections,
+                              handle_signals))
+
+    # Thread safe
+    def stop(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+
+    # Run a synchronous function (anything touching the database) on the executor
+    async def run_sync(self, fn, *args):
+        return await self.loop.run_in_executor(self.executor, fn, *args)
+
+    # Thread safe, for jobs
+    def run_coroutine(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    # Thread safe. method None is a pause of data['seconds'] in the chat
+    def submit(self, method, data, timeout=None):
+        self.loop.call_soon_threadsafe(self._send, method, data, timeout)
+
+    async def _run(self, mode, listen, port, url_path, webhook_url, max_connections,
+                   handle_signals):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._pending = asyncio.Semaphore(MAX_PENDING_UPDATES)
+        if handle_signals:
+            for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+                self.loop.add_signal_handler(signum, self._stopped.set)
+
+        # The executor serializes updates of a chat, the dispatcher's worker pool isn't used
+        for group in self.dispatcher.handlers.values():
+            for handler in _iterate_handlers(group):
+                handler.run_async = False
+        # CommandHandler checks /command@username against it
+        self.bot._bot = User.de_json(await self.api.call('getMe'), self.bot)
+        self.job_queue.start()
+
+        server = None
+        if mode == 'webhook':
+            app = tornado.web.Application([(f'/{url_path}/?', _WebhookHandler,
+                                            {'runtime': self})])
+            server = app.listen(port, listen)
+            await self.api.call('setWebhook', {'url': webhook_url,
+                                               'max_connections': max_connections})
+            await self._stopped.wait()
+        else:
+            await self.api.call('deleteWebhook')
+            poller = asyncio.ensure_future(self._poll())
+            await self._stopped.wait()
+            poller.cancel()
+        logger.info('Stopping, %d chats have updates or messages in flight',
+                    len(self._incoming) + len(self._outgoing))
+
+        if server is not None:
+            server.stop()
+        self.job_queue.stop()
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=STOP_TIMEOUT)
+        if self.dispatcher.persistence is not None:
+            self.dispatcher.persistence.flush()
+        self.executor.shutdown(wait=True)
+        await self.api.close()
+
+    async def _poll(self):
+        offset = 0
+        while True:
+            try:
+                updates = await self.api.call('getUpdates',
+                                              {'offset': offset, 'timeout': POLL_TIMEOUT},
+                                              timeout=POLL_TIMEOUT + 10)
+            except TelegramError as e:
+                logger.warning('Failed to get updates: %s', e)
+                await asyncio.sleep(1)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                await self._receive(data)
+
+    async def _receive(self, data):
+        await self._pending.acquire()
+        # The slot is released by _handle(), only once the update got there
+        try:
+            update = Update.de_json(data, self.bot)
+            chat = update.effective_chat or update.effective_user
+            self._enqueue(self._incoming, chat.id if chat else None, update, self._handle)
+        except Exception:
+            self._pending.release()
+            logger.exception('Dropped update %s', data.get('update_id'))
+
+    async def _handle(self, update):
+        try:
+            await self.run_sync(self.dispatcher.process_update, update)
+        finally:
+            self._pending.release()
+
+    def _send(self, method, data, timeout):
+        self._enqueue(self._outgoing, data.get('chat_id'), (method, data, timeout), self._call)
+
+    async def _call(self, item):
+        method, data, timeout = item
+        if method is None:
+            await asyncio.sleep(data['seconds'])
+            return
+        for _ in range(MAX_RETRIES):
+            try:
+                await self.api.call(method, data, timeout)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except TelegramError as e:
+                logger.warning('%s to %s failed: %s', method, data.get('chat_id'), e)
+                return
+
+    # Items of the same key are handled one after another by one task, which
+    # is gone once they are over. Items without a key get a task each
+    def _enqueue(self, queues, key, item, handle):
+        if key is None:
+            self._spawn(handle(item))
+            return
+        items = queues.get(key)
+        if items is not None:
+            items.append(item)
+            return
+        items = queues[key] = deque([item])
+
+        async def drain():
+            try:
+                while items:
+                    try:
+                        await handle(items[0])
+                    except Exception as e:
+                        logger.exception(e)
+                    items.popleft()
+            finally:
+                del queues[key]
+        self._spawn(drain())
+
+    def _spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+# Conversations of different chats are handled at the same time and
+# PicklePersistence rewrites its file on every change of a conversation
+def _lock_conversations(persistence):
+    lock = threading.Lock()
+    update_conversation = persistence.update_conversation
+
+    def locked(*args, **kwargs):
+        with lock:
+            return update_conversation(*args, **kwargs)
+    object.__setattr__(persistence, 'update_conversation', locked)
@@ -0,0 +1,236 @@
+import os
+import sys
+import gzip
+import shutil
+import sqlite3
+from datetime import datetime
+from time import sleep, time, perf_counter
+from helpers import logger
+
+# Online snapshots of the SQLite database: the backup API copies the database
+# a few pages at a time while the bot keeps writing, the copy is checked with
+# PRAGMA integrity_check and kept gzipped as <name>-<UTC time>.db.gz, the last
+# ones only. At startup (dbinit.py) a missing or corrupt database is restored
+# from the newest snapshot that passes the check
+
+SUFFIX = '.db.gz'
+# Every write of the bot starts a backup over in the rollback journal modes
+MAX_RESTARTS = 10
+COPY_CHUNK = 1024 * 1024
+
+
+def _stem(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def snapshot_name(path, taken):
+    return f'{_stem(path)}-{datetime.utcfromtimestamp(taken):%Y%m%d-%H%M%S}{SUFFIX}'
+
+
+# Snapshots of the database at path, the newest first
+def snapshots(path, directory):
+    if not os.path.isdir(directory):
+        return []
+    prefix = _stem(path) + '-'
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory), reverse=True)
+            if name.startswith(prefix) and name.endswith(SUFFIX)]
+
+
+# Returns None if the database is fine, what is wrong with it otherwise.
+# quick_check skips the indexes, it takes a second instead of several on hundreds of MB
+def check_database(path, quick=False):
+    try:
+        database = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            result = [row[0] for row in database.execute(
+                'PRAGMA quick_check' if quick else 'PRAGMA integrity_check')]
+        finally:
+            database.close()
+    except sqlite3.DatabaseError as e:
+        return str(e)
+    return None if result == ['ok'] else '; '.join(result[:5])
+
+
+# Copies pages of the database at a time and sleeps pause seconds after every
+# step. Returns how many times the copy started over
+def _copy(path, copy, pages, pause):
+    source = sqlite3.connect(f'file:{path}?mode=ro', uri=True, isolation_level=None)
+    target = sqlite3.connect(copy, isolation_level=None)
+    restarts = 0
+    last = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                raise sqlite3.OperationalError(
+                    f'The database changed during the backup {restarts} times')
+        last = remaining
+        sleep(pause)
+
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+            # A read transaction keeps the same snapshot of the database for all
+            # the steps, otherwise every commit of the bot starts the copy over.
+            # Writers aren't blocked by it in WAL mode, the WAL just isn't
+            # checkpointed past the snapshot until the copy is done
+            source.execute('BEGIN')
+            source.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+        source.backup(target, pages=pages, progress=progress)
+        # The snapshot is one file
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        source.close()
+        target.close()
+    return restarts
+
+
+# Decompresses the snapshot into target. Returns None if it is fine, what is
+# wrong with it otherwise
+def _unpack(snapshot, target):
+    try:
+        with gzip.open(snapshot, 'rb') as compressed, open(target, 'wb') as data:
+            shutil.copyfileobj(compressed, data, COPY_CHUNK)
+    except (OSError, EOFError) as e:
+        return str(e)
+    return check_database(target)
+
+
+def _remove(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+# Takes a snapshot of the database at path into directory and removes all but
+# the keep newest ones. Returns the snapshot, its size, the seconds it took and
+# the number of restarts. Raises sqlite3.Error or OSError, nothing is kept then
+def backup_database(path, directory, pages=256, pause=0.005, keep=8, compress_level=1):
+    started = perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    snapshot = os.path.join(directory, snapshot_name(path, time()))
+    copy = snapshot[:-len('.gz')]
+    try:
+        restarts = _copy(path, copy, pages, pause)
+        problem = check_database(copy)
+        if problem is not None:
+            raise sqlite3.DatabaseError(f'The copy of {path} is corrupt: {problem}')
+        with open(copy, 'rb') as data, gzip.open(snapshot + '.tmp', 'wb',
+                                                 compresslevel=compress_level) as compressed:
+            shutil.copyfileobj(data, compressed, COPY_CHUNK)
+        os.replace(snapshot + '.tmp', snapshot)
+    finally:
+        _remove(copy, copy + '-journal', snapshot + '.tmp')
+    for old in snapshots(path, directory)[keep:]:
+        os.remove(old)
+    return snapshot, os.path.getsize(snapshot), perf_counter() - started, restarts
+
+
+# Restores the database at path from the newest good snapshot if it is missing
+# or corrupt, or anyway with force. The old file and its WAL are moved aside as
+# <path>.<time>. Returns the snapshot it was restored from or None
+def restore_database(path, directory, force=False):
+    available = snapshots(path, directory)
+    if os.path.exists(path) and not force:
+        problem = check_database(path, quick=True)
+        if problem is None:
+            return None
+        logger.error('%s is corrupt: %s', path, problem)
+    elif len(available) > 0 and not force:
+        logger.warning('%s is missing', path)
+
+    restored = path + '.restored'
+    for snapshot in available:
+        problem = _unpack(snapshot, restored)
+        if problem is not None:
+            logger.error('Snapshot %s is corrupt: %s', snapshot, problem)
+            continue
+        # A WAL left next to the restored database would be applied to it
+        aside = f'{datetime.utcnow():%Y%m%d-%H%M%S}'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.replace(path + suffix, f'{path}.{aside}{suffix}')
+        os.replace(restored, path)
+        logger.warning('%s is restored from %s', path, snapshot)
+        return snapshot
+
+    _remove(restored)
+    if len(available) > 0:
+        logger.error('No good snapshot of %s in %s', path, directory)
+    return None
+
+
+# The scheduled backup of the bot, see the backup section of config.yaml
+class Backups:
+    def __init__(self, path, directory, interval=6 * 60 * 60, keep=8, pages=256, pause=0.005,
+                 compress_level=1):
+        self.path = path
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+        self.pages = pages
+        self.pause = pause
+        self.compress_level = compress_level
+        self.taken = 0
+        self.failed = 0
+        self.size = 0
+        self.seconds = 0
+
+    # Seconds until the next backup is due. Restarts of the bot don't put it off
+    def first(self):
+        newest = snapshots(self.path, self.directory)[:1]
+        age = time() - os.path.getmtime(newest[0]) if newest else self.interval
+        return max(60, self.interval - age)
+
+    def run(self, context=None):
+        try:
+            snapshot, self.size, self.seconds, restarts = backup_database(
+                self.path, self.directory, pages=self.pages, pause=self.pause, keep=self.keep,
+                compress_level=self.compress_level)
+        except (sqlite3.Error, OSError) as e:
+            self.failed += 1
+            logger.error('Backup of %s failed: %s', self.path, e)
+            return
+        self.taken = time()
+        logger.info('Backup %s: %.1fMB in %.1fs, %d restarts', snapshot, self.size / 2 ** 20,
+                    self.seconds, restarts)
+
+    def metrics(self):
+        return {'taken': self.taken, 'failed': self.failed, 'size': self.size,
+                'seconds': self.seconds}
+
+
+# python backup.py [backup|verify|restore] with the storage and backup sections
+# of config.yaml. restore replaces the database even if it is fine
+if __name__ == '__main__':
+    from helpers import _parse_config
+    from models import STORAGE_DEFAULTS
+    config = _parse_config()
+    if config is None:
+        sys.exit(1)
+    path = {**STORAGE_DEFAULTS, **config['storage']}['path']
+    settings = config['backup']
+    command = sys.argv[1] if len(sys.argv) > 1 else 'backup'
+    if command == 'backup':
+        backups = Backups(path, settings['directory'], keep=settings['keep'],
+                          pages=settings['pages'], pause=settings['pause'],
+                          compress_level=settings['compressLevel'])
+        backups.run()
+        sys.exit(1 if backups.failed else 0)
+    elif command == 'verify':
+        broken = 0
+        for checked in [path] + snapshots(path, settings['directory']):
+            if checked.endswith(SUFFIX):
+                problem = _unpack(checked, path + '.verify')
+                _remove(path + '.verify')
+            else:
+                problem = check_database(checked) if os.path.exists(checked) else 'missing'
+            broken += problem is not None
+            print(f'{checked}: {problem or "ok"}')
+        sys.exit(1 if broken else 0)
+    elif command == 'restore':
+        sys.exit(0 if restore_database(path, settings['directory'], force=True) else 1)
+    else:
+        print('Usage: python backup.py [backup|verify|restore]')
+        sys.exit(2)
@@ -0,0 +1,254 @@
+import queue
+import asyncio
+import threading
+from time import monotonic, sleep
+from telegram.error import RetryAfter, Unauthorized, BadRequest, TelegramError
+from helpers import logger
+from metrics import SLEEP_SECONDS
+
+# The current rate limit is 30 messages per second (see https://core.telegram.org/bots/faq)
+TELEGRAM_RATE_LIMIT = 30
+# Don't go lower than this after RetryAfter, otherwise 50k users will take forever
+MIN_RATE = 1
+MAX_RETRIES = 5
+PROGRESS_EVERY = 1000
+
+
+# Global token bucket shared by all the senders. Slows down on RetryAfter
+# (halves the rate and stops everyone for the requested time) and slowly
+# speeds up again on every successful send. name is the label of the time
+# spent waiting in the metrics
+class TokenBucket:
+    def __init__(self, rate=TELEGRAM_RATE_LIMIT, capacity=None, name='broadcast'):
+        self.name = name
+        self.max_rate = rate
+        self.rate = rate
+        # Small burst, otherwise the first second goes over the limit
+        self.capacity = capacity if capacity is not None else 1
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    # Takes a token and returns 0, or returns how long to wait for one
+    def _reserve(self):
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.capacity,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return
+            sleep(wait)
+            SLEEP_SECONDS.inc(self.name, amount=wait)
+
+    # The same for the asyncio runtime, waits without holding a thread
+    async def acquire_async(self):
+        while True:
+            wait = self._reserve()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def throttle(self, retry_after):
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + retry_after)
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self._tokens = 0
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+
+class BroadcastStats:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.blocked = []
+        self.started = monotonic()
+        self.finished = None
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        return (self.finished or monotonic()) - self.started
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0
+
+    def __str__(self):
+        return (f'sent {self.sent}, blocked {len(self.blocked)}, failed {self.failed}, ' +
+                f'retries {self.retries} in {self.elapsed:.1f}s ' +
+                f'({self.throughput:.1f} msg/s)')
+
+
+# Returns 'blocked' or 'failed', or None if the message should be sent again
+def _failed(bucket, stats, chat_id, e):
+    if isinstance(e, RetryAfter):
+        bucket.throttle(e.retry_after)
+        with stats._lock:
+            stats.retries += 1
+        return None
+    # User has blocked the bot or deactivated the account
+    if isinstance(e, Unauthorized) or (isinstance(e, BadRequest) and
+                                       'chat not found' in e.message.lower()):
+        with stats._lock:
+            stats.blocked.append(chat_id)
+        return 'blocked'
+    logger.warning('Failed to notify %s: %s', chat_id, e)
+    with stats._lock:
+        stats.failed += 1
+    return 'failed'
+
+
+def _sent(bucket, stats):
+    bucket.recover()
+    with stats._lock:
+        stats.sent += 1
+        if stats.sent % PROGRESS_EVERY == 0:
+            logger.info('Broadcast progress: %s', stats)
+
+
+# Returns what has become of the message: 'sent', 'blocked' or 'failed'
+def _send(bot, bucket, stats, chat_id, text, parse_mode):
+    for _ in range(MAX_RETRIES):
+        bucket.acquire()
+        try:
+            bot.send_message(chat_id, text, parse_mode=parse_mode)
+        except TelegramError as e:
+            status = _failed(bucket, stats, chat_id, e)
+            if status is None:
+                continue
+            return status
+        _sent(bucket, stats)
+        return 'sent'
+
+    with stats._lock:
+        stats.failed += 1
+    return 'failed'
+
+
+async def _send_async(api, bucket, stats, chat_id, text, parse_mode):
+    for _ in range(MAX_RETRIES):
+        await bucket.acquire_async()
+        try:
+            await api.call('sendMessage', {'chat_id': chat_id, 'text': text,
+                                           'parse_mode': parse_mode})
+        except TelegramError as e:
+            status = _failed(bucket, stats, chat_id, e)
+            if status is None:
+                continue
+            return status
+        _sent(bucket, stats)
+        return 'sent'
+
+    with stats._lock:
+        stats.failed += 1
+    return 'failed'
+
+
+async def _iterate_async(chat_ids):
+    if hasattr(chat_ids, '__aiter__'):
+        async for chat_id in chat_ids:
+            yield chat_id
+    else:
+        for chat_id in chat_ids:
+            yield chat_id
+
+
+# Send the same text to every chat in chat_ids using a bounded pool of senders.
+# chat_ids may be a lazy iterable (e.g. a peewee query), it is consumed only as
+# fast as the senders go, at most queue_size chats ahead of them.
+# report(chat_id, status) is called by the senders once a chat is done with,
+# status is 'sent', 'blocked' or 'failed'
+def broadcast(bot, chat_ids, text, rate=TELEGRAM_RATE_LIMIT, workers=8, parse_mode=None,
+              report=None, queue_size=None):
+    bucket = TokenBucket(rate)
+    stats = BroadcastStats()
+    pending = queue.Queue(maxsize=queue_size or workers * 4)
+
+    def sender():
+        while True:
+            chat_id = pending.get()
+            if chat_id is None:
+                return
+            try:
+                status = _send(bot, bucket, stats, chat_id, text, parse_mode)
+            except Exception as e:
+                logger.exception(e)
+                with stats._lock:
+                    stats.failed += 1
+                status = 'failed'
+            if report is not None:
+                report(chat_id, status)
+
+    threads = [threading.Thread(target=sender, name=f'broadcast-{i}', daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    # The senders finish what is queued even if chat_ids fails
+    try:
+        for chat_id in chat_ids:
+            pending.put(chat_id)
+    finally:
+        for _ in threads:
+            pending.put(None)
+        for thread in threads:
+            thread.join()
+
+    stats.finished = monotonic()
+    logger.info('Broadcast finished: %s', stats)
+    return stats
+
+
+# broadcast() for the asyncio runtime: the senders are tasks calling the Bot API
+# client of the runtime (aio.BotApi) directly. chat_ids is a list read from the
+# database beforehand, on the executor of the runtime, or an async iterable.
+# report is a coroutine function here, it may use the database on the executor
+async def broadcast_async(api, chat_ids, text, rate=TELEGRAM_RATE_LIMIT, workers=8,
+                          parse_mode=None, report=None, queue_size=None):
+    bucket = TokenBucket(rate)
+    stats = BroadcastStats()
+    pending = asyncio.Queue(maxsize=queue_size or workers * 4)
+
+    async def sender():
+        while True:
+            chat_id = await pending.get()
+            if chat_id is None:
+                return
+            try:
+                status = await _send_async(api, bucket, stats, chat_id, text, parse_mode)
+            except Exception as e:
+                logger.exception(e)
+                with stats._lock:
+                    stats.failed += 1
+                status = 'failed'
+            if report is not None:
+                await report(chat_id, status)
+
+    senders = [asyncio.ensure_future(sender()) for _ in range(workers)]
+    try:
+        async for chat_id in _iterate_async(chat_ids):
+            await pending.put(chat_id)
+    finally:
+        for _ in senders:
+            await pending.put(None)
+        await asyncio.gather(*senders)
+
+    stats.finished = monotonic()
+    logger.info('Broadcast finished: %s', stats)
+    return stats
@@ -0,0 +1,198 @@
+import os
+import json
+import pickle
+import uuid
+import socket
+import threading
+from collections.abc import MutableMapping
+from functools import wraps
+from time import time
+from peewee import IntegrityError
+from telegram.ext import BasePersistence, DispatcherHandlerStop
+from models import Leases, Conversations, HandledUpdates, Versions, write_transaction
+from helpers import logger, withConnection
+
+# Several instances of the bot can run on one database (Postgres, or SQLite on a
+# disk they all see) behind a load balancer in webhook mode. Everything they
+# share is in the database:
+#  - conversation states (DatabasePersistence) and drafts (DraftStore(shared=True)),
+#    so any instance can take the next step of /propose or /vote
+#  - update ids, so that an update Telegram delivers twice is handled once
+#  - leases, so that a scheduled job runs on one instance only
+#  - versions of what the instances cache (rendered topics, near-duplicate index)
+# Leases compare Unix timestamps of different instances, keep their clocks in sync
+
+
+def instance_name():
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+
+
+# Returns True if holder has got (or renewed) the lease for ttl seconds. A single
+# conditional UPDATE or INSERT, so two instances can't both take it
+def acquire_lease(name, holder, ttl):
+    now = time()
+    try:
+        with write_transaction():
+            if Leases.update(holder=holder, expires=now + ttl).where(
+                    (Leases.name == name) &
+                    ((Leases.holder == holder) | (Leases.expires < now))).execute() > 0:
+                return True
+            Leases.insert(name=name, holder=holder, expires=now + ttl).execute()
+            return True
+    except IntegrityError:
+        return False
+
+
+# Every instance schedules the same jobs at the same time. The instance that takes
+# the lease of the job first runs it, the others skip this run. The lease is kept
+# for hold seconds, which has to be shorter than the interval of the job and
+# longer than the difference between the clocks of the instances
+def run_once(job, name, holder, hold):
+    name = 'job:' + name
+
+    @wraps(job)
+    def wrapper(context):
+        if not acquire_lease(name, holder, hold):
+            logger.info('%s is run by another instance', name)
+            return
+        logger.info('%s is run by %s', name, holder)
+        return job(context)
+    return wrapper
+
+
+# Forget updates older than age seconds, Telegram doesn't deliver them again
+def forget_handled_updates(context=None, age=24 * 60 * 60):
+    with write_transaction():
+        HandledUpdates.delete().where(HandledUpdates.handled < time() - age).execute()
+
+
+def _encode_key(key):
+    return json.dumps(list(key) if isinstance(key, tuple) else key)
+
+
+def _decode_key(key):
+    key = json.loads(key)
+    return tuple(key) if isinstance(key, list) else key
+
+
+# The conversations dict of a ConversationHandler which reads and writes the
+# Conversations table every time, instead of a dict in memory
+class _SharedConversations(MutableMapping):
+    def __init__(self, name):
+        self.name = name
+
+    def __getitem__(self, key):
+        state = withConnection(Conversations.select(Conversations.state).where(
+            (Conversations.name == self.name) &
+            (Conversations.key == _encode_key(key))).scalar)()
+        if state is None:
+            raise KeyError(key)
+        return pickle.loads(state)
+
+    def __setitem__(self, key, state):
+        withConnection(self._save)(key, state)
+
+    def __delitem__(self, key):
+        withConnection(self._delete)(key)
+
+    def __iter__(self):
+        keys = withConnection(lambda: [row.key for row in Conversations.select(
+            Conversations.key).where(Conversations.name == self.name)])()
+        return iter([_decode_key(key) for key in keys])
+
+    def __len__(self):
+        return withConnection(Conversations.select().where(
+            Conversations.name == self.name).count)()
+
+    # One query instead of one per key (metrics.conversation_gauge)
+    def values(self):
+        return withConnection(lambda: [pickle.loads(row.state) for row in Conversations.select(
+            Conversations.state).where(Conversations.name == self.name)])()
+
+    def _save(self, key, state):
+        with write_transaction():
+            Conversations.insert(name=self.name, key=_encode_key(key),
+                                 state=pickle.dumps(state)).on_conflict(
+                conflict_target=[Conversations.name, Conversations.key],
+                preserve=[Conversations.state]).execute()
+
+    def _delete(self, key):
+        with write_transaction():
+            Conversations.delete().where((Conversations.name == self.name) &
+                                         (Conversations.key == _encode_key(key))).execute()
+
+
+# Persistence for conversations only. The dicts it gives to the handlers write
+# the changes themselves, so update_conversation() has nothing left to do
+class DatabasePersistence(BasePersistence):
+    def __init__(self):
+        super().__init__(store_user_data=False, store_chat_data=False, store_bot_data=False)
+
+    def get_conversations(self, name):
+        return _SharedConversations(name)
+
+    def update_conversation(self, name, key, new_state):
+        pass
+
+    def get_user_data(self):
+        return {}
+
+    def get_chat_data(self):
+        return {}
+
+    def get_bot_data(self):
+        return {}
+
+    def update_user_data(self, user_id, data):
+        pass
+
+    def update_chat_data(self, chat_id, data):
+        pass
+
+    def update_bot_data(self, data):
+        pass
+
+
+# A number in the Versions table. bump() tells the other instances that
+# something has changed, check() calls on_change() once it sees that the
+# number is different from the last time
+class SharedVersion:
+    def __init__(self, name, on_change):
+        self.name = name
+        self.on_change = on_change
+        self._seen = None
+        self._lock = threading.Lock()
+
+    def bump(self):
+        with write_transaction():
+            Versions.insert(name=self.name, value=1).on_conflict(
+                conflict_target=[Versions.name],
+                update={Versions.value: Versions.value + 1}).execute()
+            value = Versions.select(Versions.value).where(Versions.name == self.name).scalar()
+        with self._lock:
+            # This instance knows about its own change, unless there were others
+            if self._seen == value - 1:
+                self._seen = value
+
+    def check(self):
+        value = Versions.select(Versions.value).where(Versions.name == self.name).scalar() or 0
+        with self._lock:
+            seen, self._seen = self._seen, value
+        if seen is not None and seen != value:
+            self.on_change()
+
+
+# Runs before everything else (group -2), stops updates another instance has
+# already taken and looks for changes made by the other instances
+def claim_update(versions):
+    @withConnection
+    def claim(update, context):
+        try:
+            with write_transaction():
+                HandledUpdates.insert(update_id=update.update_id, handled=time()).execute()
+        except IntegrityError:
+            logger.info('Update %d is handled by another instance', update.update_id)
+            raise DispatcherHandlerStop()
+        for version in versions:
+            version.check()
+    return claim
@@ -0,0 +1,82 @@
+import threading
+from collections import OrderedDict
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import BadRequest, TelegramError
+from helpers import logger
+
+
+# Remembers the last max_size ids, e.g. callback query ids of taps that were
+# already handled
+class RecentIds:
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns True if the id was seen before, remembers it otherwise
+    def seen(self, id):
+        with self._lock:
+            if id in self._ids:
+                self._ids.move_to_end(id)
+                return True
+            self._ids[id] = None
+            if len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+            return False
+
+
+def _copy_markup(markup):
+    return InlineKeyboardMarkup([[InlineKeyboardButton(text=button.text,
+                                                       callback_data=button.callback_data)
+                                  for button in row] for row in markup.inline_keyboard])
+
+
+# Keyboard edits of the same message are delayed by window seconds and only the
+# latest keyboard is sent, so a burst of taps results in a single API call.
+# If the taps cancel each other out, nothing is sent at all
+class EditCoalescer:
+    def __init__(self, window=0.5):
+        self.window = window
+        self.requested = 0
+        self.sent = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    # The keyboard the user will see after the pending edit, as a copy that is safe to change
+    def current(self, chat_id, message_id, markup):
+        with self._lock:
+            pending = self._pending.get((chat_id, message_id))
+            return _copy_markup(pending['markup'] if pending is not None else markup)
+
+    def push(self, bot, chat_id, message_id, markup, original):
+        key = (chat_id, message_id)
+        with self._lock:
+            self.requested += 1
+            if key in self._pending:
+                self._pending[key]['markup'] = markup
+                return
+            self._pending[key] = {'markup': markup, 'original': original.to_dict()}
+        timer = threading.Timer(self.window, self._flush, (bot, key))
+        timer.daemon = True
+        timer.start()
+
+    # Drop the pending edit, e.g. when the message is replaced with a text
+    def cancel(self, chat_id, message_id):
+        with self._lock:
+            self._pending.pop((chat_id, message_id), None)
+
+    def _flush(self, bot, key):
+        with self._lock:
+            pending = self._pending.pop(key, None)
+        if pending is None or pending['markup'].to_dict() == pending['original']:
+            return
+        try:
+            bot.edit_message_reply_markup(chat_id=key[0], message_id=key[1],
+                                          reply_markup=pending['markup'])
+            with self._lock:
+                self.sent += 1
+        except BadRequest as e:
+            if 'not modified' not in e.message.lower():
+                logger.warning('Failed to update keyboard: %s', e)
+        except TelegramError as e:
+            logger.warning('Failed to update keyboard: %s', e)
@@ -1,5 +1,12 @@
-from models import db
-from models import SubscibedUsers, SuggestedTopics, ArchivedTopics, Votes
+from models import init_database, STORAGE_DEFAULTS
+from helpers import _parse_config
+from migrations import migrate_database
+from backup import restore_database
 
-db.create_tables([SubscibedUsers, SuggestedTopics,
-                  ArchivedTopics, Votes], safe=True)
+config = _parse_config()
+storage = {**STORAGE_DEFAULTS, **(config['storage'] if config is not None else {})}
+# Before anything opens the database, a corrupt one can't be migrated anyway
+if config is not None and config['backup']['restore'] and storage['backend'] == 'sqlite':
+    restore_database(storage['path'], config['backup']['directory'])
+init_database(config['storage'] if config is not None else None)
+migrate_database()
@@ -1,16 +1,45 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import html
+import threading
 import telegram
-from time import sleep
-from models import SubscibedUsers, SuggestedTopics, Votes, ArchivedTopics, db
-from peewee import IntegrityError
-from helpers import (_send_message, _parse_config, _format_topic,
-                     isAdmin, logger, config, _get_sorted_topics_with_votes)
-from telegram import (InlineKeyboardButton,
+from datetime import datetime
+from models import (SubscibedUsers, SuggestedTopics, Votes, ArchivedTopics,
+                    init_database, write_transaction, STORAGE_DEFAULTS)
+from peewee import IntegrityError, DatabaseError
+from helpers import (_send_message, _parse_config, _format_topic, _format_votes, _pack_messages,
+                     isAdmin, logger, config, _check_vote_counters, _rebuild_vote_counters,
+                     _topic_page, _get_voted_topic_uids,
+                     withConnection, _wrap_handlers, _toggle_vote, _archive_topics,
+                     _topic_uid, _set_message_queue)
+from outbox import (plan_broadcast, deliver, deliver_async, unfinished_broadcasts,
+                    broadcast_progress)
+from aio import AsyncRuntime
+from outgoing import MessageQueue
+from drafts import DraftStore
+from coalescing import EditCoalescer, RecentIds
+from similarity import DuplicateIndex
+from inline import TopicIndex, article
+from tally import CountTally, create_tally
+from backup import Backups
+from flood import FloodGuard
+from cluster import (DatabasePersistence, SharedVersion, instance_name, run_once,
+                     claim_update, forget_handled_updates)
+from render import RenderCache, PAGE_SIZE
+from stats import (ALL_TIME, rebuild_stats, year_stats, stats_years, episode_stats,
+                   recent_episodes, top_proposers, best_topics)
+from export import (FORMATS, MAX_DOCUMENT_SIZE, UPLOAD_TIMEOUT, topic_rows, export_topics,
+                    export_filename)
+from search import (search_topics, search_supported, rebuild_search_index, save_search,
+                    saved_search, forget_searches)
+from metrics import (REGISTRY, Gauge, CallbackCounter, timed, instrument_database,
+                     instrument_bot, conversation_gauge, start_server)
+from telegram import (InlineKeyboardButton, Update,
                       InlineKeyboardMarkup, ReplyKeyboardRemove)
 from telegram.ext import (RegexHandler, Updater, CommandHandler, CallbackQueryHandler,
-                          MessageHandler, Filters, ConversationHandler)
+                          MessageHandler, Filters, ConversationHandler, PicklePersistence,
+                          TypeHandler, InlineQueryHandler)
 
 HELP_MESSAGE = '''Я поддерживаю следующие команды:
 
@@ -18,18 +47,43 @@ HELP_MESSAGE = '''Я поддерживаю следующие команды:
 /vote – проголосовать за тему. Вам будет предоставлен список тем, предложенных другими пользователями.
 /list – посмотреть текущий список тем.
 /list episode_number – посмотреть список тем к выпуску под номером episode_number.
-/unsubscribe – отписаться от напоминаний проголосовать за выпуск.'''
+/search слова – найти темы текущего и прошлых выпусков, например, чтобы проверить, не обсуждали ли это уже.
+/unsubscribe – отписаться от напоминаний проголосовать за выпуск.
+
+В любом чате можно набрать @ и мое имя, а за ним слова из темы, чтобы отправить туда текущую или архивную тему с числом голосов.'''
 
 ADMIN_HELP_MESSAGE = '''\n\nКоманды администраторов:
 
 /archive – архивировать список тем прошедшего выпуска. Все темы переместятся в архив, за них больше нельзя будет голосовать, а список текущих тем обнулится.
-/delete – удалить тему, предложенную пользователем. Например, если она нарушает правила.'''
-
-state = {}
+/delete – удалить тему, предложенную пользователем. Например, если она нарушает правила.
+/recount – проверить и пересчитать счетчики голосов.
+/reindex – перестроить поисковый индекс.
+/broadcasts – посмотреть, как идут рассылки напоминаний.
+/stats – статистика архива: выпуски, годы и самые популярные авторы тем.
+/stats episode_number – статистика выпуска под номером episode_number.
+/restats – пересчитать статистику архива.
+/export [с_выпуска] [по_выпуск] [csv|json] – выгрузить темы выпусков файлом, без номеров выпусков – весь архив и текущие темы.'''
+
+drafts = DraftStore()
+duplicates = DuplicateIndex()
+topic_index = TopicIndex(enabled=False)
+tally = CountTally()
+render_cache = RenderCache()
+keyboard_edits = EditCoalescer()
+handled_callbacks = RecentIds()
+flood_guard = FloodGuard()
+# Set on the threads runtime, see outgoing.py
+message_queue = None
+# Set when several instances share the database, see cluster.py
+instance = None
+topics_version = None
+# Set if the SQLite database is backed up, see backup.py
+backups = None
 TITLE, BODY, CONFIRMATION = range(3)
 VOTE = range(3, 4)
 DELETE = range(4, 5)
 EPISODE_NUMBER, ARCHIVE = range(5, 7)
+SEARCH_PAGE_SIZE = 10
 
 
 @isAdmin
@@ -38,9 +92,10 @@ def start_archive(update, context):
         'Вы собираетесь зафиксировать список тем для прошедшего выпуска.\n' +
         'Пожалуйста, ознакомьтесь со списком тем. Вы не сможете изменить ' +
         'его после архивации.')
-    list_topics(update, context)
-    update.message.reply_text(
-        'К какому эпизоду предназначены эти темы? Пожалуйста, введите номер:')
+    # The question goes the same way as the topics, after them
+    for message in _review_messages() or ['К сожалению, пока никто не предложил тем.']:
+        _send_message(update, message)
+    _send_message(update, 'К какому эпизоду предназначены эти темы? Пожалуйста, введите номер:')
 
     return EPISODE_NUMBER
 
@@ -73,51 +128,83 @@ def confirm_archive(update, context):
     (episode, choice) = query.data.split('_')
     # We should archive all the topics and delete them from list
     if choice == '0':
+        # The archive is one transaction, a failed one leaves the topics as they were
         try:
-            with db.atomic():
-                topics = _get_sorted_topics_with_votes()
-                for topic in topics:
-                    ArchivedTopics.create(
-                        user=topic.user,
-                        username=topic.username,
-                        title=topic.title,
-                        body=topic.body,
-                        votes=topic.votes,
-                        episode=episode)
-                Votes.delete().execute()
-                SuggestedTopics.delete().execute()
-
-            query.edit_message_text('Темы архивированы')
-        except IntegrityError:
-            query.edit_message_text(
-                'Тема с таким заголовком и текстом уже существует.')
-
+            topics, votes, elapsed = _archive_topics(int(episode))
+        except DatabaseError as e:
+            logger.exception(e)
+            query.edit_message_text('Не удалось архивировать темы, ничего не изменилось. '
+                                    'Попробуйте снова.')
+            return ConversationHandler.END
+        duplicates.archive(int(episode))
+        topic_index.archive(int(episode))
+        tally.clear()
+        _topics_changed()
+        query.edit_message_text(
+            f'Темы архивированы: {topics} тем, {votes} голосов за {elapsed:.2f} с')
     else:
         query.edit_message_text('Попробуйте снова.')
 
     return ConversationHandler.END
 
 
+# Prev/next buttons of a page. The callback data carries the cursor: the first
+# topic of the page for the previous page and the last one for the next page
+def _page_buttons(prefix, first, last, has_prev, has_next):
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text='⬅️ Назад', callback_data=f'{prefix}_prev_{first}'))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text='Дальше ➡️', callback_data=f'{prefix}_next_{last}'))
+    return [buttons] if len(buttons) > 0 else []
+
+
+# Returns (after, before) cursors of a page button
+def _page_cursor(data, parse=int):
+    _, direction, cursor = data.split('_', 2)
+    return (parse(cursor), None) if direction == 'next' else (None, parse(cursor))
+
+
+# Returns the keyboard of a page of /delete, None if there are no topics
+def _delete_page(after=None, before=None):
+    uids, has_prev, has_next = _topic_page(PAGE_SIZE, after, before)
+    topics = render_cache.topics(uids)
+    if len(topics) == 0:
+        # Everything past the cursor was deleted meanwhile, start over
+        return _delete_page() if after is not None or before is not None else None
+
+    return InlineKeyboardMarkup(
+        inline_keyboard=[topic.button for topic in topics] +
+        _page_buttons('delete', topics[0].uid, topics[-1].uid, has_prev, has_next) +
+        [[InlineKeyboardButton(text='Закончить', callback_data='STOP')]])
+
+
 @isAdmin
 def start_delete(update, context):
+    markup = _delete_page()
     # if there are no topics yet.
-    if SuggestedTopics.select().count() == 0:
+    if markup is None:
         update.message.reply_text('В настоящее время тем нет')
         return ConversationHandler.END
 
-    keyboard = []
-    for topic in SuggestedTopics.select():
-        title = topic.title
-        keyboard.append([InlineKeyboardButton(
-            text=title, callback_data=str(topic.uid))])
-
     update.message.reply_text(
         'Вы можете удалить тему нажатием на кнопку с соответствующим названием\n' +
         'Осторожно, тема будет удалена навсегда! Вы можете внести пользователя в ' +
         'черный список в config.yaml.',
-        reply_markup=InlineKeyboardMarkup(
-            inline_keyboard=keyboard +
-            [[InlineKeyboardButton(text='Закончить', callback_data='STOP')]]))
+        reply_markup=markup)
+    return DELETE
+
+
+@isAdmin
+def delete_page(update, context):
+    query = update.callback_query
+    query.answer()
+    markup = _delete_page(*_page_cursor(query.data))
+    if markup is None:
+        query.edit_message_text('В настоящее время тем нет')
+        return ConversationHandler.END
+
+    query.edit_message_reply_markup(reply_markup=markup)
     return DELETE
 
 
@@ -135,111 +222,368 @@ def delete_topic(update, context):
             'Вероятно, тема уже удалена, попробуйте снова.')
         return ConversationHandler.END
 
-    with db.atomic():
+    with write_transaction():
         Votes.delete().where(Votes.topic == topic).execute()
         topic.delete_instance()
+    duplicates.remove(topic.uid)
+    topic_index.remove(topic.uid)
+    tally.load()
+    _topics_changed()
 
     query.edit_message_text('Тема удалена.')
     return ConversationHandler.END
 
 
+@isAdmin
+def recount(update, context):
+    broken = _check_vote_counters()
+    if len(broken) == 0:
+        update.message.reply_text('Счетчики голосов в порядке.')
+        return
+
+    with write_transaction():
+        _rebuild_vote_counters()
+    topic_index.load_votes()
+    tally.load()
+    _send_message(update, f'Пересчитаны счетчики голосов для {len(broken)} тем:\n' +
+                  '\n'.join(f'{html.escape(topic.title)}: {topic.stored} → {topic.actual}'
+                             for topic in broken))
+
+
+@isAdmin
+def reindex(update, context):
+    if not search_supported():
+        update.message.reply_text('Поиск доступен только с SQLite.')
+        return
+
+    with write_transaction():
+        topics, elapsed = rebuild_search_index()
+    update.message.reply_text(f'Поисковый индекс перестроен: {topics} тем за {elapsed:.2f} с')
+
+
+def _share(part, total):
+    return f'{part / total:.0%}' if total else '–'
+
+
+def _episode_line(row):
+    return (f'№{row.episode}: {row.topics} тем, {row.votes} голосов, ' +
+            f'{row.votes / max(row.topics, 1):.1f} на тему, ' +
+            f'тем с голосами {_share(row.voted, row.topics)}')
+
+
+def _proposer_lines(rows):
+    return [f'{i}. {html.escape(row.username)}: голосов {row.votes}, тем {row.topics}, ' +
+            f'у лучшей темы {row.best}' for i, row in enumerate(rows, start=1)]
+
+
+def _episode_stats(episode):
+    row = episode_stats(episode)
+    if row is None:
+        return f'Выпуска №{episode} нет в архиве.'
+    archived = (f'архивирован {datetime.utcfromtimestamp(row.archived):%d.%m.%Y}'
+                if row.archived is not None else 'дата архивации неизвестна')
+    return '\n'.join([f'<b>Выпуск №{episode}</b>, {archived}',
+                      f'Тем: {row.topics} от {row.proposers} авторов, голосов: {row.votes} ' +
+                      f'({row.votes / max(row.topics, 1):.1f} на тему)',
+                      f'Тем с голосами: {_share(row.voted, row.topics)}, больше всего ' +
+                      f'голосов у одной темы: {row.best}',
+                      'Лучшие темы:'] +
+                     [f'{topic.votes} – {html.escape(topic.title)}'
+                      for topic in best_topics(episode)])
+
+
+# Everything comes from the aggregates of stats.py, a few rows each
+@isAdmin
+def stats(update, context):
+    if context.args:
+        if not context.args[0].isdigit():
+            update.message.reply_text('Используйте /stats или /stats номер_выпуска')
+            return
+        _send_message(update, _episode_stats(int(context.args[0])))
+        return
+
+    total = year_stats(ALL_TIME)
+    if total is None:
+        update.message.reply_text('Архив пока пуст.')
+        return
+
+    lines = [f'<b>За все время</b>: {total.episodes} выпусков, {total.topics} тем ' +
+             f'от {total.proposers} авторов, {total.votes} голосов, ' +
+             f'тем с голосами {_share(total.voted, total.topics)}']
+    years = stats_years()
+    if years:
+        lines.append('\n<b>По годам</b>')
+        lines += [f'{row.year}: {row.episodes} выпусков, ' +
+                  f'{row.topics / max(row.episodes, 1):.1f} тем и ' +
+                  f'{row.votes / max(row.episodes, 1):.0f} голосов на выпуск, ' +
+                  f'тем с голосами {_share(row.voted, row.topics)}' for row in years]
+    lines.append('\n<b>Последние выпуски</b>')
+    lines += [_episode_line(row) for row in recent_episodes()]
+    if years:
+        lines.append(f'\n<b>Самые популярные авторы за {years[0].year} год</b>')
+        lines += _proposer_lines(top_proposers(years[0].year))
+    lines.append('\n<b>Самые популярные авторы за все время</b>')
+    lines += _proposer_lines(top_proposers(ALL_TIME))
+    _send_message(update, '\n'.join(lines))
+
+
+@isAdmin
+def restats(update, context):
+    with write_transaction():
+        episodes, elapsed = rebuild_stats()
+    update.message.reply_text(f'Статистика архива пересчитана: {episodes} выпусков ' +
+                              f'за {elapsed:.2f} с')
+
+
+# The document is written as the rows are read, see export.py. python-telegram-bot
+# reads it into memory to upload, at most MAX_DOCUMENT_SIZE. On asyncio the
+# upload is queued with the content, the file is closed right after
+@isAdmin
+def export(update, context):
+    args = list(context.args)
+    format = args.pop().lower() if args and args[-1].lower() in FORMATS else 'csv'
+    if len(args) > 2 or not all(arg.isdigit() for arg in args):
+        update.message.reply_text('Используйте /export [с_выпуска] [по_выпуск] [csv|json]')
+        return
+    first = int(args[0]) if args else None
+    last = int(args[-1]) if args else None
+
+    update.message.reply_chat_action(telegram.ChatAction.UPLOAD_DOCUMENT)
+    document, count, size = export_topics(topic_rows(first, last), format)
+    with document:
+        if count == 0:
+            update.message.reply_text('Тем для выгрузки нет.')
+            return
+        if size > MAX_DOCUMENT_SIZE:
+            update.message.reply_text(f'Файл получился слишком большим ({size >> 20} МБ), ' +
+                                      'выберите меньше выпусков.')
+            return
+        update.message.reply_document(document, filename=export_filename(first, last, format),
+                                      caption=f'Тем: {count}', timeout=UPLOAD_TIMEOUT)
+
+
+# Returns the text and the keyboard of a page of search results, the buttons
+# are search_<id of the terms>_<offset>
+def _search_page(search_id, terms, offset):
+    hits, more = search_topics(terms, offset, SEARCH_PAGE_SIZE)
+    if len(hits) == 0:
+        return f'По запросу «{html.escape(terms)}» ничего не найдено.', None
+
+    lines = [f'Результаты поиска «{html.escape(terms)}»:']
+    for number, hit in enumerate(hits, start=offset + 1):
+        where = f'выпуск №{hit["episode"]}' if hit['episode'] is not None else 'текущие темы'
+        lines.append(f'{number}. <b>{html.escape(hit["title"])}</b> ' +
+                     f'(<i>{where}</i>, голосов: {hit["votes"]})\n{hit["snippet"]}')
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(
+            text='⬅️ Назад',
+            callback_data=f'search_{search_id}_{max(0, offset - SEARCH_PAGE_SIZE)}'))
+    if more:
+        buttons.append(InlineKeyboardButton(
+            text='Дальше ➡️', callback_data=f'search_{search_id}_{offset + SEARCH_PAGE_SIZE}'))
+    return '\n\n'.join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def search(update, context):
+    if not search_supported():
+        update.message.reply_text('Поиск доступен только с SQLite.')
+        return
+
+    terms = ' '.join(context.args)
+    if terms.strip() == '':
+        update.message.reply_text('Введите, что искать, например: /search базы данных')
+        return
+
+    # Pages are requested with buttons, which have room for the id of the terms only
+    text, markup = _search_page(save_search(terms), terms, 0)
+    update.message.reply_text(text, parse_mode=telegram.ParseMode.HTML, reply_markup=markup)
+
+
+def search_page(update, context):
+    query = update.callback_query
+    query.answer()
+    parts = query.data.split('_')
+    terms = saved_search(int(parts[1])) if len(parts) == 3 else None
+    if terms is None:
+        # A button of an older version with the offset only, or the terms are forgotten
+        query.edit_message_text('Поиск устарел, повторите его с /search')
+        return
+
+    text, markup = _search_page(int(parts[1]), terms, int(parts[2]))
+    query.edit_message_text(text, parse_mode=telegram.ParseMode.HTML, reply_markup=markup)
+
+
+# Returns the text and the keyboard of a page of /list, the text is empty if
+# there are no topics
+def _list_page(after=None, before=None):
+    rows, has_prev, has_next = tally.page(PAGE_SIZE, after, before)
+    ranked = {row[0]: row for row in rows}
+    topics = render_cache.topics([uid for uid, _, _ in rows])
+    if len(topics) == 0:
+        return _list_page() if after is not None or before is not None else ('', None)
+
+    buttons = [topic.more for topic in topics if topic.more is not None] + \
+        _page_buttons('list', tally.cursor(ranked[topics[0].uid]),
+                      tally.cursor(ranked[topics[-1].uid]), has_prev, has_next)
+    return ('\n\n'.join(_format_votes(*ranked[topic.uid][1:]) + topic.html for topic in topics),
+            InlineKeyboardMarkup(buttons) if len(buttons) > 0 else None)
+
+
+# Every live topic with its whole body in the order of /list, packed into
+# messages: /archive shows all of them before they can't be changed any more
+def _review_messages():
+    rows, cursor = [], None
+    while True:
+        page, _, has_next = tally.page(PAGE_SIZE, after=cursor)
+        rows.extend(page)
+        if not has_next or len(page) == 0:
+            break
+        cursor = tally.cursor(page[-1])
+    topics = {topic.uid: topic for topic in SuggestedTopics.select().where(
+        SuggestedTopics.uid.in_([uid for uid, _, _ in rows]))}
+    return _pack_messages([_format_votes(votes, place) + _format_topic(
+        topics[uid].title, topics[uid].username, topics[uid].body)
+        for uid, votes, place in rows if uid in topics])
+
+
+# The 📖 button of a topic whose body is cut in the pages
+def show_topic(update, context):
+    query = update.callback_query
+    query.answer()
+    topic = SuggestedTopics.get_or_none(SuggestedTopics.uid == int(query.data.split('_')[1]))
+    if topic is None:
+        query.message.reply_text('Эта тема уже удалена или заархивирована.')
+        return
+    _send_message(context.bot, _format_topic(topic.title, topic.username, topic.body),
+                  chat_id=query.message.chat_id)
+
+
 def list_topics(update, context):
     # if the argument us present, user wants to get the list of topics assosiated
     # with the exact episode
     if len(context.args) == 1:
-        topics = ArchivedTopics.select().where(
-            ArchivedTopics.episode == context.args[0]).order_by(
-            ArchivedTopics.votes.desc())
+        messages = render_cache.episode(int(context.args[0])) \
+            if context.args[0].isdigit() else []
     else:
-        topics = _get_sorted_topics_with_votes()
-
-    if len(topics) == 0:
+        text, markup = _list_page()
+        if text != '':
+            update.message.reply_text(text, parse_mode=telegram.ParseMode.HTML,
+                                      reply_markup=markup)
+            return
+        messages = []
+
+    if len(messages) == 0:
         update.message.reply_text(
             'К сожалению, пока никто не предложил тем, ' +
             'либо введен неверный номер выпуска.')
 
-    for topic in topics:
-        _send_message(update, _format_topic(
-            topic.title, topic.username, topic.body, votes=topic.votes))
+    for message in messages:
+        _send_message(update, message)
+
+
+def list_page(update, context):
+    query = update.callback_query
+    query.answer()
+    text, markup = _list_page(*_page_cursor(query.data, str))
+    if text == '':
+        query.edit_message_text('К сожалению, пока никто не предложил тем.')
+        return
+
+    query.edit_message_text(text, parse_mode=telegram.ParseMode.HTML, reply_markup=markup)
+
+
+# Returns the text and the keyboard of a page of the ballot, the text is empty
+# if there are no topics
+def _ballot_page(user_id, after=None, before=None):
+    uids, has_prev, has_next = _topic_page(PAGE_SIZE, after, before)
+    topics = render_cache.topics(uids)
+    if len(topics) == 0:
+        return _ballot_page(user_id) if after is not None or before is not None else ('', None)
+
+    # Mark themes that already have votes from the current user
+    voted = _get_voted_topic_uids(user_id, uids)
+    return ('\n\n'.join(topic.html for topic in topics),
+            InlineKeyboardMarkup(
+                inline_keyboard=[topic.checked if topic.uid in voted else topic.button
+                                 for topic in topics] +
+                _page_buttons('vote', topics[0].uid, topics[-1].uid, has_prev, has_next) +
+                [[InlineKeyboardButton(text='Закончить', callback_data='STOP')]]))
 
 
 def start_vote(update, context):
+    text, markup = _ballot_page(update.message.from_user.id)
+
     # if there are no topics yet.
-    if SuggestedTopics.select().count() == 0:
+    if text == '':
         update.message.reply_text('К сожалению, пока никто не предложил тем.')
         return ConversationHandler.END
 
     update.message.reply_text(
         'Спасибо за то, что голосуете за темы!\nСедует помнить, ' +
-        'что список тем может обновляться до выпуска. Текущий список тем:\n')
-
-    keyboard = []
+        'что список тем может обновляться до выпуска.\n' +
+        'Вы можете проголосовать за тему нажатием на кнопку с соответствующим названием. ' +
+        'Темы, за которые вы уже проголосовали, отмечены знаком ✅\n' +
+        'Вы можете отозвать свой голос нажав на уже проголосованную тему. ' +
+        ('Порядок важен: сначала голосуйте за самые интересные вам темы. '
+         if tally.method != 'count' else '') +
+        f'Темы показаны по {PAGE_SIZE}, остальные – на следующих страницах.')
 
-    for topic in SuggestedTopics.select():
-        _send_message(update, _format_topic(
-            topic.title, topic.username, topic.body))
-        title = topic.title
+    update.message.reply_text(text, parse_mode=telegram.ParseMode.HTML, reply_markup=markup)
+    return VOTE
 
-        # Mark themes that already have votes from the current user
-        if Votes.select().where(
-                (Votes.user == update.message.from_user.id) &
-                (Votes.topic == topic)).count() > 0:
-            title = '✅ ' + title
 
-        keyboard.append([InlineKeyboardButton(
-            text=title, callback_data=str(topic.uid))])
+def vote_page(update, context):
+    query = update.callback_query
+    query.answer()
+    # A pending keyboard edit belongs to the page we are leaving
+    keyboard_edits.cancel(query.message.chat_id, query.message.message_id)
+    text, markup = _ballot_page(query.from_user.id, *_page_cursor(query.data))
+    if text == '':
+        query.edit_message_text('К сожалению, пока никто не предложил тем.')
+        return ConversationHandler.END
 
-    update.message.reply_text(
-        'Вы можете проголосовать за тему нажатием на кнопку с соответствующим названием. ' +
-        'Темы, за которые вы уже проголосовали, отмечены знаком ✅\n' +
-        'Вы можете отозвать свой голос нажав на уже проголосованную тему.',
-        reply_markup=InlineKeyboardMarkup(
-            inline_keyboard=keyboard +
-            [[InlineKeyboardButton(text='Закончить', callback_data='STOP')]]))
+    query.edit_message_text(text, parse_mode=telegram.ParseMode.HTML, reply_markup=markup)
     return VOTE
 
 
 def vote(update, context):
     query = update.callback_query
     query.answer()
-    topic = None
+    chat_id, message_id = query.message.chat_id, query.message.message_id
 
-    try:
-        topic = SuggestedTopics.get(uid=query.data)
-    except:
+    # The same tap might be delivered twice, it must not toggle the vote back
+    if handled_callbacks.seen(query.id):
+        return VOTE
+
+    voted = _toggle_vote(query.from_user.id, int(query.data))
+    if voted is None:
         # Might happen when user requested /vote before /archive but voted after
+        keyboard_edits.cancel(chat_id, message_id)
         query.edit_message_text(
             'Данное голосование уже закончено или тема удалена, попробуйте снова.')
         return ConversationHandler.END
-
-    # We should update the pressed button text. Let's find the corresponding button
-    t = next(filter(lambda x: x[0]['callback_data'] == query.data,
-                    query.message.reply_markup.inline_keyboard))[0]
-    with db.atomic():
-        # if user has already voted for this topic
-        if Votes.select().where(
-                (Votes.user == query.from_user.id) &
-                (Votes.topic == topic)).count() > 0:
-            Votes.delete().where((Votes.user == query.from_user.id) &
-                                 (Votes.topic == topic)).execute()
-            # There might be a little race here, but it's ok, isn't it? (:
-            # It doesn't affect any business logic after all
-            t.text = t.text[2:]
-        else:
-            Votes.create(user=query.from_user.id, topic=topic)
-            t.text = '✅ ' + t.text
-
-    query.edit_message_text(
-        'Вы можете проголосовать за тему нажатием на кнопку с соответствующим названием. ' +
-        'Темы, за которые вы уже проголосовали, отмечены знаком ✅\n' +
-        'Вы можете отозвать свой голос нажав на уже проголосованную тему.',
-        reply_markup=query.message.reply_markup)
+    topic_index.vote(int(query.data), 1 if voted else -1)
+    tally.vote(query.from_user.id, int(query.data), voted)
+
+    # We should update the pressed button text. Previous taps might not have been
+    # sent to Telegram yet, so start from the keyboard we are going to show
+    markup = keyboard_edits.current(chat_id, message_id, query.message.reply_markup)
+    for row in markup.inline_keyboard:
+        for button in row:
+            if button.callback_data == query.data:
+                title = button.text[2:] if button.text.startswith('✅ ') else button.text
+                button.text = '✅ ' + title if voted else title
+
+    keyboard_edits.push(context.bot, chat_id, message_id, markup, query.message.reply_markup)
     return VOTE
 
 
 def stop_vote(update, context):
     query = update.callback_query
     query.answer()
+    keyboard_edits.cancel(query.message.chat_id, query.message.message_id)
     query.edit_message_text('Спасибо!')
     return ConversationHandler.END
 
@@ -254,10 +598,16 @@ def start_propose(update, context):
         'Спасибо за то, что предлагаете нам темы! ' +
         'Пожалуйста, введите короткий заголовок темы (максимум 140 символов)\n' +
         'Если вы нажали на кнопку случайно –– не волнуйтесь, это можно будет отменить на последнем шаге.')
-    state[update.message.from_user.id] = {}
+    drafts.start(update.message.from_user.id)
     return TITLE
 
 
+def _draft_expired(update):
+    update.effective_message.reply_text(
+        'К сожалению, черновик темы устарел. Пожалуйста, начните заново с /propose')
+    return ConversationHandler.END
+
+
 def add_title(update, context):
     title = update.message.text
 
@@ -266,27 +616,39 @@ def add_title(update, context):
             'Заголовок темы слишком длинный. Пожалуйста, придумайте короткое предложение, ' +
             'характеризующее тему, чтобы слушателям было удобнее голосовать.\nПопробуйте снова.')
         return TITLE
+    elif not drafts.update(update.message.from_user.id, title=title):
+        return _draft_expired(update)
     else:
-        state[update.message.from_user.id]['title'] = title
         update.message.reply_text(
             'Спасибо! Теперь введите тело новости. Пожалуйста, избегайте излишне длинного текста.')
         return BODY
 
 
 def add_body(update, context):
-    state[update.message.from_user.id]['username'] = update.message.from_user.username \
+    username = update.message.from_user.username \
         if update.message.from_user.username != '' else \
         update.message.from_user.first_name + " " + update.message.from_user.last_name
 
-    state[update.message.from_user.id]['body'] = update.message.text
+    if not drafts.update(update.message.from_user.id,
+                         username=username, body=update.message.text):
+        return _draft_expired(update)
+    draft = drafts.get(update.message.from_user.id)
 
-    text = _format_topic(state[update.message.from_user.id]['title'],
-                         state[update.message.from_user.id]['username'],
-                         state[update.message.from_user.id]['body'])
+    text = _format_topic(draft['title'], draft['username'], draft['body'])
 
     _send_message(update, text)
-    update.message.reply_text(
-        'Спасибо! Тема выглядит так, как вы ожидали?',
+
+    similar = duplicates.similar(draft['title'], draft['body'])
+    if len(similar) > 0:
+        _send_message(update, 'Возможно, такую тему уже предлагали:\n' + '\n'.join(
+            f'• {html.escape(title)} ' +
+            (f'(выпуск №{episode}' if episode is not None else '(текущие темы') +
+            f', совпадение {similarity:.0%})'
+            for similarity, title, episode in similar))
+
+    # After the queued topic
+    _send_message(
+        update, 'Спасибо! Тема выглядит так, как вы ожидали?',
         reply_markup=InlineKeyboardMarkup(
             inline_keyboard=[
                 [InlineKeyboardButton(text=value, callback_data=str(i))
@@ -298,40 +660,62 @@ def add_body(update, context):
 def confirm_topic(update, context):
     query = update.callback_query
     query.answer()
-    if query.data == '0':
+    draft = drafts.get(query.from_user.id)
+    if draft is None:
+        query.edit_message_text(
+            'К сожалению, черновик темы устарел. Пожалуйста, начните заново с /propose')
+    elif query.data == '0':
+        uid = _topic_uid(draft['title'], draft['body'])
         try:
-            with db.atomic():
+            with write_transaction():
                 SuggestedTopics.create(
-                    uid=hash(state[query.from_user.id]['title'] +
-                             state[query.from_user.id]['body']),
+                    uid=uid,
                     user=query.from_user.id,
-                    username=state[query.from_user.id]['username'],
-                    title=state[query.from_user.id]['title'],
-                    body=state[query.from_user.id]['body'])
+                    username=draft['username'],
+                    title=draft['title'],
+                    body=draft['body'])
+            duplicates.add(uid, draft['title'], draft['body'])
+            topic_index.add(uid, draft['title'], draft['body'], draft['username'])
+            tally.add(uid)
+            _topics_changed()
             query.edit_message_text('Ваша тема принята, спасибо.')
         except IntegrityError:
             query.edit_message_text(
                 'Тема с таким заголовком и текстом уже существует.')
-
-        del state[query.from_user.id]
     else:
-        state[query.from_user.id] = {}
         query.edit_message_text('Попробуйте снова.')
 
+    drafts.discard(query.from_user.id)
     return ConversationHandler.END
 
 
 def cancel(update, context):
-    if update.message.from_user.id in state:
-        del state[update.message.from_user.id]
+    drafts.discard(update.message.from_user.id)
 
     update.message.reply_text('Ввод отменен',
                               reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
+def evict_drafts(context):
+    drafts.evict_expired()
+    logger.info('Drafts: %s', drafts.metrics())
+
+
+# @bot words in any chat. Answered from memory, the handler doesn't get a
+# database connection
+def inline_query(update, context):
+    query = update.inline_query
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    topics, next_offset = topic_index.search(query.query, offset)
+    # The results are the same for everyone, Telegram may reuse them
+    query.answer([article(key, topic) for key, topic in topics],
+                 cache_time=config['inline']['cacheTime'], is_personal=False,
+                 next_offset='' if next_offset is None else str(next_offset))
+
+
 def unsubscribe(update, context):
-    with db.atomic():
+    with write_transaction():
         SubscibedUsers.delete().where(SubscibedUsers.user ==
                                       update.message.from_user.id).execute()
     update.message.reply_text('Вы успешно отписаны от уведомлений. Однако, ' +
@@ -339,15 +723,77 @@ def unsubscribe(update, context):
                               'Для информации используйте /help')
 
 
+NOTIFY_MESSAGE = ('Время проголосовать за новости. Используйте /vote для голосования\n' +
+                  'Если вы хотите отписаться от напоминаний, используйте /unsubscribe')
+
+
+# The reminder is planned into the outbox once a day at most, every subscriber
+# gets it once even if the bot is restarted halfway (see outbox.py)
+def _plan_reminder():
+    return plan_broadcast('reminder:' + datetime.utcnow().date().isoformat(), NOTIFY_MESSAGE,
+                          keep=config['broadcast']['keepDays'] * 24 * 60 * 60)
+
+
 def notify_subscribed_users(context):
-    for user in SubscibedUsers.select():
-        _send_message(context.bot,
-                      'Время проголосовать за новости. Используйте /vote для голосования\n' +
-                      'Если вы хотите отписаться от напоминаний, используйте /unsubscribe',
-                      user.user)
-        # The current rate limit is 30 messages per second (see https://core.telegram.org/bots/faq)
-        # We will wate for 50 milliseconds (which makes approx 20 messages per second)
-        sleep(0.05)
+    deliver(context.bot, _plan_reminder(),
+            rate=config['broadcast']['rate'],
+            workers=config['broadcast']['workers'])
+
+
+# Broadcasts whose sender has stopped: a restart, or another instance has died
+def resume_broadcasts(context):
+    for broadcast_id in unfinished_broadcasts():
+        deliver(context.bot, broadcast_id,
+                rate=config['broadcast']['rate'],
+                workers=config['broadcast']['workers'])
+
+
+# The same for the asyncio runtime
+async def notify_subscribed_users_async(runtime):
+    broadcast_id = await runtime.run_sync(withConnection(_plan_reminder))
+    await deliver_async(runtime, broadcast_id,
+                        rate=config['broadcast']['rate'],
+                        workers=config['broadcast']['workers'])
+
+
+async def resume_broadcasts_async(runtime):
+    for broadcast_id in await runtime.run_sync(withConnection(unfinished_broadcasts)):
+        await deliver_async(runtime, broadcast_id,
+                            rate=config['broadcast']['rate'],
+                            workers=config['broadcast']['workers'])
+
+
+def _format_time(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%d.%m %H:%M UTC')
+
+
+@isAdmin
+def broadcasts(update, context):
+    progress = broadcast_progress()
+    if not progress:
+        update.message.reply_text('Рассылок еще не было.')
+        return
+
+    texts = []
+    for row, counts, rate, average in progress:
+        total = sum(counts.values())
+        sent = counts.get('sent', 0)
+        text = (f'<b>{html.escape(row.key)}</b>, начата {_format_time(row.created)}\n' +
+                f'Отправлено {sent} из {total} ({sent / max(total, 1):.0%}), ' +
+                f'в очереди {counts.get("pending", 0) + counts.get("sending", 0)}, ' +
+                f'заблокировали бота {counts.get("blocked", 0)}, ' +
+                f'ошибки {counts.get("failed", 0)}\n' +
+                f'Скорость: {average:.1f} сообщ./с в среднем')
+        if row.finished is not None:
+            text += f'\nЗавершена {_format_time(row.finished)}'
+        elif rate > 0:
+            minutes = counts.get('pending', 0) / rate / 60
+            text += (f', {rate:.1f} сообщ./с за последнюю минуту, осталось ' +
+                     (f'примерно {minutes:.0f} мин.' if minutes >= 1 else 'меньше минуты'))
+        else:
+            text += '\nСейчас не отправляется, продолжится в течение нескольких минут'
+        texts.append(text)
+    _send_message(update, '\n\n'.join(texts))
 
 
 def start(update, context):
@@ -364,7 +810,7 @@ def start(update, context):
     if SubscibedUsers.select().where(SubscibedUsers.user == userId).count() > 0:
         return
     else:
-        with db.atomic():
+        with write_transaction():
             SubscibedUsers.create(user=userId)
 
 
@@ -382,25 +828,119 @@ def error(update, context):
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 
-# Start the bot.
-def main():
-    global config
-    config = _parse_config()
-    if config is None:
-        logger.critical('Configuration error. Shutting down')
-        return
+# Shared state of the handlers, returns the persistence for the conversations
+def _create_state():
+    global drafts, duplicates, topic_index, tally, render_cache, flood_guard, instance, \
+        topics_version
+    shared = config['cluster']['enabled']
+    drafts = DraftStore(max_size=config['drafts']['maxSize'],
+                        ttl=config['drafts']['ttl'],
+                        persistent=config['drafts']['persistent'],
+                        shared=shared)
+    withConnection(drafts.load)()
+
+    duplicates = DuplicateIndex(threshold=config['duplicates']['threshold'],
+                                archived_episodes=config['duplicates']['archivedEpisodes'])
+    withConnection(duplicates.load)()
+
+    topic_index = TopicIndex(enabled=config['inline']['enabled'],
+                             archived_episodes=config['inline']['archivedEpisodes'])
+    withConnection(topic_index.load)()
+
+    tally = create_tally(config['tally']['method'])
+    withConnection(tally.load)()
+
+    render_cache = RenderCache(enabled=config['render']['cache'],
+                               max_episodes=config['render']['episodes'])
+
+    flood = config['flood']
+    flood_guard = FloodGuard({name: (flood[name]['rate'], flood[name]['burst'])
+                              for name in ('list', 'vote', 'inline', 'default')},
+                             admins=config['adminIds'],
+                             max_users=flood['users'],
+                             repeat_window=flood['repeatWindow'],
+                             overload=flood['overload'])
+
+    # Every instance can get the next update of any conversation
+    if shared:
+        instance = instance_name()
+        topics_version = SharedVersion('topics', _reload_topics)
+        withConnection(topics_version.check)()
+        logger.info('Running as %s', instance)
+        return DatabasePersistence()
+
+    # Drafts are kept in the database, but the conversation state (which step of
+    # /propose the user is at) has to survive restarts as well
+    if config['drafts']['persistent']:
+        return PicklePersistence(config['drafts']['conversationsFile'],
+                                 store_user_data=False,
+                                 store_chat_data=False,
+                                 store_bot_data=False)
+    return None
+
+
+# Create the updater with all the handlers and jobs registered.
+# Keyword arguments are passed to Updater (e.g. base_url for a local API stub)
+def create_updater(**kwargs):
+    global message_queue
+    updater = Updater(config['botApiToken'], persistence=_create_state(),
+                      workers=config['server']['workers'], **kwargs)
+    # The asyncio runtime sends everything in the background already
+    outgoing = config['outgoing']
+    if outgoing['enabled']:
+        message_queue = MessageQueue(rate=outgoing['rate'],
+                                     chat_interval=outgoing['chatInterval'],
+                                     group_interval=outgoing['groupInterval'],
+                                     workers=outgoing['workers'],
+                                     max_queued=outgoing['maxQueued']).start()
+        _set_message_queue(message_queue)
+    _add_handlers(updater.dispatcher)
+    _add_jobs(updater.job_queue, notify_subscribed_users, resume_broadcasts)
+    if config['metrics']['enabled']:
+        instrument_bot(updater.bot)
+    return updater
+
+
+# The same handlers and jobs on the asyncio runtime.
+# Keyword arguments are passed to AsyncRuntime
+def create_runtime(**kwargs):
+    runtime = AsyncRuntime(config['botApiToken'], persistence=_create_state(),
+                           workers=config['server']['workers'], **kwargs)
+    _add_handlers(runtime.dispatcher)
+
+    # The jobs only hand the broadcasts over to the event loop
+    def notify(context):
+        runtime.run_coroutine(notify_subscribed_users_async(runtime))
+
+    def resume(context):
+        runtime.run_coroutine(resume_broadcasts_async(runtime))
+    _add_jobs(runtime.job_queue, notify, resume)
+    return runtime
+
+
+def _add_handlers(dp):
+    shared = config['cluster']['enabled']
+    # Before the conversations, their callback handlers only take their own buttons
+    dp.add_handler(CallbackQueryHandler(search_page, pattern=r'^search_\d+(_\d+)?$',
+                                        run_async=True))
+    dp.add_handler(CallbackQueryHandler(show_topic, pattern=r'^topic_-?\d+$', run_async=True))
+    dp.add_handler(CallbackQueryHandler(list_page, pattern=r'^list_(prev|next)_\d+_-?\d+$',
+                                        run_async=True))
 
-    updater = Updater(config['botApiToken'])
-    # Get the dispatcher to register handlers
-    dp = updater.dispatcher
     suggest_handler = ConversationHandler(
         entry_points=[CommandHandler('propose', start_propose)],
         states={
             TITLE: [MessageHandler(Filters.all, add_title)],
             BODY: [MessageHandler(Filters.all, add_body)],
-            CONFIRMATION: [CallbackQueryHandler(confirm_topic)]
+            # Yes or no, a stale page button of another message mustn't end the draft
+            CONFIRMATION: [CallbackQueryHandler(confirm_topic, pattern='^[01]$')]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='propose',
+        persistent=config['drafts']['persistent'] or shared,
+        # The timeout is a job of the instance that has handled the last update,
+        # with several of them expired drafts are enough
+        conversation_timeout=None if shared else config['drafts']['ttl']
     )
     dp.add_handler(suggest_handler)
 
@@ -409,10 +949,14 @@ def main():
         states={
             VOTE: [
                 CallbackQueryHandler(stop_vote, pattern='^STOP$'),
+                CallbackQueryHandler(vote_page, pattern=r'^vote_(prev|next)_-?\d+$'),
                 CallbackQueryHandler(vote, pattern='^[-]{0,1}\d+$')
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        # Persistence needs a name, the entry point keeps the labels of the metrics
+        name='start_vote',
+        persistent=shared
     )
 
     dp.add_handler(vote_handler)
@@ -422,10 +966,13 @@ def main():
         states={
             DELETE: [
                 CallbackQueryHandler(stop_vote, pattern='^STOP$'),
+                CallbackQueryHandler(delete_page, pattern=r'^delete_(prev|next)_-?\d+$'),
                 CallbackQueryHandler(delete_topic, pattern='^[-]{0,1}\d+$')
             ]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='start_delete',
+        persistent=shared
     )
 
     dp.add_handler(delete_handler)
@@ -437,33 +984,191 @@ def main():
             EPISODE_NUMBER: [MessageHandler(Filters.regex(r'^\d{1,3}$'), set_episode_number)],
             ARCHIVE: [CallbackQueryHandler(confirm_archive)]
         },
-        fallbacks=[CommandHandler('cancel', cancel)]
+        fallbacks=[CommandHandler('cancel', cancel)],
+        name='start_archive',
+        persistent=shared
     )
 
     dp.add_handler(archive_handler)
 
-    dp.add_handler(CommandHandler('start', start))
+    # Commands outside of conversations don't depend on the order of updates,
+    # so they run on the pool of workers instead of the dispatcher thread
+    dp.add_handler(CommandHandler('start', start, run_async=True))
+
+    dp.add_handler(CommandHandler('unsubscribe', unsubscribe, run_async=True))
+
+    dp.add_handler(CommandHandler('list', list_topics, run_async=True))
+
+    dp.add_handler(CommandHandler('recount', recount, run_async=True))
 
-    dp.add_handler(CommandHandler('unsubscribe', unsubscribe))
+    dp.add_handler(CommandHandler('search', search, run_async=True))
 
-    dp.add_handler(CommandHandler('list', list_topics))
+    dp.add_handler(CommandHandler('reindex', reindex, run_async=True))
 
-    job = updater.job_queue.run_daily(notify_subscribed_users,
-                                      time=config['votes']['notifyToVoteOnTime'],
-                                      days=[config['votes']['notifyToVoteOnDay']])
+    dp.add_handler(CommandHandler('broadcasts', broadcasts, run_async=True))
 
-    dp.add_handler(CommandHandler("help", help))
+    dp.add_handler(CommandHandler('stats', stats, run_async=True))
+
+    dp.add_handler(CommandHandler('restats', restats, run_async=True))
+
+    dp.add_handler(CommandHandler('export', export, run_async=True))
+
+    dp.add_handler(CommandHandler("help", help, run_async=True))
 
     # log all errors
     dp.add_error_handler(error)
 
-    # Start the Bot
-    updater.start_polling()
+    _wrap_handlers(dp, withConnection)
+    # Outermost, so that the time includes opening the connection
+    _wrap_handlers(dp, timed)
+
+    # Answered from memory, added after the wrapping so it doesn't open a connection
+    if config['inline']['enabled']:
+        dp.add_handler(InlineQueryHandler(timed(inline_query), run_async=True))
+
+    # Runs before the handlers of group 0 and stops the updates of flooding
+    # users. Added after the wrapping, it doesn't need a database connection
+    if config['flood']['enabled']:
+        dp.add_handler(TypeHandler(Update, flood_guard.check), group=-1)
+
+    if shared:
+        dp.add_handler(TypeHandler(Update, claim_update([topics_version])), group=-2)
+        # Conversations look their states up in the database for every update,
+        # all of it is done on one connection
+        object.__setattr__(dp, 'process_update', withConnection(dp.process_update))
+
+    if config['metrics']['enabled']:
+        REGISTRY.register(conversation_gauge(dp))
+
+
+def _add_jobs(job_queue, notify, resume):
+    if config['cluster']['enabled']:
+        # Every instance has the same schedule, one of them sends the reminder
+        notify = run_once(notify, 'notify_subscribed_users', instance, hold=60 * 60)
+        job_queue.run_repeating(timed(withConnection(forget_handled_updates)),
+                                interval=60 * 60)
+        # Votes of the other instances, about as old as Telegram may keep the answers
+        if config['inline']['enabled']:
+            job_queue.run_repeating(timed(withConnection(topic_index.load_votes)),
+                                    interval=config['inline']['cacheTime'])
+        if tally.method != 'count':
+            job_queue.run_repeating(timed(withConnection(tally.load)),
+                                    interval=config['tally']['reload'])
+    job_queue.run_daily(timed(withConnection(notify)),
+                        time=config['votes']['notifyToVoteOnTime'],
+                        days=[config['votes']['notifyToVoteOnDay']])
+
+    job_queue.run_repeating(timed(withConnection(evict_drafts)), interval=60 * 60)
+    job_queue.run_repeating(timed(withConnection(forget_searches)), interval=24 * 60 * 60)
+    if backups is not None:
+        backup = backups.run
+        if config['cluster']['enabled']:
+            # The instances share the database file, one of them backs it up
+            backup = withConnection(run_once(backup, 'backup', instance,
+                                             hold=config['backup']['interval'] // 2))
+        job_queue.run_repeating(timed(backup), interval=config['backup']['interval'],
+                                first=backups.first())
+    # A resumed broadcast keeps its run going for a while, the next one only
+    # finds out that the broadcast is taken instead of being skipped with a warning
+    job_queue.run_repeating(timed(withConnection(resume)), interval=60, first=10,
+                            job_kwargs={'max_instances': 2})
+
+
+# Topics were proposed, deleted or archived
+def _topics_changed():
+    render_cache.invalidate()
+    if topics_version is not None:
+        topics_version.bump()
+
+
+# Another instance has changed the topics. The index takes a while to load,
+# until then it finds less
+def _reload_topics():
+    render_cache.invalidate()
+    threading.Thread(target=withConnection(duplicates.load), daemon=True).start()
+    threading.Thread(target=withConnection(topic_index.load), daemon=True).start()
+    threading.Thread(target=withConnection(tally.load), daemon=True).start()
+
+
+# Start the bot.
+def main():
+    global config, backups
+    config = _parse_config()
+    if config is None:
+        logger.critical('Configuration error. Shutting down')
+        return
+    database = init_database(config['storage'])
+    storage = {**STORAGE_DEFAULTS, **config['storage']}
+    if config['backup']['enabled'] and storage['backend'] == 'sqlite':
+        settings = config['backup']
+        backups = Backups(storage['path'], settings['directory'], interval=settings['interval'],
+                          keep=settings['keep'], pages=settings['pages'], pause=settings['pause'],
+                          compress_level=settings['compressLevel'])
+
+    if config['metrics']['enabled']:
+        instrument_database(database)
+        REGISTRY.register(Gauge('devzen_drafts', 'Unfinished /propose topics', (),
+                                lambda: {(): len(drafts)}))
+        REGISTRY.register(CallbackCounter('devzen_drafts_evicted_total',
+                                          'Drafts dropped from the store', ('reason',),
+                                          lambda: {('lru',): drafts.evicted_lru,
+                                                   ('ttl',): drafts.evicted_ttl}))
+        REGISTRY.register(CallbackCounter('devzen_render_cache_total',
+                                          'Lookups of rendered topics and ballots', ('result',),
+                                          lambda: {('hit',): render_cache.hits,
+                                                   ('miss',): render_cache.misses}))
+        REGISTRY.register(CallbackCounter('devzen_keyboard_edits_total', 'Vote keyboard edits',
+                                          ('result',),
+                                          lambda: {('requested',): keyboard_edits.requested,
+                                                   ('sent',): keyboard_edits.sent}))
+        REGISTRY.register(Gauge('devzen_flood_load', 'Updates per second seen by flood control',
+                                (), lambda: {(): flood_guard.load}))
+        REGISTRY.register(Gauge('devzen_outgoing_messages', 'Messages of the outgoing queue',
+                                ('state',),
+                                lambda: {(state,): count for state, count in (
+                                    message_queue.metrics().items()
+                                    if message_queue is not None else ())}))
+        REGISTRY.register(Gauge('devzen_backup', 'The last backup of the database: when it ' +
+                                'was taken, its size and seconds, failed backups', ('stat',),
+                                lambda: {(stat,): value for stat, value in (
+                                    backups.metrics().items() if backups is not None else ())}))
+        start_server(config['metrics']['listen'], config['metrics']['port'])
+
+    server = config['server']
+    if server['mode'] == 'webhook':
+        # Telegram is the only one who knows the secret part of the path
+        url_path = server['urlPath'].strip('/')
+        if server['secretToken']:
+            url_path += '/' + server['secretToken']
+        webhook = {'listen': server['listen'],
+                   'port': server['port'],
+                   'url_path': url_path,
+                   'webhook_url': server['webhookUrl'].rstrip('/') + '/' + url_path,
+                   'max_connections': server['maxConnections']}
+
+    if server['runtime'] == 'asyncio':
+        # Stops on Ctrl-C, SIGTERM or SIGABRT the same way as updater.idle()
+        if server['mode'] == 'webhook':
+            create_runtime().run('webhook', **webhook)
+        else:
+            create_runtime().run('polling')
+        return
+
+    updater = create_updater()
+    if server['mode'] == 'webhook':
+        updater.start_webhook(**webhook)
+    else:
+        updater.start_polling()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
+    # start_polling() is non-blocking and will stop the bot gracefully:
+    # it stops receiving updates first, then the dispatcher handles everything
+    # already queued and waits for the workers to finish
     updater.idle()
+    # Then the last replies go out
+    if message_queue is not None:
+        message_queue.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,138 @@
+import threading
+from collections import OrderedDict
+from time import time
+from peewee import EXCLUDED
+from models import Drafts, write_transaction
+
+FIELDS = ('title', 'body', 'username')
+
+
+# Half-finished /propose topics keyed by user id. Keeps at most max_size drafts,
+# evicting the least recently used one, and forgets drafts that haven't been
+# touched for ttl seconds. When persistent, every change is also written to the
+# Drafts table and the drafts are loaded back on start. When shared (several
+# instances of the bot, see cluster.py), drafts are always read from the table.
+# The lock only guards the dict: the table is written after it is released, so
+# that a slow write doesn't hold up the drafts of every other user
+class DraftStore:
+    def __init__(self, max_size=10000, ttl=24 * 60 * 60, persistent=False, shared=False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.persistent = persistent or shared
+        self.shared = shared
+        self.evicted_lru = 0
+        self.evicted_ttl = 0
+        self._drafts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.persistent:
+            return
+        rows = list(Drafts.select().where(Drafts.updated > time() - self.ttl).order_by(
+            Drafts.updated.desc()).limit(self.max_size))
+        with self._lock:
+            self._drafts.clear()
+            for row in reversed(rows):
+                self._drafts[row.user] = ({field: getattr(row, field) for field in FIELDS
+                                           if getattr(row, field) is not None}, row.updated)
+        self.evict_expired()
+
+    def start(self, user_id):
+        self._put(user_id, {})
+
+    def get(self, user_id):
+        if self.shared:
+            return self._get_shared(user_id)
+        with self._lock:
+            if user_id not in self._drafts:
+                return None
+            draft, updated = self._drafts[user_id]
+            if updated >= time() - self.ttl:
+                self._drafts.move_to_end(user_id)
+                return dict(draft)
+            del self._drafts[user_id]
+            self.evicted_ttl += 1
+        self._delete([user_id])
+        return None
+
+    # Returns False if there is no such draft (expired or evicted)
+    def update(self, user_id, **fields):
+        draft = self.get(user_id)
+        if draft is None:
+            return False
+        draft.update(fields)
+        self._put(user_id, draft)
+        return True
+
+    def discard(self, user_id):
+        with self._lock:
+            self._drafts.pop(user_id, None)
+        self._delete([user_id])
+
+    def evict_expired(self):
+        deadline = time() - self.ttl
+        with self._lock:
+            # The dict is ordered by last access, so expired drafts are at the beginning
+            while len(self._drafts) > 0:
+                user_id, (_, updated) = next(iter(self._drafts.items()))
+                if updated >= deadline:
+                    break
+                del self._drafts[user_id]
+                self.evicted_ttl += 1
+        if self.persistent:
+            with write_transaction():
+                Drafts.delete().where(Drafts.updated < deadline).execute()
+
+    # Called by the metrics thread, the counters are only changed under the lock
+    def metrics(self):
+        with self._lock:
+            return {'live': len(self._drafts),
+                    'evicted_lru': self.evicted_lru,
+                    'evicted_ttl': self.evicted_ttl}
+
+    def __len__(self):
+        return len(self._drafts)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def _put(self, user_id, draft):
+        updated = time()
+        with self._lock:
+            self._drafts[user_id] = (draft, updated)
+            self._drafts.move_to_end(user_id)
+            evicted = []
+            while len(self._drafts) > self.max_size:
+                evicted.append(self._drafts.popitem(last=False)[0])
+                self.evicted_lru += 1
+        if not self.persistent:
+            return
+        # Two changes of a draft may be written in the other order, the older one
+        # doesn't overwrite the newer
+        with write_transaction():
+            Drafts.insert(user=user_id, updated=updated,
+                          **{field: draft.get(field) for field in FIELDS}).on_conflict(
+                conflict_target=[Drafts.user],
+                preserve=[Drafts.updated] + [getattr(Drafts, field) for field in FIELDS],
+                where=Drafts.updated <= EXCLUDED.updated
+            ).execute()
+            if len(evicted) > 0:
+                Drafts.delete().where(Drafts.user.in_(evicted)).execute()
+
+    # Another instance may have changed the draft, the table is the only copy
+    def _get_shared(self, user_id):
+        row = Drafts.get_or_none(Drafts.user == user_id)
+        if row is None:
+            return None
+        if row.updated < time() - self.ttl:
+            self.discard(user_id)
+            with self._lock:
+                self.evicted_ttl += 1
+            return None
+        return {field: getattr(row, field) for field in FIELDS if getattr(row, field) is not None}
+
+    # Without the lock, after the drafts are gone from the dict
+    def _delete(self, user_ids):
+        if self.persistent:
+            with write_transaction():
+                Drafts.delete().where(Drafts.user.in_(user_ids)).execute()
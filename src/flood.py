@@ -0,0 +1,131 @@
+import re
+import math
+import threading
+from collections import OrderedDict
+from time import monotonic
+from telegram.error import TelegramError
+from telegram.ext import DispatcherHandlerStop
+from helpers import logger
+from metrics import FLOOD_DECISIONS
+
+# /list, /search and their pages send the most, taps on the ballot are cheap
+# and what the bot is for
+_LIST_COMMANDS = {'list', 'search'}
+_VOTE_COMMANDS = {'vote'}
+_LIST_CALLBACK = re.compile(r'^(list|search)_')
+_VOTE_CALLBACK = re.compile(r'^(vote_|STOP$|-?\d+$)')
+
+# Under overload requests are dropped starting from the least important:
+# repeats of the previous request of the user when the load goes over half of
+# the limit, then /list, /search and inline queries, then everything else at
+# twice the limit. Votes and admins are never dropped
+SHED_AT = {'repeat': 0.5, 'list': 1, 'inline': 1, 'default': 2}
+# class: (requests per second, burst)
+LIMITS = {'list': (0.5, 5), 'vote': (3, 20), 'inline': (5, 30), 'default': (1, 10)}
+
+
+def _classify(update):
+    if update.inline_query is not None:
+        return 'inline', update.inline_query.query
+    if update.callback_query is not None:
+        data = update.callback_query.data or ''
+        if _LIST_CALLBACK.match(data):
+            return 'list', data
+        return ('vote' if _VOTE_CALLBACK.match(data) else 'default'), data
+    message = update.effective_message
+    text = (message.text or '') if message is not None else ''
+    if text.startswith('/'):
+        command = text.split(maxsplit=1)[0][1:].split('@')[0].lower()
+        if command in _LIST_COMMANDS:
+            return 'list', text
+        if command in _VOTE_COMMANDS:
+            return 'vote', text
+    return 'default', text
+
+
+# Per-user flood control in front of all the handlers, registered as a handler
+# of group -1 (check() stops the update from going further).
+# Every user has a token bucket per class of requests ('list', 'vote', 'inline',
+# 'default', limits are {class: (rate, burst)}) and the last request, users
+# are kept in an LRU of max_users. The load is the number of updates in about
+# the last second of all users together, when it goes over overload, the
+# least important requests are dropped (see SHED_AT).
+# Dropped users get a notice at most once in repeat_window seconds
+class FloodGuard:
+    def __init__(self, limits=LIMITS, admins=(), max_users=10000, repeat_window=10, overload=100):
+        self.limits = limits
+        self.admins = admins
+        self.max_users = max_users
+        self.repeat_window = repeat_window
+        self.overload = overload
+        self.load = 0
+        # user_id: {'tokens': {class: [tokens, updated]}, 'last': (request, time), 'noticed': time}
+        self._users = OrderedDict()
+        self._updated = monotonic()
+        self._lock = threading.Lock()
+
+    def check(self, update, context):
+        user_class, decision, notify = self.decide(update)
+        FLOOD_DECISIONS.inc(user_class, decision)
+        if decision == 'allowed':
+            return
+        if notify:
+            self._notify(update)
+        raise DispatcherHandlerStop()
+
+    # Returns (class, decision, notify), decision is allowed, throttled or shed,
+    # notify is True when the user has to be told about it
+    def decide(self, update, now=None):
+        now = monotonic() if now is None else now
+        user = update.effective_user
+        with self._lock:
+            # Exponential decay with a time constant of one second
+            self.load = self.load * math.exp(min(0, self._updated - now)) + 1
+            self._updated = now
+            if user is None or user.id in self.admins:
+                return 'admin', 'allowed', False
+
+            user_class, request = _classify(update)
+            state = self._users.get(user.id)
+            if state is None:
+                state = self._users[user.id] = {'tokens': {}, 'last': None, 'noticed': None}
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user.id)
+            last, state['last'] = state['last'], (request, now)
+            repeat = last is not None and last[0] == request and now - last[1] < self.repeat_window
+
+            decision = 'allowed'
+            if user_class != 'vote' and self.load > self.overload * min(
+                    SHED_AT[user_class], SHED_AT['repeat'] if repeat else math.inf):
+                decision = 'shed'
+            else:
+                rate, burst = self.limits[user_class]
+                tokens, updated = state['tokens'].get(user_class, (burst, now))
+                tokens = min(burst, tokens + (now - updated) * rate)
+                if tokens >= 1:
+                    tokens -= 1
+                else:
+                    decision = 'throttled'
+                state['tokens'][user_class] = [tokens, now]
+
+            if decision == 'allowed' or (state['noticed'] is not None and
+                                         now - state['noticed'] < self.repeat_window):
+                return user_class, decision, False
+            state['noticed'] = now
+            return user_class, decision, True
+
+    def metrics(self):
+        return {'users': len(self._users), 'load': round(self.load, 1)}
+
+    def _notify(self, update):
+        text = 'Слишком много запросов, попробуйте немного позже'
+        try:
+            if update.callback_query is not None:
+                update.callback_query.answer(text)
+            elif update.effective_message is not None:
+                update.effective_message.reply_text(text)
+        except TelegramError as e:
+            logger.warning('Failed to tell %s about flood control: %s',
+                           update.effective_user.id, e)
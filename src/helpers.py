@@ -1,13 +1,18 @@
 import os
+import re
 import logging
 import yaml
 import telegram
 import datetime
 import html
+import hashlib
 from functools import wraps
-from time import sleep
-from models import SuggestedTopics, Votes
-from peewee import fn, JOIN
+from time import sleep, perf_counter, time
+from models import SuggestedTopics, ArchivedTopics, Votes, db, write_transaction
+from stats import count_archived
+from peewee import fn, Value, Tuple
+from metrics import SLEEP_SECONDS
+from telegram.ext import ConversationHandler
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
@@ -34,6 +39,40 @@ def isAdmin(fn):
     return wrapper
 
 
+# Every handler gets its own connection which is closed right after it, so that
+# worker threads don't keep SQLite connections (or pooled Postgres ones) forever.
+# Nested calls reuse the connection of the outer handler
+def withConnection(fn):
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not db.is_closed():
+            return fn(*args, **kwargs)
+        db.connect()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            db.close()
+    return wrapper
+
+
+def _iterate_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _iterate_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _iterate_handlers(state_handlers)
+            yield from _iterate_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+
+# Apply decorator to the callbacks of every handler registered in the dispatcher
+def _wrap_handlers(dispatcher, decorator):
+    for group in dispatcher.handlers.values():
+        for handler in _iterate_handlers(group):
+            handler.callback = decorator(handler.callback)
+
+
 def _parse_config():
     global config
     try:
@@ -69,76 +108,370 @@ def _parse_config():
         config['votes'] = {'notifyToVoteOnDay': 5,
                            'notifyToVoteOnTime': datetime.time.fromisoformat("10:00")}
 
+    config.setdefault('storage', {})
+
+    config.setdefault('server', {})
+    config['server'].setdefault('mode', 'polling')
+    config['server'].setdefault('runtime', 'threads')
+    config['server'].setdefault('workers', 4)
+    config['server'].setdefault('listen', '0.0.0.0')
+    config['server'].setdefault('port', 8443)
+    config['server'].setdefault('urlPath', 'devzen')
+    config['server'].setdefault('secretToken', '')
+    config['server'].setdefault('webhookUrl', '')
+    config['server'].setdefault('maxConnections', 40)
+    if 'WEBHOOK_SECRET_TOKEN' in os.environ:
+        config['server']['secretToken'] = os.getenv('WEBHOOK_SECRET_TOKEN')
+    if config['server']['mode'] == 'webhook' and not config['server']['webhookUrl']:
+        logger.error('Webhook mode requires server.webhookUrl')
+        return None
+    config.setdefault('cluster', {})
+    config['cluster'].setdefault('enabled', False)
+    # Only one getUpdates at a time is allowed
+    if config['cluster']['enabled'] and config['server']['mode'] != 'webhook':
+        logger.error('Several instances (cluster.enabled) require server.mode: webhook')
+        return None
+    if config['server']['runtime'] not in ('threads', 'asyncio'):
+        logger.error('server.runtime must be threads or asyncio')
+        return None
+
+    config.setdefault('metrics', {})
+    config['metrics'].setdefault('enabled', False)
+    config['metrics'].setdefault('listen', '127.0.0.1')
+    config['metrics'].setdefault('port', 9100)
+
+    config.setdefault('drafts', {})
+    config['drafts'].setdefault('maxSize', 10000)
+    config['drafts'].setdefault('ttl', 24 * 60 * 60)
+    config['drafts'].setdefault('persistent', True)
+    config['drafts'].setdefault('conversationsFile', 'db_data/conversations.pickle')
+
+    config.setdefault('outgoing', {})
+    config['outgoing'].setdefault('enabled', True)
+    config['outgoing'].setdefault('rate', 30)
+    config['outgoing'].setdefault('chatInterval', 1)
+    config['outgoing'].setdefault('groupInterval', 3)
+    config['outgoing'].setdefault('workers', 4)
+    config['outgoing'].setdefault('maxQueued', 10000)
+
+    config.setdefault('render', {})
+    config['render'].setdefault('cache', True)
+    config['render'].setdefault('episodes', 64)
+
+    config.setdefault('duplicates', {})
+    config['duplicates'].setdefault('threshold', 0.5)
+    config['duplicates'].setdefault('archivedEpisodes', 20)
+
+    config.setdefault('inline', {})
+    config['inline'].setdefault('enabled', True)
+    config['inline'].setdefault('cacheTime', 30)
+    config['inline'].setdefault('archivedEpisodes', 0)
+
+    config.setdefault('backup', {})
+    config['backup'].setdefault('enabled', True)
+    config['backup'].setdefault('directory', 'db_data/backups')
+    config['backup'].setdefault('interval', 6 * 60 * 60)
+    config['backup'].setdefault('keep', 8)
+    config['backup'].setdefault('pages', 256)
+    config['backup'].setdefault('pause', 0.005)
+    config['backup'].setdefault('compressLevel', 1)
+    config['backup'].setdefault('restore', True)
+
+    config.setdefault('tally', {})
+    config['tally'].setdefault('method', 'count')
+    config['tally'].setdefault('reload', 60)
+    if config['tally']['method'] not in ('count', 'borda', 'schulze'):
+        logger.error('tally.method must be count, borda or schulze')
+        return None
+
+    config.setdefault('flood', {})
+    config['flood'].setdefault('enabled', True)
+    config['flood'].setdefault('users', 10000)
+    config['flood'].setdefault('list', {'rate': 0.5, 'burst': 5})
+    config['flood'].setdefault('vote', {'rate': 3, 'burst': 20})
+    config['flood'].setdefault('inline', {'rate': 5, 'burst': 30})
+    config['flood'].setdefault('default', {'rate': 1, 'burst': 10})
+    config['flood'].setdefault('repeatWindow', 10)
+    config['flood'].setdefault('overload', 100)
+
+    config.setdefault('broadcast', {})
+    config['broadcast'].setdefault('rate', 30)
+    config['broadcast'].setdefault('workers', 8)
+    config['broadcast'].setdefault('keepDays', 30)
+
     if config == {}:
         return None
     else:
         return config
 
 
-# A helper function for sending potentially long messages
-def _send_message(update, text, chat_id=None, isCode=False):
-    if len(text) <= MAX_MESSAGE_LENGTH:
-        if isCode:
-            text = '```' + text + '```'
-        if chat_id is not None:
-            update.send_message(
-                chat_id, text, parse_mode=telegram.ParseMode.HTML)
-        else:
-            update.message.reply_text(text, parse_mode=telegram.ParseMode.HTML)
-        return
+# An outgoing.MessageQueue on the threaded runtime, see _set_message_queue()
+message_queue = None
+# Tags, entities, words and single whitespace characters of an HTML message
+_HTML_TOKEN = re.compile(r'<[^>]*>|&#?\w+;|[^<&\s]+|\s|[<&]')
+_TAG_NAME = re.compile(r'</?\s*(\w+)')
+
+
+def _set_message_queue(queue):
+    global message_queue
+    message_queue = queue
+
+
+# Open tags after token: a list of (name, opening tag)
+def _open_tags(tags, token):
+    if not token.startswith('<') or len(token) < 3:
+        return tags
+    name = _TAG_NAME.match(token)
+    if name is None:
+        return tags
+    name = name.group(1).lower()
+    if token.startswith('</'):
+        for i in range(len(tags) - 1, -1, -1):
+            if tags[i][0] == name:
+                return tags[:i] + tags[i + 1:]
+        return tags
+    return tags + [(name, token)]
+
+
+def _closing_tags(tags):
+    return ''.join(f'</{name}>' for name, _ in reversed(tags))
+
+
+# Splits an HTML message into parts of at most limit characters, at the last
+# line break that fits if it isn't in the first half of the part, else at the
+# last space, else inside a word. Never inside a
+# tag or an entity: the tags open at the cut are closed at the end of the part
+# and opened again at the start of the next one
+def _split_html(text, limit=MAX_MESSAGE_LENGTH):
+    if len(text) <= limit:
+        return [text]
+    tokens = _HTML_TOKEN.findall(text)
     parts = []
-    while len(text) > 0:
-        if len(text) > MAX_MESSAGE_LENGTH:
-            part = text[:MAX_MESSAGE_LENGTH]
-            first_lnbr = part.rfind('\n')
-            if first_lnbr != -1:
-                parts.append(part[:first_lnbr])
-                text = text[first_lnbr:]
-            else:
-                parts.append(part)
-                text = text[MAX_MESSAGE_LENGTH:]
-        else:
-            parts.append(text)
-            break
-    for part in parts:
-        if isCode:
-            part = '```' + part + '```'
-        if chat_id:
-            update.send_message(
-                chat_id, part, parse_mode=telegram.ParseMode.HTML)
-        else:
-            update.message.reply_text(part, parse_mode=telegram.ParseMode.HTML)
-        sleep(1)  # There are some limitations on messages per second
+    tags = []
+    i = 0
+    while i < len(tokens):
+        opening = ''.join(tag for _, tag in tags)
+        size = len(opening)
+        open_tags = tags
+        end = i
+        # (token index, open tags, size) after the last line break and the last space
+        line = space = None
+        while end < len(tokens):
+            after = _open_tags(open_tags, tokens[end])
+            if size + len(tokens[end]) + len(_closing_tags(after)) > limit:
+                break
+            size += len(tokens[end])
+            open_tags = after
+            end += 1
+            if tokens[end - 1] == '\n':
+                line = (end, open_tags, size)
+            elif tokens[end - 1].isspace():
+                space = (end, open_tags, size)
+        if end < len(tokens):
+            if line is not None and (line[2] >= limit // 2 or space is None):
+                end, open_tags, _ = line
+            elif space is not None:
+                end, open_tags, _ = space
+            elif end == i and tokens[i][0] in '<&' and len(tokens[i]) > 1:
+                # Only with tags longer than the limit, they aren't cut
+                end, open_tags = i + 1, _open_tags(open_tags, tokens[i])
+            elif end == i:
+                # A word longer than the whole part
+                room = max(1, limit - size - len(_closing_tags(open_tags)))
+                tokens[i:i + 1] = [tokens[i][:room], tokens[i][room:]]
+                continue
+        part = (opening + ''.join(tokens[i:end])).rstrip() + _closing_tags(open_tags)
+        if part.strip():
+            parts.append(part)
+        tags = open_tags
+        i = end
+    return parts
+
+
+# A helper function for sending potentially long messages. On the threaded
+# runtime the parts are queued (see outgoing.py) and the handler goes on right
+# away. update is the bot when chat_id is given. reply_markup goes with the last
+# part, so a question with buttons comes after the text it asks about
+def _send_message(update, text, chat_id=None, isCode=False, reply_markup=None):
+    bot = update if chat_id is not None else update.message.bot
+    if chat_id is None:
+        chat_id = update.message.chat_id
+    parts = _split_html(text)
+    if isCode:
+        parts = ['```' + part + '```' for part in parts]
+    for i, part in enumerate(parts):
+        markup = reply_markup if i == len(parts) - 1 else None
+        if message_queue is not None:
+            message_queue.send(bot, chat_id, part, parse_mode=telegram.ParseMode.HTML,
+                               reply_markup=markup)
+            continue
+        if i > 0:
+            # There are some limitations on messages per second
+            _pause(bot, chat_id, 1)
+        bot.send_message(chat_id, part, parse_mode=telegram.ParseMode.HTML,
+                         reply_markup=markup)
+
+
+# The asyncio runtime pauses the messages of the chat on its own, without
+# holding the thread (see aio._DeferredRequest)
+def _pause(bot, chat_id, seconds):
+    pause = getattr(getattr(bot, 'request', None), 'pause', None)
+    if pause is not None:
+        pause(chat_id, seconds)
+        return
+    sleep(seconds)
+    SLEEP_SECONDS.inc('send_message', amount=seconds)
+
+
+def _format_votes(votes, place=None):
+    if place is not None:
+        return f'#️⃣ <i>Место:</i> {place}, <i>голосов:</i> {votes}\n'
+    return f'#️⃣ <i>Голосов:</i> {votes}\n'
 
 
 def _format_topic(title, username, body, votes=None):
-    if votes is None:
-        topic = f'*️⃣ <b>' + \
-            f'{html.escape(title)}</b> (Предложена <i>{html.escape(username)}</i>)\n'
-    else:
-        topic = f'#️⃣ <i>Голосов:</i> {votes}\n*️⃣ <b>' + \
-            f'{html.escape(title)}</b> (Предложена <i>{html.escape(username)}</i>)\n'
+    topic = f'*️⃣ <b>' + \
+        f'{html.escape(title)}</b> (Предложена <i>{html.escape(username)}</i>)\n'
+    if votes is not None:
+        topic = _format_votes(votes) + topic
     topic += html.escape(body)
 
     return topic
 
 
-def _get_sorted_topics_with_votes():
-    # Since sqlite does not support full outer join,
-    # we should use dirty UNION hack. Or maybe I just don't get SQL (:
-    query = Votes.select(SuggestedTopics.username.alias('username'),
-                         SuggestedTopics.user.alias('user'),
-                         SuggestedTopics.title.alias('title'),
-                         SuggestedTopics.body.alias('body'),
-                         fn.COUNT(SuggestedTopics.title).alias(
-                             'votes')
-                         ).join(SuggestedTopics).group_by(SuggestedTopics.title) | \
-        SuggestedTopics.select(SuggestedTopics.username,
-                               SuggestedTopics.user,
-                               SuggestedTopics.title,
-                               SuggestedTopics.body,
-                               0).join(Votes, JOIN.LEFT_OUTER).where(Votes.topic.is_null())
-    # Let's sort topics by votes
-    topics = sorted(list(query.namedtuples()),
-                    key=lambda x: x.votes, reverse=True)
-    return topics
+# Case and whitespace don't make a topic different
+def _normalize_text(text):
+    return ' '.join(text.lower().split())
+
+
+# SuggestedTopics.uid. Unlike hash(), which is salted for every process, the same
+# topic gets the same uid after a restart, so the primary key catches duplicates.
+# Signed, as SQLite integers are
+def _topic_uid(title, body):
+    digest = hashlib.blake2b((_normalize_text(title) + '\n' + _normalize_text(body)).encode(),
+                             digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+def _actual_votes():
+    return Votes.select(fn.COUNT(Votes.user)).where(Votes.topic == SuggestedTopics.uid)
+
+
+# Returns (uid, title, stored, actual) for every topic whose counter went wrong
+def _check_vote_counters():
+    actual = _actual_votes()
+    return list(SuggestedTopics.select(SuggestedTopics.uid,
+                                       SuggestedTopics.title,
+                                       SuggestedTopics.votes.alias('stored'),
+                                       actual.alias('actual')
+                                       ).where(SuggestedTopics.votes != actual).namedtuples())
+
+
+def _rebuild_vote_counters():
+    return SuggestedTopics.update(votes=_actual_votes()).execute()
+
+
+# Returns True if the vote was added, False if it was withdrawn and None if there
+# is no such topic anymore. The delete tells us whether the vote existed, so there
+# is no need to look it up first
+def _toggle_vote(user_id, topic_uid):
+    with write_transaction():
+        if Votes.delete().where((Votes.user == user_id) &
+                                (Votes.topic == topic_uid)).execute() > 0:
+            SuggestedTopics.update(votes=SuggestedTopics.votes - 1).where(
+                SuggestedTopics.uid == topic_uid).execute()
+            return False
+        if SuggestedTopics.update(votes=SuggestedTopics.votes + 1).where(
+                SuggestedTopics.uid == topic_uid).execute() == 0:
+            return None
+        Votes.insert(user=user_id, topic=topic_uid, created=time()).execute()
+        return True
+
+
+# Moves all the topics with their vote counts to the archive in one statement
+# and clears the live tables in the same transaction, the statistics of the
+# archive are updated in it as well.
+# Returns the numbers of archived topics and votes and the elapsed seconds
+def _archive_topics(episode):
+    started = perf_counter()
+    archived = time()
+    with write_transaction():
+        last = ArchivedTopics.select(fn.MAX(ArchivedTopics.id)).scalar() or 0
+        ArchivedTopics.insert_from(
+            SuggestedTopics.select(SuggestedTopics.user,
+                                   SuggestedTopics.title,
+                                   SuggestedTopics.body,
+                                   SuggestedTopics.username,
+                                   SuggestedTopics.votes,
+                                   Value(episode),
+                                   Value(archived)).order_by(SuggestedTopics.votes.desc()),
+            fields=[ArchivedTopics.user,
+                    ArchivedTopics.title,
+                    ArchivedTopics.body,
+                    ArchivedTopics.username,
+                    ArchivedTopics.votes,
+                    ArchivedTopics.episode,
+                    ArchivedTopics.archived]).execute()
+        count_archived(episode, archived, ArchivedTopics.id > last)
+        votes = Votes.delete().execute()
+        topics = SuggestedTopics.delete().execute()
+    return topics, votes, perf_counter() - started
+
+
+def _get_voted_topic_uids(user_id, uids=None):
+    # One query for the whole ballot (or the page of it) instead of one count() per topic
+    query = Votes.select(Votes.topic).where(Votes.user == user_id)
+    if uids is not None:
+        query = query.where(Votes.topic.in_(uids))
+    return {vote.topic_id for vote in query}
+
+
+# Pages of live topics are fetched by keyset: the cursor is the uid of the
+# last topic of the previous page (after) or of the first topic of the next one
+# (before), so that a page costs the same at any depth and topics added or
+# removed meanwhile don't shift the pages. Returns (uids, has_prev, has_next)
+def _topic_page(size, after=None, before=None):
+    uid = SuggestedTopics.uid
+    query = SuggestedTopics.select(uid)
+    if before is not None:
+        uids = [row[0] for row in query.where(uid < before).order_by(uid.desc()).limit(
+            size + 1).tuples()]
+        return list(reversed(uids[:size])), len(uids) > size, True
+    if after is not None:
+        query = query.where(uid > after)
+    uids = [row[0] for row in query.order_by(uid).limit(size + 1).tuples()]
+    return uids[:size], after is not None, len(uids) > size
+
+
+# The same for topics ranked by votes, most voted first. The cursors are
+# (votes, uid), compared as row values so that SQLite walks the votes index
+# (which ends with the uid) from the cursor. Returns ([(uid, votes)], has_prev, has_next)
+def _ranked_page(size, after=None, before=None):
+    uid, votes = SuggestedTopics.uid, SuggestedTopics.votes
+    query = SuggestedTopics.select(uid, votes)
+    if before is not None:
+        rows = list(query.where(Tuple(votes, uid) > Tuple(*before)).order_by(
+            votes, uid).limit(size + 1).tuples())
+        return list(reversed(rows[:size])), len(rows) > size, True
+    if after is not None:
+        query = query.where(Tuple(votes, uid) < Tuple(*after))
+    rows = list(query.order_by(votes.desc(), uid.desc()).limit(size + 1).tuples())
+    return rows[:size], after is not None, len(rows) > size
+
+
+# Glue small texts together so that we send a few messages instead of one per topic.
+# Texts longer than MAX_MESSAGE_LENGTH go alone and are split by _split_html()
+def _pack_messages(texts, separator='\n\n'):
+    messages = []
+    current = ''
+    for text in texts:
+        if current and len(current) + len(separator) + len(text) > MAX_MESSAGE_LENGTH:
+            messages.append(current)
+            current = text
+        elif current:
+            current += separator + text
+        else:
+            current = text
+    if current:
+        messages.append(current)
+    return messages
@@ -0,0 +1,246 @@
+import re
+import bisect
+import threading
+from collections import OrderedDict, namedtuple
+from peewee import fn
+from telegram import InlineQueryResultArticle, InputTextMessageContent, ParseMode
+from models import SuggestedTopics, ArchivedTopics
+from helpers import _format_topic
+
+# Telegram takes up to 50 results per answer, the rest come with next_offset
+RESULTS_PER_PAGE = 20
+# A topic is sent as one message
+MAX_BODY = 3000
+# Queries come letter by letter and many users type the same ones
+MAX_CACHED_QUERIES = 1000
+_WORD = re.compile(r'\w+')
+
+Topic = namedtuple('Topic', ['title', 'body', 'username', 'votes', 'episode'])
+
+
+def _words(text):
+    return _WORD.findall(text.lower())
+
+
+def _topic_words(topic):
+    return set(_words(f'{topic.title} {topic.body} {topic.username}'))
+
+
+def _live_key(uid):
+    return f't{uid}'
+
+
+# Live and archived topics with their vote counts for inline queries (@bot
+# words), which are answered from memory. Every word of the query has to be a
+# prefix of a word of the title, the body or the author. Live topics go first,
+# the most voted first, then archived ones from the latest episode.
+# The index is loaded once and then updated on propose, vote, delete and
+# archive. Keys are also the ids of the results: 't<uid>' for live topics and
+# 'a<id>' for archived ones. archived_episodes limits how many of the last
+# episodes are kept, 0 is all of them
+class TopicIndex:
+    def __init__(self, enabled=True, archived_episodes=0):
+        self.enabled = enabled
+        self.archived_episodes = archived_episodes
+        # key: Topic
+        self._topics = {}
+        self._live = set()
+        # word: keys of the topics with it, and all the words sorted for prefixes
+        self._keys = {}
+        self._words = []
+        # Archived keys in the order they are shown and the position of every one
+        self._archived = []
+        self._rank = {}
+        # words of a query: (live keys, archived keys in order)
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self):
+        if not self.enabled:
+            return
+        topics = {_live_key(topic.uid): Topic(topic.title, topic.body, topic.username,
+                                              topic.votes, None)
+                  for topic in SuggestedTopics.select(
+                      SuggestedTopics.uid, SuggestedTopics.title, SuggestedTopics.body,
+                      SuggestedTopics.username, SuggestedTopics.votes)}
+        for topic in self._archived_topics():
+            topics[f'a{topic.id}'] = Topic(topic.title, topic.body, topic.username,
+                                           topic.votes, topic.episode)
+        # Built aside, queries are answered from the old one meanwhile
+        index = TopicIndex(archived_episodes=self.archived_episodes)
+        index._topics = topics
+        index._live = {key for key, topic in topics.items() if topic.episode is None}
+        for key, topic in topics.items():
+            for word in _topic_words(topic):
+                index._keys.setdefault(word, set()).add(key)
+        index._words = sorted(index._keys)
+        index._changed(archived=True)
+        with self._lock:
+            self._topics, self._live = index._topics, index._live
+            self._keys, self._words = index._keys, index._words
+            self._archived, self._rank = index._archived, index._rank
+            self._queries.clear()
+
+    # Vote counts changed by someone else (another instance or /recount)
+    def load_votes(self):
+        if not self.enabled:
+            return
+        votes = dict(SuggestedTopics.select(SuggestedTopics.uid, SuggestedTopics.votes).tuples())
+        with self._lock:
+            for uid, count in votes.items():
+                topic = self._topics.get(_live_key(uid))
+                if topic is not None and topic.votes != count:
+                    self._topics[_live_key(uid)] = topic._replace(votes=count)
+
+    def add(self, uid, title, body, username, votes=0):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._add(_live_key(uid), Topic(title, body, username, votes, None))
+            self._changed()
+
+    def remove(self, uid):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remove(_live_key(uid))
+            self._changed()
+
+    # delta is 1 for a new vote and -1 for a withdrawn one
+    def vote(self, uid, delta):
+        if not self.enabled:
+            return
+        with self._lock:
+            topic = self._topics.get(_live_key(uid))
+            if topic is not None:
+                self._topics[_live_key(uid)] = topic._replace(votes=topic.votes + delta)
+
+    # Live topics are replaced with the topics archived as episode, the oldest
+    # episodes are forgotten
+    def archive(self, episode):
+        if not self.enabled:
+            return
+        archived = list(ArchivedTopics.select(
+            ArchivedTopics.id, ArchivedTopics.title, ArchivedTopics.body,
+            ArchivedTopics.username, ArchivedTopics.votes).where(ArchivedTopics.episode == episode))
+        with self._lock:
+            for key in list(self._live):
+                self._remove(key)
+            for topic in archived:
+                self._add(f'a{topic.id}', Topic(topic.title, topic.body, topic.username,
+                                                topic.votes, episode))
+            if self.archived_episodes:
+                for key, topic in list(self._topics.items()):
+                    if topic.episode is not None and \
+                            topic.episode <= episode - self.archived_episodes:
+                        self._remove(key)
+            self._changed(archived=True)
+
+    # Returns [(key, Topic)] of a page of topics matching text and the offset of
+    # the next page, None if it is the last one
+    def search(self, text, offset=0, limit=RESULTS_PER_PAGE):
+        words = tuple(sorted(set(_words(text))))
+        with self._lock:
+            found = self._queries.get(words)
+            if found is None:
+                found = self._queries[words] = self._match(words)
+                if len(self._queries) > MAX_CACHED_QUERIES:
+                    self._queries.popitem(last=False)
+            else:
+                self._queries.move_to_end(words)
+            live, archived = found
+            # Votes of live topics change all the time, there are few of them
+            live = sorted(live, key=lambda key: (-self._topics[key].votes, key))
+            if offset < len(live):
+                page = live[offset:offset + limit]
+                page += archived[:limit - len(page)]
+            else:
+                page = archived[offset - len(live):offset - len(live) + limit]
+            more = offset + limit < len(live) + len(archived)
+            return [(key, self._topics[key]) for key in page], offset + limit if more else None
+
+    def __len__(self):
+        return len(self._topics)
+
+    def _archived_topics(self):
+        query = ArchivedTopics.select(ArchivedTopics.id, ArchivedTopics.title,
+                                      ArchivedTopics.body, ArchivedTopics.username,
+                                      ArchivedTopics.votes, ArchivedTopics.episode)
+        if self.archived_episodes:
+            last = ArchivedTopics.select(fn.MAX(ArchivedTopics.episode)).scalar()
+            if last is None:
+                return []
+            query = query.where(ArchivedTopics.episode > last - self.archived_episodes)
+        return query
+
+    # Must be called with the lock held, as the rest of the methods below
+    def _match(self, words):
+        if len(words) == 0:
+            return set(self._live), self._archived
+        keys = None
+        # Longer prefixes match fewer words
+        for word in sorted(words, key=len, reverse=True):
+            matched = set()
+            i = bisect.bisect_left(self._words, word)
+            while i < len(self._words) and self._words[i].startswith(word):
+                matched |= self._keys[self._words[i]]
+                i += 1
+            keys = matched if keys is None else keys & matched
+            if len(keys) == 0:
+                break
+        live = keys & self._live
+        # Going through all of them in order is cheaper than sorting many
+        if len(keys) > len(self._archived) // 8:
+            return live, [key for key in self._archived if key in keys]
+        return live, sorted(keys - live, key=self._rank.__getitem__)
+
+    def _add(self, key, topic):
+        self._remove(key)
+        self._topics[key] = topic
+        if topic.episode is None:
+            self._live.add(key)
+        for word in _topic_words(topic):
+            keys = self._keys.get(word)
+            if keys is None:
+                keys = self._keys[word] = set()
+                bisect.insort(self._words, word)
+            keys.add(key)
+
+    def _remove(self, key):
+        topic = self._topics.pop(key, None)
+        if topic is None:
+            return
+        self._live.discard(key)
+        for word in _topic_words(topic):
+            keys = self._keys.get(word)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if len(keys) == 0:
+                del self._keys[word]
+                del self._words[bisect.bisect_left(self._words, word)]
+
+    # The topic set has changed: the matches of cached queries are dropped and
+    # archived topics are ranked again if there are new ones
+    def _changed(self, archived=False):
+        if archived:
+            self._archived = sorted((key for key in self._topics if key not in self._live),
+                                    key=lambda key: (-self._topics[key].episode,
+                                                     -self._topics[key].votes, key))
+            self._rank = {key: i for i, key in enumerate(self._archived)}
+        self._queries.clear()
+
+
+# An inline result which sends the topic with its vote count to the chat
+def article(key, topic):
+    body = topic.body if len(topic.body) <= MAX_BODY else topic.body[:MAX_BODY].rstrip() + '…'
+    text = _format_topic(topic.title, topic.username, body, topic.votes)
+    if topic.episode is None:
+        where = 'текущее голосование'
+    else:
+        where = f'выпуск №{topic.episode}'
+        text += f'\n<i>Выпуск №{topic.episode}</i>'
+    return InlineQueryResultArticle(
+        key, topic.title,
+        InputTextMessageContent(text, parse_mode=ParseMode.HTML),
+        description=f'Голосов: {topic.votes} · {where}\n{topic.body[:100]}')
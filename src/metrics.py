@@ -0,0 +1,250 @@
+import re
+import logging
+import threading
+from functools import wraps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import perf_counter
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ConversationHandler
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            if labels not in self._values:
+                self._values[labels] = {'buckets': [0] * len(self.buckets), 'sum': 0, 'count': 0}
+            values = self._values[labels]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values['buckets'][i] += 1
+            values['sum'] += value
+            values['count'] += 1
+
+    def count(self, *labels):
+        return self._values[labels]['count'] if labels in self._values else 0
+
+    def samples(self):
+        with self._lock:
+            values = {labels: dict(v, buckets=list(v['buckets']))
+                      for labels, v in self._values.items()}
+        for labels, v in sorted(values.items()):
+            for bound, bucket in zip(self.buckets, v['buckets']):
+                yield self.name + '_bucket' + _format_labels(
+                    self.labels, labels, [('le', bound)]), bucket
+            yield self.name + '_bucket' + _format_labels(
+                self.labels, labels, [('le', '+Inf')]), v['count']
+            yield self.name + '_sum' + _format_labels(self.labels, labels), v['sum']
+            yield self.name + '_count' + _format_labels(self.labels, labels), v['count']
+
+
+# Values are collected by callback(), which returns {label values: value}, at scrape time
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+
+    def samples(self):
+        for labels, value in sorted((self.callback() or {}).items()):
+            yield self.name + _format_labels(self.labels, labels), value
+
+
+# Totals only ever growing that are kept by someone else (e.g. the hits of the
+# render cache), collected by callback() at scrape time like a Gauge
+class CallbackCounter(Gauge):
+    type = 'counter'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            try:
+                lines.extend(f'{name} {value}' for name, value in metric.samples())
+            except Exception as e:
+                logger.exception(e)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.register(Histogram(
+    'devzen_handler_seconds', 'Time spent in update handlers and jobs', ('handler',)))
+HANDLER_ERRORS = REGISTRY.register(Counter(
+    'devzen_handler_errors_total', 'Exceptions raised by update handlers and jobs', ('handler',)))
+QUERY_SECONDS = REGISTRY.register(Histogram(
+    'devzen_db_query_seconds', 'Time spent executing SQL statements', ('statement', 'table')))
+API_SECONDS = REGISTRY.register(Histogram(
+    'devzen_telegram_api_seconds', 'Time spent in Bot API calls', ('method',)))
+API_ERRORS = REGISTRY.register(Counter(
+    'devzen_telegram_api_errors_total', 'Failed Bot API calls by error', ('method', 'error')))
+FLOOD_DECISIONS = REGISTRY.register(Counter(
+    'devzen_flood_decisions_total', 'Updates let through or dropped by flood control',
+    ('class', 'decision')))
+SLEEP_SECONDS = REGISTRY.register(Counter(
+    'devzen_sleep_seconds_total', 'Time handlers spent sleeping to respect rate limits', ('where',)))
+
+
+# Records latency and errors of a handler or job callback
+def timed(fn):
+    name = getattr(fn, '__name__', repr(fn))
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        started = perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(perf_counter() - started, name)
+    return wrapper
+
+
+_STATEMENT = re.compile(r'^\s*(\w+)')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+"?(\w+)"?', re.IGNORECASE)
+
+
+def instrument_database(database):
+    execute_sql = database.execute_sql
+
+    @wraps(execute_sql)
+    def timed_execute_sql(sql, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return execute_sql(sql, *args, **kwargs)
+        finally:
+            statement = _STATEMENT.match(sql)
+            table = _TABLE.search(sql)
+            QUERY_SECONDS.observe(perf_counter() - started,
+                                  statement.group(1).upper() if statement else '',
+                                  table.group(1) if table else '')
+    database.execute_sql = timed_execute_sql
+
+
+# Every Bot API call goes through Request.post, the method is the last part of the url
+def instrument_bot(bot):
+    request = bot.request
+    post = request.post
+
+    @wraps(post)
+    def timed_post(url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        started = perf_counter()
+        try:
+            return post(url, *args, **kwargs)
+        except RetryAfter:
+            API_ERRORS.inc(method, 'RetryAfter')
+            raise
+        except TelegramError as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_SECONDS.observe(perf_counter() - started, method)
+    # Request warns about custom attributes on plain assignment
+    object.__setattr__(request, 'post', timed_post)
+
+
+# Number of users in every state of every conversation
+def conversation_gauge(dispatcher):
+    def occupancy():
+        values = {}
+        for group in dispatcher.handlers.values():
+            for handler in group:
+                if not isinstance(handler, ConversationHandler):
+                    continue
+                name = handler.name or handler.entry_points[0].callback.__name__
+                for state in list(handler.conversations.values()):
+                    # Conversations waiting for an async handler keep (old state, promise)
+                    if isinstance(state, tuple):
+                        state = state[0]
+                    values[(name, str(state))] = values.get((name, str(state)), 0) + 1
+        return values
+    return Gauge('devzen_conversations', 'Users in every conversation state',
+                 ('conversation', 'state'), occupancy)
+
+
+def _handler():
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = REGISTRY.exposition().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return MetricsHandler
+
+
+def start_server(listen, port):
+    server = ThreadingHTTPServer((listen, port), _handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on http://%s:%d/metrics', listen, server.server_port)
+    return server
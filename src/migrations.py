@@ -0,0 +1,118 @@
+from models import db
+from models import (SubscibedUsers, SuggestedTopics, ArchivedTopics, Votes, Drafts,
+                    SchemaVersion, Leases, Conversations, HandledUpdates, Versions,
+                    Broadcasts, Outbox, Deliveries, EpisodeStats, YearStats,
+                    ProposerStats, Searches)
+from helpers import logger, _rebuild_vote_counters, _topic_uid
+from search import create_search_index, search_supported, rebuild_search_index
+from stats import rebuild_stats
+
+MODELS = [SubscibedUsers, SuggestedTopics, ArchivedTopics, Votes, Drafts, Leases,
+          Conversations, HandledUpdates, Versions, Broadcasts, Outbox, Deliveries,
+          EpisodeStats, YearStats, ProposerStats, Searches]
+
+
+# Migrations bring databases created by older versions of the bot up to date
+# with models.py. Append new ones to the end of MIGRATIONS and never edit released
+# ones: the position in the list is the schema version stored in the database.
+# Fresh databases are created from the models and get the latest version right away,
+# so don't forget to update the model as well.
+
+def _index_votes_topic():
+    # delete_topic and the vote counters filter Votes by topic
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "votes_topic_id" ON "votes" ("topic_id")')
+
+
+def _index_archived_topics_episode():
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "archivedtopics_episode_votes" ' +
+                   'ON "archivedtopics" ("episode", "votes")')
+
+
+def _add_vote_counters():
+    # dbinit.py used to add this column by itself, so it may be there already
+    if 'votes' in [column.name for column in db.get_columns('suggestedtopics')]:
+        return
+    db.execute_sql('ALTER TABLE "suggestedtopics" ADD COLUMN "votes" INTEGER NOT NULL DEFAULT 0')
+    db.execute_sql('CREATE INDEX IF NOT EXISTS "suggestedtopics_votes" ' +
+                   'ON "suggestedtopics" ("votes")')
+    _rebuild_vote_counters()
+
+
+def _add_search_index():
+    # Not a model: FTS5 tables and their triggers are SQLite only
+    create_search_index()
+
+
+def _stable_topic_uids():
+    # uids used to be hash(title + body), which changes with every restart
+    for topic in list(SuggestedTopics.select(SuggestedTopics.uid, SuggestedTopics.title,
+                                             SuggestedTopics.body)):
+        uid = _topic_uid(topic.title, topic.body)
+        if uid == topic.uid or SuggestedTopics.select().where(
+                SuggestedTopics.uid == uid).exists():
+            continue
+        Votes.update(topic=uid).where(Votes.topic == topic.uid).execute()
+        SuggestedTopics.update(uid=uid).where(SuggestedTopics.uid == topic.uid).execute()
+    # The uid is the rowid of the search index, which triggers don't update
+    if search_supported():
+        rebuild_search_index()
+
+
+def _add_archive_stats():
+    # Dates of the topics archived so far are unknown, they count for all the time only
+    if 'archived' not in [column.name for column in db.get_columns('archivedtopics')]:
+        db.execute_sql('ALTER TABLE "archivedtopics" ADD COLUMN "archived" REAL')
+    db.create_tables([EpisodeStats, YearStats, ProposerStats], safe=True)
+    episodes, elapsed = rebuild_stats()
+    logger.info('Counted statistics of %d archived episodes in %.2fs', episodes, elapsed)
+
+
+def _add_vote_order():
+    # The order of the votes cast so far is unknown, see tally.py
+    if 'created' not in [column.name for column in db.get_columns('votes')]:
+        db.execute_sql('ALTER TABLE "votes" ADD COLUMN "created" REAL')
+
+
+MIGRATIONS = [
+    _index_votes_topic,
+    _index_archived_topics_episode,
+    _add_vote_counters,
+    _add_search_index,
+    _stable_topic_uids,
+    _add_archive_stats,
+    _add_vote_order,
+]
+
+
+def schema_version():
+    row = SchemaVersion.select().first()
+    return row.version if row is not None else 0
+
+
+def _set_schema_version(version):
+    SchemaVersion.delete().execute()
+    SchemaVersion.create(version=version)
+
+
+def migrate_database():
+    db.create_tables([SchemaVersion], safe=True)
+
+    # Nothing to migrate, the models already describe the latest schema
+    if not db.table_exists(SuggestedTopics._meta.table_name):
+        with db.atomic():
+            db.create_tables(MODELS, safe=True)
+            create_search_index()
+            _set_schema_version(len(MIGRATIONS))
+        return
+
+    version = schema_version()
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info('Applying migration %d: %s', number, migration.__name__)
+        with db.atomic():
+            migration()
+            _set_schema_version(number)
+
+    # Migrations must run before this: create_tables() also creates the indexes
+    # from the models, and SQLite happily indexes a column that doesn't exist yet
+    # as a string literal. New tables are created here as is
+    db.create_tables(MODELS, safe=True)
@@ -1,8 +1,70 @@
 from peewee import Model
-from peewee import SqliteDatabase
-from peewee import CharField, IntegerField, ForeignKeyField, CompositeKey
+from peewee import SqliteDatabase, DatabaseProxy
+from peewee import (CharField, TextField, IntegerField, BigIntegerField, FloatField,
+                    BlobField, ForeignKeyField, CompositeKey)
 
-db = SqliteDatabase("db_data/devzen.db")
+# Defaults for the storage section of config.yaml
+STORAGE_DEFAULTS = {
+    'backend': 'sqlite',
+    'path': 'db_data/devzen.db',
+    # Readers don't block the writer and vice versa
+    'journalMode': 'wal',
+    # Safe with WAL, only the last transactions may be lost on power failure
+    'synchronous': 'normal',
+    # Milliseconds to wait for the write lock before "database is locked"
+    'busyTimeout': 5000,
+    # Negative values are KiB
+    'cacheSize': -16000,
+    'mmapSize': 64 * 1024 * 1024,
+    # Postgres only
+    'host': 'localhost',
+    'port': 5432,
+    'user': 'postgres',
+    'password': '',
+    'database': 'devzen',
+    'maxConnections': 16,
+    'staleTimeout': 300,
+}
+
+# The actual database is chosen in init_database() according to the config
+db = DatabaseProxy()
+
+
+def init_database(storage=None):
+    storage = {**STORAGE_DEFAULTS, **(storage or {})}
+    if storage['backend'] == 'postgres':
+        # Requires psycopg2, which is not installed by default
+        from playhouse.pool import PooledPostgresqlDatabase
+        database = PooledPostgresqlDatabase(storage['database'],
+                                            host=storage['host'],
+                                            port=storage['port'],
+                                            user=storage['user'],
+                                            password=storage['password'],
+                                            max_connections=storage['maxConnections'],
+                                            stale_timeout=storage['staleTimeout'])
+    else:
+        database = SqliteDatabase(storage['path'],
+                                  timeout=storage['busyTimeout'] / 1000,
+                                  pragmas={
+                                      'journal_mode': storage['journalMode'],
+                                      'synchronous': storage['synchronous'],
+                                      'busy_timeout': storage['busyTimeout'],
+                                      'cache_size': storage['cacheSize'],
+                                      'mmap_size': storage['mmapSize']})
+    db.initialize(database)
+    return database
+
+
+# Use it instead of db.atomic() for transactions that write. SQLite then takes
+# the write lock right away: upgrading a read lock halfway through a transaction
+# fails with "database is locked" without waiting for busy_timeout
+def write_transaction():
+    if isinstance(db.obj, SqliteDatabase):
+        return db.atomic('IMMEDIATE')
+    return db.atomic()
+
+
+init_database()
 
 
 class BaseModel(Model):
@@ -11,32 +73,178 @@ class BaseModel(Model):
 
 
 class SubscibedUsers(BaseModel):
-    user = IntegerField(unique=True)
+    user = BigIntegerField(unique=True)
 
 
 class SuggestedTopics(BaseModel):
-    # hash(title+body). We should be able to uniquely identyfy topic for voting
-    # We don't really care about collisions, we'll use non-cryptographic hash
-    uid = IntegerField(primary_key=True)
-    user = IntegerField()
+    # helpers._topic_uid(): 8 bytes of BLAKE2b over the normalized title and body,
+    # signed. The same text gets the same uid after a restart and on every instance,
+    # so the primary key catches duplicates
+    uid = BigIntegerField(primary_key=True)
+    user = BigIntegerField()
     title = CharField()
     body = CharField()
     username = CharField()
+    # Number of rows in Votes for this topic. Updated in the same transaction
+    # as the vote itself, so ranking is a plain indexed ORDER BY
+    votes = IntegerField(default=0, index=True)
 
 
 class ArchivedTopics(BaseModel):
-    user = IntegerField()
+    user = BigIntegerField()
     title = CharField()
     body = CharField()
     username = CharField()
     votes = IntegerField()
     episode = IntegerField()
+    # Unix timestamp, unknown for topics archived by older versions of the bot
+    archived = FloatField(null=True)
+
+    class Meta:
+        # /list N and /archive look topics up by episode, ordered by votes
+        indexes = ((('episode', 'votes'), False),)
 
 
 class Votes(Model):
-    user = IntegerField()
+    user = BigIntegerField()
     topic = ForeignKeyField(SuggestedTopics)
+    # Unix time of the vote, the ranked tally engines read the ballot in this order
+    created = FloatField(null=True)
 
     class Meta:
         database = db
         primary_key = CompositeKey('user', 'topic')
+
+
+# The number of schema migrations applied to the database, see migrations.py
+class SchemaVersion(BaseModel):
+    version = IntegerField()
+
+
+# Half-finished /propose topics, see drafts.py
+class Drafts(BaseModel):
+    user = BigIntegerField(primary_key=True)
+    title = CharField(null=True)
+    body = CharField(null=True)
+    username = CharField(null=True)
+    # Unix timestamp of the last change
+    updated = FloatField(index=True)
+
+
+# Locks with an expiry time, held by one instance of the bot at a time, see cluster.py
+class Leases(BaseModel):
+    name = CharField(primary_key=True)
+    holder = CharField()
+    # Unix timestamp, anyone can take the lease after it
+    expires = FloatField()
+
+
+# Conversation states shared by the instances of the bot, see cluster.py
+class Conversations(BaseModel):
+    name = CharField()
+    # JSON of the key of ConversationHandler, e.g. [chat_id, user_id]
+    key = CharField()
+    # Pickled, like PicklePersistence does: the states are range objects
+    state = BlobField()
+
+    class Meta:
+        primary_key = CompositeKey('name', 'key')
+
+
+# Updates taken by one of the instances, so that no other one handles them again
+class HandledUpdates(BaseModel):
+    update_id = BigIntegerField(primary_key=True)
+    # Unix timestamp
+    handled = FloatField(index=True)
+
+
+# Terms of /search. The page buttons carry the id: callback data has room for
+# 64 bytes only, and any instance has to find the terms, after a restart too
+class Searches(BaseModel):
+    terms = TextField(unique=True)
+    # Unix timestamp of the last search with the terms
+    used = FloatField(index=True)
+
+
+# Counters the instances bump when they change something that the others cache
+class Versions(BaseModel):
+    name = CharField(primary_key=True)
+    value = IntegerField()
+
+
+# Messages sent to many users at once, see outbox.py
+class Broadcasts(BaseModel):
+    # Unique, e.g. 'reminder:2026-10-17', so that a broadcast is planned once
+    key = CharField(unique=True)
+    text = TextField()
+    parse_mode = CharField(null=True)
+    # Unix timestamps
+    created = FloatField()
+    finished = FloatField(null=True, index=True)
+
+
+# A row per recipient of a broadcast, planned before the first message is sent
+class Outbox(BaseModel):
+    broadcast = ForeignKeyField(Broadcasts)
+    user = BigIntegerField()
+    # pending, sending (taken by the sender), sent, blocked or failed
+    status = CharField()
+    # Unix timestamp of the last change
+    updated = FloatField(null=True)
+
+    class Meta:
+        primary_key = CompositeKey('broadcast', 'user')
+        # The sender takes pending rows in the order of users
+        indexes = ((('broadcast', 'status', 'user'), False),)
+
+
+# A row per message of a broadcast the Bot API has accepted, written with the
+# sent status of its Outbox row as soon as the answer comes, see outbox.py
+class Deliveries(BaseModel):
+    broadcast = ForeignKeyField(Broadcasts)
+    user = BigIntegerField()
+    # Unix timestamp
+    sent = FloatField()
+
+    class Meta:
+        primary_key = CompositeKey('broadcast', 'user')
+
+
+# Aggregates of ArchivedTopics for /stats, see stats.py
+class EpisodeStats(BaseModel):
+    episode = IntegerField(primary_key=True)
+    topics = IntegerField()
+    votes = IntegerField()
+    # Topics with at least one vote
+    voted = IntegerField()
+    # Votes of the most voted topic
+    best = IntegerField()
+    proposers = IntegerField()
+    # Unix timestamp of the first archiving, if known
+    archived = FloatField(null=True)
+
+
+# The same per year of archiving, year 0 is all the time
+class YearStats(BaseModel):
+    year = IntegerField(primary_key=True)
+    episodes = IntegerField()
+    topics = IntegerField()
+    votes = IntegerField()
+    voted = IntegerField()
+    proposers = IntegerField()
+
+
+class ProposerStats(BaseModel):
+    user = BigIntegerField()
+    # 0 is all the time
+    year = IntegerField()
+    username = CharField()
+    topics = IntegerField()
+    votes = IntegerField()
+    voted = IntegerField()
+    best = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('user', 'year')
+        # Top proposers of a year
+        indexes = ((('year', 'votes'), False),)
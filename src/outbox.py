@@ -0,0 +1,268 @@
+import asyncio
+import threading
+from collections import defaultdict
+from time import time
+from peewee import DatabaseError, IntegrityError, Value, fn
+from models import (Broadcasts, Outbox, Deliveries, Leases, SubscibedUsers,
+                    write_transaction)
+from helpers import logger, withConnection
+from broadcast import broadcast, broadcast_async, TELEGRAM_RATE_LIMIT
+from cluster import acquire_lease, instance_name
+
+# Broadcasts go through an outbox: plan_broadcast() puts a row per recipient
+# into the Outbox table before anything is sent, deliver() takes pending rows
+# in small batches and writes down what has become of every message with the
+# next batch. A sender that stops halfway (a restart, a crash) leaves the rest
+# pending, and the next deliver() of the broadcast goes on from there.
+# One sender at a time works on a broadcast: it holds the lease
+# 'broadcast:<id>' (see cluster.py) and renews it with every batch and every
+# third of its ttl in between, as the senders may wait out a RetryAfter longer
+# than the ttl. Another process or instance takes over once the lease expires.
+# Every message the Bot API has accepted gets a Deliveries row as soon as the
+# answer comes, in the same transaction that marks its Outbox row sent. The
+# next sender puts the rows left sending without one back to pending, so the
+# messages in flight when the sender stopped are sent again. The Bot API has
+# no idempotency keys: only a message accepted right before the sender died,
+# before its row was written, reaches the user twice
+
+LEASE_TTL = 120
+# Seconds, for the rate of /broadcasts
+RATE_WINDOW = 60
+
+
+# Returns the id of the broadcast with the key, planning it for every
+# subscriber if there is none yet. Finished broadcasts older than keep seconds
+# are forgotten
+def plan_broadcast(key, text, parse_mode=None, keep=30 * 24 * 60 * 60):
+    try:
+        with write_transaction():
+            row = Broadcasts.get_or_none(Broadcasts.key == key)
+            if row is not None:
+                return row.id
+            _forget_broadcasts(time() - keep)
+            broadcast_id = Broadcasts.insert(key=key, text=text, parse_mode=parse_mode,
+                                             created=time()).execute()
+            planned = Outbox.insert_from(
+                SubscibedUsers.select(Value(broadcast_id), SubscibedUsers.user, Value('pending')),
+                fields=[Outbox.broadcast, Outbox.user, Outbox.status]).execute()
+    except IntegrityError:
+        # Planned by another instance in the meantime
+        return Broadcasts.get(Broadcasts.key == key).id
+    logger.info('Broadcast %s planned for %d users', key, planned)
+    return broadcast_id
+
+
+def _forget_broadcasts(finished_before):
+    old = Broadcasts.select(Broadcasts.id).where(Broadcasts.finished < finished_before)
+    Outbox.delete().where(Outbox.broadcast.in_(old)).execute()
+    Deliveries.delete().where(Deliveries.broadcast.in_(old)).execute()
+    Broadcasts.delete().where(Broadcasts.finished < finished_before).execute()
+
+
+def unfinished_broadcasts():
+    return [row.id for row in Broadcasts.select(Broadcasts.id).where(
+        Broadcasts.finished.is_null()).order_by(Broadcasts.id)]
+
+
+# The sender side of a broadcast. start(), next_batch() and finish() run on
+# the thread (or executor) that feeds the senders, report() is called by the
+# senders. It writes down sent messages right away and keeps the other results
+# until the next batch
+class _Delivery:
+    def __init__(self, broadcast_id, lease_ttl=LEASE_TTL):
+        self.broadcast_id = broadcast_id
+        self.lease = f'broadcast:{broadcast_id}'
+        self.holder = instance_name()
+        self.lease_ttl = lease_ttl
+        self.text = None
+        self.parse_mode = None
+        self._results = []
+        self._lock = threading.Lock()
+
+    def _rows(self, *statuses):
+        return (Outbox.broadcast == self.broadcast_id) & Outbox.status.in_(statuses)
+
+    def _delivered(self):
+        return Deliveries.select(Deliveries.user).where(
+            Deliveries.broadcast == self.broadcast_id)
+
+    # Returns False if the broadcast is finished or another sender is at it
+    def start(self):
+        row = Broadcasts.get_or_none(Broadcasts.id == self.broadcast_id)
+        if row is None or row.finished is not None:
+            return False
+        if not acquire_lease(self.lease, self.holder, self.lease_ttl):
+            return False
+        self.text, self.parse_mode = row.text, row.parse_mode
+        with write_transaction():
+            Outbox.update(status='sent', updated=time()).where(
+                self._rows('sending') & Outbox.user.in_(self._delivered())).execute()
+            resent = Outbox.update(status='pending', updated=time()).where(
+                self._rows('sending')).execute()
+        if resent > 0:
+            logger.warning('Broadcast %s: %d messages were being sent when the previous ' +
+                           'sender stopped, they are sent again', row.key, resent)
+        logger.info('Broadcast %s is sent by %s', row.key, self.holder)
+        return True
+
+    # Returns False once another sender has taken the broadcast over
+    def renew(self):
+        if acquire_lease(self.lease, self.holder, self.lease_ttl):
+            return True
+        logger.warning('Broadcast %d has been taken over by another sender', self.broadcast_id)
+        return False
+
+    # Renews the lease until stopped is set, on a thread of its own
+    def keep_lease(self, stopped):
+        renew = withConnection(self.renew)
+        while not stopped.wait(self.lease_ttl / 3) and renew():
+            pass
+
+    def report(self, chat_id, status):
+        if status == 'sent':
+            try:
+                with write_transaction():
+                    self._write_sent([chat_id], time())
+                return
+            except DatabaseError as e:
+                logger.warning('Broadcast %d: %s, %s is written down with the next batch',
+                               self.broadcast_id, e, chat_id)
+        with self._lock:
+            self._results.append((chat_id, status))
+
+    def _write_sent(self, chat_ids, now):
+        Deliveries.insert_many([{'broadcast': self.broadcast_id, 'user': chat_id, 'sent': now}
+                                for chat_id in chat_ids]).on_conflict_ignore().execute()
+        Outbox.update(status='sent', updated=now).where(
+            self._rows('sending') & Outbox.user.in_(chat_ids)).execute()
+
+    # Writes down the results so far and takes the next size pending recipients.
+    # Returns nothing once there are no more or the lease has been lost
+    def next_batch(self, size):
+        with write_transaction():
+            self._flush()
+            if not self.renew():
+                return []
+            chat_ids = [row.user for row in Outbox.select(Outbox.user).where(
+                self._rows('pending')).order_by(Outbox.user).limit(size)]
+            if chat_ids:
+                Outbox.update(status='sending', updated=time()).where(
+                    self._rows('pending') & Outbox.user.in_(chat_ids)).execute()
+        return chat_ids
+
+    def _flush(self):
+        with self._lock:
+            results, self._results = self._results, []
+        by_status = defaultdict(list)
+        for chat_id, status in results:
+            by_status[status].append(chat_id)
+        now = time()
+        for status, chat_ids in by_status.items():
+            if status == 'sent':
+                self._write_sent(chat_ids, now)
+                continue
+            Outbox.update(status=status, updated=now).where(
+                self._rows('sending') & Outbox.user.in_(chat_ids)).execute()
+
+    # After the senders are done: marks the broadcast finished and unsubscribes
+    # the users who have blocked the bot, there is no point in notifying them
+    def finish(self):
+        with write_transaction():
+            self._flush()
+            if (not acquire_lease(self.lease, self.holder, self.lease_ttl) or
+                    Outbox.select().where(self._rows('pending', 'sending')).exists()):
+                return
+            Broadcasts.update(finished=time()).where(
+                Broadcasts.id == self.broadcast_id).execute()
+            Leases.delete().where(Leases.name == self.lease).execute()
+            blocked = SubscibedUsers.delete().where(SubscibedUsers.user.in_(
+                Outbox.select(Outbox.user).where(self._rows('blocked')))).execute()
+        if blocked > 0:
+            logger.info('Unsubscribed %d users who blocked the bot', blocked)
+
+
+# Sends the pending messages of the broadcast with broadcast.broadcast().
+# Returns its stats, or None if the broadcast is finished or being sent by
+# another sender
+def deliver(bot, broadcast_id, rate=TELEGRAM_RATE_LIMIT, workers=8, lease_ttl=LEASE_TTL):
+    delivery = _Delivery(broadcast_id, lease_ttl)
+    if not delivery.start():
+        return None
+
+    def chat_ids():
+        while True:
+            batch = delivery.next_batch(workers)
+            if not batch:
+                return
+            yield from batch
+
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=delivery.keep_lease, args=(stopped,),
+                                 name=f'broadcast-{broadcast_id}-lease', daemon=True)
+    heartbeat.start()
+    try:
+        # Only a batch is queued ahead of the senders, it's what is sent again
+        # if the process dies
+        stats = broadcast(bot, chat_ids(), delivery.text, rate=rate, workers=workers,
+                          parse_mode=delivery.parse_mode, report=withConnection(delivery.report),
+                          queue_size=workers)
+    finally:
+        stopped.set()
+        heartbeat.join()
+    delivery.finish()
+    return stats
+
+
+# The same for the asyncio runtime, the database is used on its executor
+async def deliver_async(runtime, broadcast_id, rate=TELEGRAM_RATE_LIMIT, workers=8,
+                        lease_ttl=LEASE_TTL):
+    delivery = _Delivery(broadcast_id, lease_ttl)
+    if not await runtime.run_sync(withConnection(delivery.start)):
+        return None
+
+    async def chat_ids():
+        while True:
+            batch = await runtime.run_sync(withConnection(delivery.next_batch), workers)
+            if not batch:
+                return
+            for chat_id in batch:
+                yield chat_id
+
+    async def report(chat_id, status):
+        await runtime.run_sync(withConnection(delivery.report), chat_id, status)
+
+    async def keep_lease():
+        while True:
+            await asyncio.sleep(lease_ttl / 3)
+            if not await runtime.run_sync(withConnection(delivery.renew)):
+                return
+
+    heartbeat = asyncio.ensure_future(keep_lease())
+    try:
+        stats = await broadcast_async(runtime.api, chat_ids(), delivery.text, rate=rate,
+                                      workers=workers, parse_mode=delivery.parse_mode,
+                                      report=report, queue_size=workers)
+    finally:
+        heartbeat.cancel()
+    await runtime.run_sync(withConnection(delivery.finish))
+    return stats
+
+
+# The last few broadcasts, the latest first: the row, the number of recipients
+# by status and the messages per second over the last RATE_WINDOW seconds and
+# since the start
+def broadcast_progress(limit=3):
+    now = time()
+    progress = []
+    for row in Broadcasts.select().order_by(Broadcasts.id.desc()).limit(limit):
+        counts = dict(Outbox.select(Outbox.status, fn.COUNT(Outbox.user)).where(
+            Outbox.broadcast == row.id).group_by(Outbox.status).tuples())
+        sent = Outbox.select(fn.COUNT(Outbox.user), fn.MAX(Outbox.updated)).where(
+            (Outbox.broadcast == row.id) & (Outbox.status == 'sent'))
+        recent = sent.where(Outbox.updated > now - RATE_WINDOW).scalar()
+        total, last = sent.scalar(as_tuple=True)
+        average = total / (last - row.created) if total and last > row.created else 0
+        window = min(RATE_WINDOW, now - row.created)
+        progress.append((row, counts, 0 if row.finished or window <= 0 else recent / window,
+                         average))
+    return progress
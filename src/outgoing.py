@@ -0,0 +1,146 @@
+import heapq
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from telegram.error import RetryAfter, TelegramError
+from helpers import logger
+from broadcast import TokenBucket, TELEGRAM_RATE_LIMIT
+
+MAX_RETRIES = 3
+
+
+# Messages of the handlers are queued and sent by a scheduler thread, so a
+# handler returns as soon as it has queued them instead of sleeping between
+# the parts of a long text (see _send_message()).
+# Every chat has a FIFO: its messages go one at a time and at most one per
+# chat_interval seconds, group_interval in groups (Telegram allows 20 a minute
+# there). All chats together send at most rate messages per second. Chats are
+# served in the order their next message is due, so a long /list N doesn't
+# hold up the answers to everyone else. Broadcasts have their own limit
+class MessageQueue:
+    def __init__(self, rate=TELEGRAM_RATE_LIMIT, chat_interval=1, group_interval=3, workers=4,
+                 max_queued=10000):
+        self.chat_interval = chat_interval
+        self.group_interval = group_interval
+        self.workers = workers
+        self.max_queued = max_queued
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        # chat_id: deque of [bot, message, attempts]. A chat stays here for an
+        # interval after its last message, so that the next one waits for it
+        self._chats = {}
+        # (due, seq, chat_id) of chats with nothing being sent right now
+        self._due = []
+        self._seq = itertools.count()
+        self._queued = 0
+        self._bucket = TokenBucket(rate, name='outgoing')
+        self._cond = threading.Condition()
+        self._executor = None
+        self._thread = None
+        self._stopping = False
+
+    def start(self):
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='outgoing')
+        self._thread = threading.Thread(target=self._schedule, name='outgoing', daemon=True)
+        self._thread.start()
+        return self
+
+    # Waits up to timeout seconds for the queued messages to go out
+    def stop(self, timeout=10):
+        deadline = monotonic() + timeout
+        with self._cond:
+            while self._queued > 0 and monotonic() < deadline:
+                self._cond.wait(deadline - monotonic())
+            self._stopping = True
+            self._cond.notify_all()
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+        if self._queued > 0:
+            logger.warning('%d queued messages were not sent', self._queued)
+
+    def __len__(self):
+        return self._queued
+
+    # Thread safe, returns right away. Returns False if the queue is full and
+    # the message is dropped
+    def send(self, bot, chat_id, text, **kwargs):
+        with self._cond:
+            if self._queued >= self.max_queued:
+                self.dropped += 1
+                logger.warning('Outgoing queue is full, a message to %s is dropped', chat_id)
+                return False
+            messages = self._chats.get(chat_id)
+            if messages is None:
+                messages = self._chats[chat_id] = deque()
+                self._push(chat_id, monotonic())
+            messages.append([bot, {'chat_id': chat_id, 'text': text, **kwargs}, 0])
+            self._queued += 1
+            self._cond.notify_all()
+        return True
+
+    def metrics(self):
+        return {'queued': self._queued, 'sent': self.sent, 'failed': self.failed,
+                'dropped': self.dropped}
+
+    # Must be called with the lock held
+    def _push(self, chat_id, due):
+        heapq.heappush(self._due, (due, next(self._seq), chat_id))
+
+    def _interval(self, chat_id):
+        return self.group_interval if chat_id < 0 else self.chat_interval
+
+    def _schedule(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopping:
+                        return
+                    now = monotonic()
+                    if self._due and self._due[0][0] <= now:
+                        _, _, chat_id = heapq.heappop(self._due)
+                        if self._chats[chat_id]:
+                            break
+                        # Nothing more came during the interval
+                        del self._chats[chat_id]
+                        continue
+                    self._cond.wait(self._due[0][0] - now if self._due else None)
+            self._bucket.acquire()
+            self._executor.submit(self._deliver, chat_id)
+
+    # Sends the first message of the chat, which is out of _due meanwhile
+    def _deliver(self, chat_id):
+        with self._cond:
+            item = self._chats[chat_id][0]
+        bot, message, attempts = item
+        retry_after = None
+        try:
+            bot.send_message(**message)
+            self._bucket.recover()
+            sent = True
+        except RetryAfter as e:
+            self._bucket.throttle(e.retry_after)
+            retry_after = e.retry_after
+            sent = False
+        except TelegramError as e:
+            logger.warning('Message to %s failed: %s', chat_id, e)
+            sent = False
+        except Exception as e:
+            logger.exception(e)
+            sent = False
+
+        with self._cond:
+            item[2] += 1
+            if retry_after is not None and item[2] < MAX_RETRIES:
+                self._push(chat_id, monotonic() + retry_after)
+            else:
+                if sent:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self._chats[chat_id].popleft()
+                self._queued -= 1
+                self._push(chat_id, monotonic() + self._interval(chat_id))
+            self._cond.notify_all()
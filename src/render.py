@@ -0,0 +1,112 @@
+import threading
+from collections import OrderedDict, namedtuple
+from telegram import InlineKeyboardButton
+from models import SuggestedTopics, ArchivedTopics
+from helpers import _format_topic, _pack_messages
+
+
+# Topics are shown in pages that must fit into one message (4096 characters)
+# because paging edits the message: 8 topics with a 140 character title and
+# a body cut to 250 characters do. The 📖 button of a cut topic sends the whole
+# of it, see show_topic()
+PAGE_SIZE = 8
+BODY_PREVIEW = 250
+
+# button and checked are the rows of the ballot, with 📖 next to the title of a
+# cut topic. more is the 📖 row of /list, None if the body is shown in full
+Rendered = namedtuple('Rendered', ['uid', 'html', 'button', 'checked', 'more'])
+
+
+def _preview(body):
+    return body if len(body) <= BODY_PREVIEW else body[:BODY_PREVIEW].rstrip() + '…'
+
+
+# Rendered topics: HTML and ballot buttons of live topics and the messages of
+# archived episodes. The topic set changes a few times a day, on propose,
+# delete and archive, and every change must call invalidate(), which bumps the
+# version and drops everything. Vote counts aren't cached, they are added on
+# top of the topic HTML on every /list.
+# Something rendered from the data of an older version is never stored, so a
+# /vote that races with /archive can't put the old topics back
+class RenderCache:
+    def __init__(self, enabled=True, max_episodes=64):
+        self.enabled = enabled
+        self.max_episodes = max_episodes
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        # uid: Rendered
+        self._topics = {}
+        # episode: messages, the least recently used episodes are dropped
+        self._episodes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._topics = {}
+            self._episodes.clear()
+
+    # Returns Rendered of the topics in the same order. The button rows are
+    # shared, don't change them. A topic deleted meanwhile is skipped
+    def topics(self, uids):
+        with self._lock:
+            version = self.version
+            topics = self._topics if self.enabled else {}
+            missing = [uid for uid in uids if uid not in topics]
+            self.hits += len(uids) - len(missing)
+            self.misses += len(missing)
+
+        if len(missing) > 0:
+            rendered = {}
+            for topic in SuggestedTopics.select(
+                    SuggestedTopics.uid, SuggestedTopics.title, SuggestedTopics.username,
+                    SuggestedTopics.body).where(SuggestedTopics.uid.in_(missing)):
+                cut = len(topic.body) > BODY_PREVIEW
+                more = [InlineKeyboardButton(text='📖', callback_data=f'topic_{topic.uid}')] \
+                    if cut else []
+                rendered[topic.uid] = Rendered(
+                    topic.uid,
+                    _format_topic(topic.title, topic.username, _preview(topic.body)),
+                    [InlineKeyboardButton(text=topic.title, callback_data=str(topic.uid))] + more,
+                    [InlineKeyboardButton(text='✅ ' + topic.title,
+                                          callback_data=str(topic.uid))] + more,
+                    [InlineKeyboardButton(text='📖 ' + topic.title,
+                                          callback_data=f'topic_{topic.uid}')] if cut else None)
+            with self._lock:
+                if self.enabled and version == self.version:
+                    self._topics.update(rendered)
+            topics = {**topics, **rendered}
+
+        return [topics[uid] for uid in uids if uid in topics]
+
+    # Packed messages of /list N. Archived topics don't change, only /archive
+    # may add more of them to the episode
+    def episode(self, episode):
+        with self._lock:
+            messages = self._episodes.get(episode) if self.enabled else None
+            if messages is not None:
+                self._episodes.move_to_end(episode)
+            version = self.version
+            self._count(messages is not None)
+        if messages is None:
+            messages = _pack_messages([
+                _format_topic(topic.title, topic.username, topic.body, votes=topic.votes)
+                for topic in ArchivedTopics.select().where(
+                    ArchivedTopics.episode == episode).order_by(ArchivedTopics.votes.desc())])
+            with self._lock:
+                if self.enabled and version == self.version:
+                    self._episodes[episode] = messages
+                    while len(self._episodes) > self.max_episodes:
+                        self._episodes.popitem(last=False)
+        return messages
+
+    def metrics(self):
+        return {'version': self.version, 'hits': self.hits, 'misses': self.misses}
+
+    # Must be called with the lock held
+    def _count(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
@@ -0,0 +1,146 @@
+import re
+import html
+from time import perf_counter, time
+from peewee import SqliteDatabase
+from models import db, Searches, write_transaction
+
+# Full-text search over live and archived topics with SQLite FTS5.
+# Both indexes are external content tables: they store only the index and read
+# title and body from the topic tables, which keep them in sync with triggers,
+# so archive, propose and delete don't have to know about search at all
+INDEXES = {
+    # index: (content table, its rowid column)
+    'suggestedtopics_search': ('suggestedtopics', 'uid'),
+    'archivedtopics_search': ('archivedtopics', 'id'),
+}
+# A match in the title counts ten times more than a match in the body
+TITLE_WEIGHT = 10.0
+BODY_WEIGHT = 1.0
+_TERM = re.compile(r'\w+')
+
+
+def search_supported():
+    return isinstance(db.obj, SqliteDatabase)
+
+
+def create_search_index():
+    if not search_supported():
+        return
+    for index, (table, rowid) in INDEXES.items():
+        # unicode61 folds case of Cyrillic as well, prefixes make "тест*" fast
+        db.execute_sql(f'CREATE VIRTUAL TABLE IF NOT EXISTS "{index}" USING fts5(' +
+                       f'title, body, content="{table}", content_rowid="{rowid}", ' +
+                       'tokenize="unicode61 remove_diacritics 2", prefix="2 3")')
+        db.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "{index}_insert" ' +
+                       f'AFTER INSERT ON "{table}" BEGIN ' +
+                       f'INSERT INTO "{index}" (rowid, title, body) ' +
+                       f'VALUES (new."{rowid}", new.title, new.body); END')
+        db.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "{index}_delete" ' +
+                       f'AFTER DELETE ON "{table}" BEGIN ' +
+                       f'INSERT INTO "{index}" ("{index}", rowid, title, body) ' +
+                       f'VALUES (\'delete\', old."{rowid}", old.title, old.body); END')
+        # Not on every update: vote counters change all the time
+        db.execute_sql(f'CREATE TRIGGER IF NOT EXISTS "{index}_update" ' +
+                       f'AFTER UPDATE OF title, body ON "{table}" BEGIN ' +
+                       f'INSERT INTO "{index}" ("{index}", rowid, title, body) ' +
+                       f'VALUES (\'delete\', old."{rowid}", old.title, old.body); ' +
+                       f'INSERT INTO "{index}" (rowid, title, body) ' +
+                       f'VALUES (new."{rowid}", new.title, new.body); END')
+    rebuild_search_index()
+
+
+# Rebuilds both indexes from the topic tables and merges their segments.
+# Returns the number of indexed topics and the elapsed seconds
+def rebuild_search_index():
+    started = perf_counter()
+    topics = 0
+    for index, (table, _) in INDEXES.items():
+        db.execute_sql(f'INSERT INTO "{index}" ("{index}") VALUES (\'rebuild\')')
+        db.execute_sql(f'INSERT INTO "{index}" ("{index}") VALUES (\'optimize\')')
+        topics += db.execute_sql(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+    return topics, perf_counter() - started
+
+
+# Turn the words of a search into an FTS5 query: every word must be present, as a prefix,
+# so that "тест" finds "тесты" and "тестирование". Quoting every word keeps FTS5
+# syntax (AND, NEAR, *, ") out of user hands. Returns None if there are no words
+def _match_query(words):
+    if len(words) == 0:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+# A few words of the body around the first match, as HTML with the matches in bold
+def _snippet(body, words, size=12):
+    tokens = body.split()
+    matches = [i for i, token in enumerate(tokens)
+               if any(token.lower().lstrip('«("\'').startswith(word) for word in words)]
+    start = max(0, matches[0] - size // 3) if len(matches) > 0 else 0
+    snippet = [f'<b>{html.escape(token)}</b>' if i in matches else html.escape(token)
+               for i, token in enumerate(tokens[start:start + size], start=start)]
+    return ('… ' if start > 0 else '') + ' '.join(snippet) + \
+        (' …' if start + size < len(tokens) else '')
+
+
+# Returns the id of the terms for the page buttons of a search, the same one
+# every time the same terms are searched for
+def save_search(terms):
+    with write_transaction():
+        Searches.insert(terms=terms, used=time()).on_conflict(
+            conflict_target=[Searches.terms], preserve=[Searches.used]).execute()
+        return Searches.get(Searches.terms == terms).id
+
+
+# Returns the terms of the search, None if they have been forgotten
+def saved_search(search_id):
+    row = Searches.get_or_none(Searches.id == search_id)
+    return row.terms if row is not None else None
+
+
+# Forget the terms nobody has searched for in age seconds, their buttons say
+# that the search is outdated
+def forget_searches(context=None, age=30 * 24 * 60 * 60):
+    with write_transaction():
+        Searches.delete().where(Searches.used < time() - age).execute()
+
+
+# Returns up to limit hits starting from offset, best first, and whether there
+# are more of them. Every hit has title, snippet (HTML), username, votes and
+# episode, which is None for topics that haven't been archived yet
+def search_topics(terms, offset=0, limit=10):
+    words = _TERM.findall(terms.lower())
+    query = _match_query(words)
+    if query is None:
+        return [], False
+
+    # Every match is ranked, the oldest archived topics too. ORDER BY with a LIMIT
+    # keeps only the best rows while bm25() scores the matches, a page at offset
+    # needs at most offset + limit + 1 of each index. It is faster than ORDER BY
+    # rank, for which FTS5 sorts all the matches itself
+    top = offset + limit + 1
+    ranked = ' UNION ALL '.join(
+        f'SELECT * FROM (SELECT \'{index}\' AS source, rowid, ' +
+        f'bm25("{index}", {TITLE_WEIGHT}, {BODY_WEIGHT}) AS score FROM "{index}" ' +
+        f'WHERE "{index}" MATCH ? ORDER BY score LIMIT ?)'
+        for index in INDEXES)
+    # One more row than asked to know whether there is a next page without COUNT(*)
+    page = db.execute_sql(ranked + ' ORDER BY score LIMIT ? OFFSET ?',
+                          (query, top) * len(INDEXES) + (limit + 1, offset)).fetchall()
+    more = len(page) > limit
+    page = page[:limit]
+
+    # Topics only for the rows on the page. FTS5 snippet() would need the MATCH
+    # again for every row, which costs as much as the search itself
+    hits = {}
+    for index, (table, rowid) in INDEXES.items():
+        rowids = [row for source, row, _ in page if source == index]
+        if len(rowids) == 0:
+            continue
+        episode = 'episode' if table == 'archivedtopics' else 'NULL'
+        cursor = db.execute_sql(
+            f'SELECT "{rowid}", title, body, username, votes, {episode} FROM "{table}" ' +
+            f'WHERE "{rowid}" IN ({", ".join("?" * len(rowids))})', rowids)
+        for row, title, body, username, votes, episode in cursor.fetchall():
+            hits[(index, row)] = {'title': title, 'snippet': _snippet(body, words),
+                                  'username': username, 'votes': votes, 'episode': episode}
+    return [hits[(source, row)] for source, row, _ in page if (source, row) in hits], more
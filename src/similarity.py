@@ -0,0 +1,129 @@
+import re
+import struct
+import hashlib
+import threading
+from functools import lru_cache
+from models import SuggestedTopics, ArchivedTopics
+from peewee import fn
+
+# Words are cut to this many letters, so that different forms of a Russian word
+# ("базы", "базами", "базах") count as the same one
+STEM_LENGTH = 5
+# Shorter words are mostly prepositions and conjunctions
+MIN_WORD_LENGTH = 3
+# MinHash signature of NUM_PERM values split into BANDS bands for LSH. Topics
+# that share all the values of at least one band become candidates. With 16 bands
+# of 4 values, pairs with Jaccard similarity 0.5 are found with probability 0.65
+# and 0.7 with 0.99
+NUM_PERM = 64
+BANDS = 16
+# NUM_PERM independent 32-bit hashes of a shingle are cut from one SHAKE digest,
+# instead of NUM_PERM rounds of (a * x + b) % p in Python
+_HASHES = struct.Struct(f'>{NUM_PERM}I')
+_WORD = re.compile(r'\w+')
+
+
+def _shingles(title, body):
+    return {word[:STEM_LENGTH] for word in _WORD.findall((title + ' ' + body).lower())
+            if len(word) >= MIN_WORD_LENGTH}
+
+
+# Words repeat a lot from topic to topic
+@lru_cache(maxsize=100000)
+def _hashes(shingle):
+    return _HASHES.unpack(hashlib.shake_128(shingle.encode()).digest(_HASHES.size))
+
+
+def _signature(shingles):
+    if len(shingles) == 0:
+        return None
+    # The minimum of every hash function over all the shingles
+    return tuple(map(min, zip(*map(_hashes, shingles))))
+
+
+# Live and recently archived topics indexed for near-duplicate lookups:
+# similar(title, body) returns topics whose words mostly match, even if the
+# text was reworded or the words reordered. Everything is in memory, the index
+# is loaded once and then updated on propose, delete and archive
+class DuplicateIndex:
+    def __init__(self, threshold=0.5, archived_episodes=20):
+        self.threshold = threshold
+        self.archived_episodes = archived_episodes
+        # key: (signature, title, episode), episode is None for live topics
+        self._topics = {}
+        self._buckets = [{} for _ in range(BANDS)]
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self._topics.clear()
+            self._buckets = [{} for _ in range(BANDS)]
+        for topic in SuggestedTopics.select(SuggestedTopics.uid, SuggestedTopics.title,
+                                            SuggestedTopics.body):
+            self.add(topic.uid, topic.title, topic.body)
+        last = ArchivedTopics.select(fn.MAX(ArchivedTopics.episode)).scalar()
+        if last is None:
+            return
+        for topic in ArchivedTopics.select(ArchivedTopics.id, ArchivedTopics.title,
+                                           ArchivedTopics.body, ArchivedTopics.episode).where(
+                ArchivedTopics.episode > last - self.archived_episodes):
+            self.add(('archived', topic.id), topic.title, topic.body, topic.episode)
+
+    def add(self, key, title, body, episode=None):
+        signature = _signature(_shingles(title, body))
+        if signature is None:
+            return
+        with self._lock:
+            self._remove(key)
+            self._topics[key] = (signature, title, episode)
+            for band, bucket in zip(self._bands(signature), self._buckets):
+                bucket.setdefault(band, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    # Live topics become topics of the episode, the oldest episodes are forgotten
+    def archive(self, episode):
+        with self._lock:
+            for key, (signature, title, topic_episode) in list(self._topics.items()):
+                if topic_episode is None:
+                    self._topics[key] = (signature, title, episode)
+                elif topic_episode <= episode - self.archived_episodes:
+                    self._remove(key)
+
+    # Returns (similarity, title, episode) of up to limit most similar topics
+    def similar(self, title, body, limit=3):
+        signature = _signature(_shingles(title, body))
+        if signature is None:
+            return []
+        with self._lock:
+            candidates = set()
+            for band, bucket in zip(self._bands(signature), self._buckets):
+                candidates.update(bucket.get(band, ()))
+            found = []
+            for key in candidates:
+                other, other_title, episode = self._topics[key]
+                similarity = sum(a == b for a, b in zip(signature, other)) / NUM_PERM
+                if similarity >= self.threshold:
+                    found.append((similarity, other_title, episode))
+        return sorted(found, key=lambda topic: topic[0], reverse=True)[:limit]
+
+    def __len__(self):
+        return len(self._topics)
+
+    def _bands(self, signature):
+        rows = NUM_PERM // BANDS
+        return [signature[i:i + rows] for i in range(0, NUM_PERM, rows)]
+
+    # Must be called with the lock held
+    def _remove(self, key):
+        topic = self._topics.pop(key, None)
+        if topic is None:
+            return
+        for band, bucket in zip(self._bands(topic[0]), self._buckets):
+            keys = bucket.get(band)
+            if keys is not None:
+                keys.discard(key)
+                if len(keys) == 0:
+                    del bucket[band]
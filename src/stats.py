@@ -0,0 +1,178 @@
+from datetime import datetime
+from time import perf_counter
+from peewee import fn, Case, chunked
+from models import ArchivedTopics, EpisodeStats, YearStats, ProposerStats
+
+# Aggregates of the archive behind /stats. _archive_topics() counts every
+# archived episode in the same transaction, so /stats reads a few rows by
+# primary key or index instead of scanning ArchivedTopics on every request.
+# Everything is counted per year of archiving and for all the time (year 0),
+# episodes archived before the archive dates were kept only count for all the
+# time. rebuild_stats() counts the whole archive again (/restats)
+
+ALL_TIME = 0
+COUNTS = ('topics', 'votes', 'voted')
+
+
+def _years(archived):
+    if archived is None:
+        return (ALL_TIME,)
+    return (ALL_TIME, datetime.utcfromtimestamp(archived).year)
+
+
+def _topics(where):
+    topic = ArchivedTopics
+    return (topic.select(topic.user,
+                         fn.MAX(topic.username).alias('username'),
+                         fn.COUNT(topic.id).alias('topics'),
+                         fn.SUM(topic.votes).alias('votes'),
+                         fn.SUM(Case(None, ((topic.votes > 0, 1),), 0)).alias('voted'),
+                         fn.MAX(topic.votes).alias('best'))
+            .where(where).group_by(topic.user).namedtuples())
+
+
+# Adds the counts (and best votes) of rows to the rows of model with the keys,
+# creates the missing ones. Returns the keys of the created rows
+def _add(model, key_field, rows, year=None):
+    keys = [row[key_field] for row in rows]
+    query = model.select().where(getattr(model, key_field).in_(keys))
+    if year is not None:
+        query = query.where(model.year == year)
+    existing = {getattr(row, key_field): row for row in query}
+    created = []
+    for row in rows:
+        old = existing.get(row[key_field])
+        if old is None:
+            created.append({**row, **({} if year is None else {'year': year})})
+            continue
+        update = {getattr(model, name): getattr(model, name) + row[name] for name in row
+                  if name in COUNTS or name in ('episodes', 'proposers')}
+        if 'best' in row:
+            update[model.best] = max(old.best, row['best'])
+        if 'username' in row:
+            update[model.username] = row['username']
+        where = getattr(model, key_field) == row[key_field]
+        if year is not None:
+            where &= model.year == year
+        model.update(update).where(where).execute()
+    if created:
+        model.insert_many(created).execute()
+    return {row[key_field] for row in created}
+
+
+# Counts the topics of episode which match where (ArchivedTopics), archived at
+# archived. An episode archived in several parts counts for the year of the first
+def count_archived(episode, archived, where):
+    proposers = list(_topics(where))
+    if not proposers:
+        return
+    first = EpisodeStats.get_or_none(EpisodeStats.episode == episode)
+    if first is not None and first.archived is not None:
+        archived = first.archived
+
+    # Only the topics of the episode, by the episode index
+    totals = list(_topics(ArchivedTopics.episode == episode))
+    EpisodeStats.delete().where(EpisodeStats.episode == episode).execute()
+    EpisodeStats.insert(episode=episode,
+                        topics=sum(row.topics for row in totals),
+                        votes=sum(row.votes for row in totals),
+                        voted=sum(row.voted for row in totals),
+                        best=max(row.best for row in totals),
+                        proposers=len(totals),
+                        archived=archived).execute()
+
+    for year in _years(archived):
+        new = _add(ProposerStats, 'user',
+                   [{'user': row.user, 'username': row.username, 'topics': row.topics,
+                     'votes': row.votes, 'voted': row.voted, 'best': row.best}
+                    for row in proposers], year)
+        _add(YearStats, 'year',
+             [{'year': year,
+               'episodes': 0 if first is not None else 1,
+               'topics': sum(row.topics for row in proposers),
+               'votes': sum(row.votes for row in proposers),
+               'voted': sum(row.voted for row in proposers),
+               'proposers': len(new)}])
+
+
+# Counts the whole archive again, returns the number of episodes and the elapsed
+# seconds. The same as count_archived() for every episode, in one pass over the
+# archive grouped by episode and proposer
+def rebuild_stats():
+    started = perf_counter()
+    for model in (EpisodeStats, YearStats, ProposerStats):
+        model.delete().execute()
+    topic = ArchivedTopics
+    rows = list(_topics(True).select_extend(topic.episode,
+                                            fn.MIN(topic.archived).alias('archived'))
+                .group_by(topic.episode, topic.user).order_by(topic.episode))
+
+    first = {}
+    for row in rows:
+        if row.archived is not None:
+            first[row.episode] = min(first.get(row.episode, row.archived), row.archived)
+    episodes = {}
+    years = {}
+    proposers = {}
+    for row in rows:
+        archived = first.get(row.episode)
+        episode = episodes.setdefault(row.episode, {
+            'episode': row.episode, 'topics': 0, 'votes': 0, 'voted': 0, 'best': 0,
+            'proposers': 0, 'archived': archived})
+        for year in _years(archived):
+            if year not in years:
+                years[year] = {'year': year, 'episodes': 0, 'topics': 0, 'votes': 0,
+                               'voted': 0, 'proposers': 0}
+            proposer = proposers.get((row.user, year))
+            if proposer is None:
+                proposer = proposers[row.user, year] = {
+                    'user': row.user, 'year': year, 'topics': 0, 'votes': 0, 'voted': 0,
+                    'best': 0}
+                years[year]['proposers'] += 1
+            proposer['username'] = row.username
+            for counts in (proposer, years[year]):
+                for name in COUNTS:
+                    counts[name] += getattr(row, name)
+            proposer['best'] = max(proposer['best'], row.best)
+        for name in COUNTS:
+            episode[name] += getattr(row, name)
+        episode['best'] = max(episode['best'], row.best)
+        episode['proposers'] += 1
+    for episode in episodes.values():
+        for year in _years(episode['archived']):
+            years[year]['episodes'] += 1
+
+    for model, values in ((EpisodeStats, episodes), (YearStats, years),
+                          (ProposerStats, proposers)):
+        for batch in chunked(list(values.values()), 100):
+            model.insert_many(batch).execute()
+    return len(episodes), perf_counter() - started
+
+
+def year_stats(year=ALL_TIME):
+    return YearStats.get_or_none(YearStats.year == year)
+
+
+# Years with anything archived, the latest first
+def stats_years():
+    return list(YearStats.select().where(YearStats.year != ALL_TIME).order_by(
+        YearStats.year.desc()))
+
+
+def episode_stats(episode):
+    return EpisodeStats.get_or_none(EpisodeStats.episode == episode)
+
+
+def recent_episodes(limit=5):
+    return list(EpisodeStats.select().order_by(EpisodeStats.episode.desc()).limit(limit))
+
+
+def top_proposers(year=ALL_TIME, limit=5):
+    return list(ProposerStats.select().where(ProposerStats.year == year).order_by(
+        ProposerStats.votes.desc(), ProposerStats.topics.desc()).limit(limit))
+
+
+# The most voted topics of episode, by the episode index
+def best_topics(episode, limit=3):
+    return list(ArchivedTopics.select(ArchivedTopics.title, ArchivedTopics.votes).where(
+        ArchivedTopics.episode == episode).order_by(ArchivedTopics.votes.desc()).limit(limit))
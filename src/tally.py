@@ -0,0 +1,236 @@
+import threading
+from peewee import fn
+from models import db, SuggestedTopics, Votes
+from helpers import _ranked_page
+
+METHODS = ('count', 'borda', 'schulze')
+# Pairs of topics counted at once when the ballots are loaded, 64MB of indexes
+MAX_PAIRS = 4 * 1024 * 1024
+
+
+# Tally engines rank the current topics for /list. The default one counts the
+# votes, the ranked ones read the ballot of a user as the topics they have voted
+# for in the order of the taps: the first one is the most wanted, and every
+# voted topic is preferred to the ones not voted for.
+# Engines are told about every change: vote(), add() of a proposed topic,
+# clear() after /archive and load() after anything else (/delete, /recount,
+# another instance). page() returns ([(uid, votes, place)], has_prev, has_next)
+# for the cursors made by cursor() of the rows it has returned, place is None
+# for the count. Cursors of all the engines are <key>_<uid>, which is what the
+# page buttons of /list take
+class CountTally:
+    method = 'count'
+
+    # SuggestedTopics.votes is kept by _toggle_vote(), nothing to do here
+    def load(self):
+        pass
+
+    def vote(self, user, uid, voted):
+        pass
+
+    def add(self, uid):
+        pass
+
+    def clear(self):
+        pass
+
+    def cursor(self, row):
+        uid, votes, _ = row
+        return f'{votes}_{uid}'
+
+    def page(self, size, after=None, before=None):
+        rows, has_prev, has_next = _ranked_page(size, _count_cursor(after),
+                                                _count_cursor(before))
+        return [(uid, votes, None) for uid, votes in rows], has_prev, has_next
+
+
+# A cursor of a ranked engine (place_uid) after a restart with the count is
+# taken for votes_uid, the page is somewhere in the middle
+def _count_cursor(cursor):
+    if cursor is None or '_' not in cursor:
+        return None
+    votes, uid = cursor.split('_')
+    return int(votes), int(uid)
+
+
+# d[i, j] of the ballots (lists of rows of the matrix) is the number of users
+# who prefer topic i to topic j: every topic of a ballot is preferred to all the
+# topics but itself and the ones above it, so d[i, j] is the number of ballots
+# with i minus the number of those with j at or above i. The pairs are counted
+# with one bincount for all the ballots of the same length
+def _pairwise(np, ballots, n):
+    votes = np.zeros(n, np.int64)
+    at_or_above = np.zeros(n * n, np.int64)
+    by_length = {}
+    for ballot in ballots:
+        by_length.setdefault(len(ballot), []).append(ballot)
+    by_length.pop(0, None)
+    for length, group in by_length.items():
+        above, below = np.triu_indices(length)
+        step = max(1, MAX_PAIRS // len(above))
+        for start in range(0, len(group), step):
+            chunk = np.array(group[start:start + step], np.int64)
+            votes += np.bincount(chunk.ravel(), minlength=n)
+            at_or_above += np.bincount((chunk[:, below] * n + chunk[:, above]).ravel(),
+                                       minlength=n * n)
+    return votes[:, None] - at_or_above.reshape(n, n), votes
+
+
+# Ranked engines keep the matrix of pairwise preferences of the current topics.
+# Loading the ballots is vectorized, a vote changes one row and column of the
+# matrix in place. The ranking is computed from it on the first /list after a
+# change: by the score of the method, then by votes like the count
+class PairwiseTally:
+    def __init__(self):
+        # Requires numpy, which is not installed by default
+        import numpy
+        self._np = numpy
+        self._lock = threading.Lock()
+        self._reset()
+
+    # Must be called with the lock held
+    def _reset(self, capacity=16):
+        # row of the matrix: uid and back
+        self._uids = []
+        self._rows = {}
+        # user: rows of the topics they voted for, the most preferred first
+        self._ballots = {}
+        self._d = self._np.zeros((capacity, capacity), self._np.int32)
+        self._votes = self._np.zeros(capacity, self._np.int32)
+        # [(uid, votes)] in the order of /list and uid: place in it
+        self._ranking = None
+        self._places = {}
+
+    # Reads the ballots under the lock, so that no vote is counted twice or lost
+    # meanwhile. Votes wait for it, it takes tens of milliseconds for thousands of users
+    def load(self):
+        with self._lock:
+            uids = [uid for uid, in SuggestedTopics.select(SuggestedTopics.uid).order_by(
+                SuggestedTopics.uid).tuples()]
+            self._reset(max(16, 2 * len(uids)))
+            self._uids = uids
+            self._rows = {uid: row for row, uid in enumerate(uids)}
+            # Votes cast before the order was stored go in the order of uids
+            for user, uid in db.execute(Votes.select(Votes.user, Votes.topic).order_by(
+                    Votes.user, fn.COALESCE(Votes.created, 0), Votes.topic)):
+                if uid in self._rows:
+                    self._ballots.setdefault(user, []).append(self._rows[uid])
+            n = len(uids)
+            self._d[:n, :n], self._votes[:n] = _pairwise(self._np, self._ballots.values(), n)
+
+    def vote(self, user, uid, voted):
+        with self._lock:
+            row = self._rows.get(uid)
+            if row is None:
+                return
+            ballot = self._ballots.setdefault(user, [])
+            d, n = self._d, len(self._uids)
+            if voted and row not in ballot:
+                # It stays below the topics of the ballot and goes above the rest
+                d[row, :n] += 1
+                d[row, ballot] -= 1
+                d[row, row] -= 1
+                ballot.append(row)
+                self._votes[row] += 1
+            elif not voted and row in ballot:
+                # Not above the rest anymore, and the topics below it go above it
+                position = ballot.index(row)
+                d[row, :n] -= 1
+                d[row, row] += 1
+                d[row, ballot[:position]] += 1
+                d[ballot[position + 1:], row] += 1
+                del ballot[position]
+                self._votes[row] -= 1
+            if len(ballot) == 0:
+                del self._ballots[user]
+            self._ranking = None
+
+    def add(self, uid):
+        with self._lock:
+            if uid in self._rows:
+                return
+            n = len(self._uids)
+            if n == len(self._votes):
+                d, votes = self._d, self._votes
+                self._d = self._np.zeros((2 * n, 2 * n), self._np.int32)
+                self._d[:n, :n] = d
+                self._votes = self._np.zeros(2 * n, self._np.int32)
+                self._votes[:n] = votes
+            # Nobody has voted for it, every voted topic is preferred to it
+            self._d[n, :n + 1] = 0
+            self._d[:n, n] = self._votes[:n]
+            self._votes[n] = 0
+            self._uids.append(uid)
+            self._rows[uid] = n
+            self._ranking = None
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+    # Returns [(uid, votes)] in the order of /list. Must be called with the lock held
+    def _ranked(self):
+        if self._ranking is None:
+            n = len(self._uids)
+            scores = self.scores(self._d[:n, :n]).tolist()
+            votes = self._votes[:n].tolist()
+            order = sorted(range(n), key=lambda row: (scores[row], votes[row], self._uids[row]),
+                           reverse=True)
+            self._ranking = [(self._uids[row], votes[row]) for row in order]
+            self._places = {uid: place for place, (uid, _) in enumerate(self._ranking)}
+        return self._ranking
+
+    def ranking(self):
+        with self._lock:
+            return list(self._ranked())
+
+    # place_uid, the place is only there for the format, the uid is looked up
+    def cursor(self, row):
+        uid, _, place = row
+        return f'{place}_{uid}'
+
+    def page(self, size, after=None, before=None):
+        with self._lock:
+            ranking, places = self._ranked(), self._places
+        cursor = after if after is not None else before
+        # A cursor of the count (votes_uid) after a restart is fine as well
+        place = places.get(int(cursor.split('_')[-1])) if cursor is not None else None
+        if place is None:
+            start, end = 0, size
+        elif after is not None:
+            start, end = place + 1, place + 1 + size
+        else:
+            start, end = max(0, place - size), place
+        end = min(end, len(ranking))
+        return ([(uid, votes, start + i + 1) for i, (uid, votes) in enumerate(ranking[start:end])],
+                start > 0, end < len(ranking))
+
+
+# A topic gets a point for every topic it is ranked above in a ballot, the ones
+# not voted for included
+class BordaTally(PairwiseTally):
+    method = 'borda'
+
+    def scores(self, d):
+        return d.sum(axis=1)
+
+
+# The number of topics a topic beats by the strongest path of pairwise wins
+# (the Schulze method), the paths are widened for all the pairs at once through
+# every topic in turn
+class SchulzeTally(PairwiseTally):
+    method = 'schulze'
+
+    def scores(self, d):
+        np = self._np
+        strength = np.where(d > d.T, d, 0)
+        for k in range(len(strength)):
+            np.maximum(strength, np.minimum(strength[:, k, None], strength[k]), out=strength)
+        return (strength > strength.T).sum(axis=1)
+
+
+ENGINES = {'count': CountTally, 'borda': BordaTally, 'schulze': SchulzeTally}
+
+
+def create_tally(method='count'):
+    return ENGINES[method]()
@@ -0,0 +1,56 @@
+# The tests drive the handlers, engines and jobs with the tools of the
+# benchmarks (bench/): a throwaway SQLite database, a fake Bot and a local
+# Bot API stub the real Updater or asyncio runtime talk to
+#
+#   python -m pytest tests
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bench'))
+
+from common import temp_db, load_config  # noqa: E402
+from fakes import FakeBot  # noqa: E402
+from stub_api import StubApi  # noqa: E402
+from runtimes import start  # noqa: E402
+from tally import CountTally  # noqa: E402
+import devzen_bot  # noqa: E402
+
+ADMIN = 1
+
+
+@pytest.fixture(autouse=True)
+def config():
+    devzen_bot.config = load_config(f'adminIds: [{ADMIN}]\nbotApiToken: "123:stub"\n' +
+                                    'drafts:\n  persistent: false\n' +
+                                    'flood:\n  enabled: false\n' +
+                                    'broadcast:\n  rate: 100000\n  workers: 4\n')
+    return devzen_bot.config
+
+
+@pytest.fixture
+def database():
+    with temp_db() as database:
+        devzen_bot.render_cache.invalidate()
+        devzen_bot.tally = CountTally()
+        yield database
+
+
+@pytest.fixture
+def bot():
+    return FakeBot(latency=0, rate_limit=None)
+
+
+# Starts the bot on the runtime against a Bot API stub, returns the stub
+@pytest.fixture
+def serve(database):
+    stops = []
+
+    def serve(runtime):
+        stub = StubApi().start()
+        stops.append(stub.stop)
+        stops.append(start(runtime, stub, timeout=0.5))
+        return stub
+    yield serve
+    for stop in reversed(stops):
+        stop()
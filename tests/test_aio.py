@@ -0,0 +1,13 @@
+from stub_api import command_update
+
+import aio
+
+
+# An update that can't be parsed is dropped and gives its slot back
+def test_broken_update(serve, monkeypatch):
+    monkeypatch.setattr(aio, 'MAX_PENDING_UPDATES', 1)
+    stub = serve('asyncio')
+    stub.push_update({'update_id': 1, 'message': {'text': '/list'}})
+    stub.push_update(command_update(2, 10, '/list'))
+    message, = stub.wait_calls('sendMessage')
+    assert message['text'].startswith('К сожалению, пока никто не предложил тем')
@@ -0,0 +1,98 @@
+import os
+import random
+import sqlite3
+import threading
+from itertools import count
+import pytest
+from common import populate
+
+import backup
+from models import db
+from helpers import _toggle_vote
+from backup import backup_database, restore_database, check_database, snapshots, _unpack
+
+TOPICS = 50
+
+
+@pytest.fixture
+def path(database):
+    populate(topics=TOPICS, voters=200, votes_per_voter=5, archived=3000)
+    return db.obj.database
+
+
+# Votes from a few threads until the block is over
+class Voting:
+    def __enter__(self):
+        self._stop = threading.Event()
+        self.votes = 0
+        self._threads = [threading.Thread(target=self._vote, args=(seed,)) for seed in range(3)]
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _vote(self, seed):
+        rnd = random.Random(seed)
+        with db.connection_context():
+            while not self._stop.is_set():
+                _toggle_vote(rnd.randrange(1, 1000), rnd.randrange(1, TOPICS + 1))
+                self.votes += 1
+
+    def __exit__(self, *args):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+# Every vote changes the counter of its topic in the same transaction
+def consistent(path):
+    database = sqlite3.connect(path)
+    try:
+        return database.execute(
+            'SELECT COUNT(*) FROM suggestedtopics t WHERE t.votes != ' +
+            '(SELECT COUNT(*) FROM votes v WHERE v.topic_id = t.uid)').fetchone()[0] == 0
+    finally:
+        database.close()
+
+
+# One snapshot a second apart
+@pytest.fixture
+def clock(monkeypatch):
+    seconds = count(1700000000)
+    monkeypatch.setattr(backup, 'time', lambda: next(seconds))
+
+
+def test_snapshot_while_voting(path, tmp_path, clock):
+    with Voting() as voting:
+        snapshot, size, _, restarts = backup_database(path, str(tmp_path), pages=8, pause=0.001)
+    assert voting.votes > 0 and restarts == 0
+    assert snapshots(path, str(tmp_path)) == [snapshot] and os.path.getsize(snapshot) == size
+    unpacked = str(tmp_path / 'unpacked.db')
+    assert _unpack(snapshot, unpacked) is None and consistent(unpacked)
+
+    for _ in range(3):
+        backup_database(path, str(tmp_path), keep=2)
+    taken = snapshots(path, str(tmp_path))
+    assert len(taken) == 2 and snapshot not in taken and taken == sorted(taken, reverse=True)
+
+
+def test_restore(path, tmp_path, clock):
+    directory = str(tmp_path / 'backups')
+    backup_database(path, directory)
+    copy = str(tmp_path / os.path.basename(path))
+    with open(path, 'rb') as data, open(copy, 'wb') as target:
+        target.write(data.read())
+    assert restore_database(copy, directory) is None
+
+    # A page in the middle of the file is overwritten
+    with open(copy, 'r+b') as data:
+        data.seek(os.path.getsize(copy) // 2 // 4096 * 4096)
+        data.write(os.urandom(4096 * 4))
+    assert check_database(copy, quick=True) is not None
+    assert restore_database(copy, directory) == snapshots(path, directory)[0]
+    assert check_database(copy) is None and consistent(copy)
+
+    os.remove(copy)
+    assert restore_database(copy, directory) is not None and consistent(copy)
+    # Nothing to restore from
+    os.remove(copy)
+    assert restore_database(copy, str(tmp_path / 'missing')) is None
@@ -0,0 +1,42 @@
+import sqlite3
+import threading
+from time import monotonic, sleep
+
+from models import db, Drafts
+from helpers import withConnection
+from drafts import DraftStore
+
+
+def test_persistent(database):
+    drafts = DraftStore(max_size=2, persistent=True)
+    drafts.start(1)
+    assert drafts.update(1, title='Title', username='user1')
+    drafts.start(2)
+    drafts.start(3)
+    assert 1 not in drafts and drafts.evicted_lru == 1
+    drafts.discard(2)
+    assert [row.user for row in Drafts.select()] == [3]
+
+    loaded = DraftStore(persistent=True)
+    loaded.load()
+    assert loaded.get(3) == {} and loaded.get(1) is None and not loaded.update(1, body='Body')
+
+
+# A write that waits for the database doesn't hold up the drafts of other users
+def test_write_outside_the_lock(database):
+    drafts = DraftStore(persistent=True)
+    drafts.start(1)
+    other = sqlite3.connect(db.obj.database, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    try:
+        writer = threading.Thread(target=withConnection(drafts.start), args=(2,))
+        writer.start()
+        sleep(0.2)
+        started = monotonic()
+        assert drafts.get(1) == {} and 2 in drafts._drafts
+        assert monotonic() - started < 0.5 and writer.is_alive()
+    finally:
+        other.execute('ROLLBACK')
+        other.close()
+    writer.join()
+    assert {row.user for row in Drafts.select()} == {1, 2}
@@ -0,0 +1,56 @@
+import io
+import csv
+import gzip
+import json
+import pytest
+from common import populate
+from stub_api import command_update
+from conftest import ADMIN
+
+from export import COLUMNS, topic_rows, export_topics
+
+
+def rows_of(content, format):
+    text = gzip.decompress(content).decode('utf-8')
+    if format == 'json':
+        return [[row[column] for column in COLUMNS] for row in json.loads(text)]
+    rows = list(csv.reader(io.StringIO(text.lstrip('﻿'))))
+    assert rows[0] == list(COLUMNS)
+    return rows[1:]
+
+
+@pytest.mark.parametrize('format', ['csv', 'json'])
+def test_export_topics(database, format):
+    populate(topics=7, voters=10, votes_per_voter=3, archived=50, episodes=5)
+    # Spooled to a temp file on the way
+    document, count, size = export_topics(topic_rows(), format, spool_size=1024)
+    with document:
+        content = document.read()
+    assert count == 57 and size == len(content)
+    rows = rows_of(content, format)
+    assert len(rows) == 57
+    episodes = [row[0] for row in rows]
+    # The current topics go last, with no episode
+    assert episodes[:50] == sorted(episodes[:50]) and set(episodes[50:]) <= {None, ''}
+
+    document, count, _ = export_topics(topic_rows(2, 3), format)
+    with document:
+        rows = rows_of(document.read(), format)
+    assert count == len(rows) == 20 and {int(row[0]) for row in rows} == {2, 3}
+
+
+# On asyncio the upload is queued after the handler has closed the document
+@pytest.mark.parametrize('runtime', ['threads', 'asyncio'])
+def test_export_command(serve, runtime):
+    populate(topics=7, archived=50, episodes=5)
+    stub = serve(runtime)
+    stub.push_update(command_update(1, ADMIN, '/export 2 3 json'))
+    document, = stub.wait_calls('sendDocument')
+    assert document['document']['filename'] == 'topics-2-3.json.gz'
+    assert document['caption'] == 'Тем: 20'
+    assert len(rows_of(document['document']['content'], 'json')) == 20
+
+    # Not for everyone
+    stub.push_update(command_update(2, ADMIN + 1, '/export'))
+    stub.wait_calls('sendMessage', 1)
+    assert len(stub.wait_calls('sendDocument', 2, timeout=0.5)) == 1
@@ -0,0 +1,116 @@
+import threading
+import multiprocessing
+from collections import Counter
+from time import monotonic, sleep
+from common import populate
+from stub_api import StubApi
+from fakes import FakeBot
+
+from telegram import Bot
+from telegram.utils.request import Request
+from models import db, init_database, SubscibedUsers, Outbox, Broadcasts, Deliveries
+from helpers import withConnection
+from outbox import plan_broadcast, deliver, unfinished_broadcasts
+
+SUBSCRIBERS = 200
+BLOCKED = set(range(1, SUBSCRIBERS + 1, 20))
+LEASE_TTL = 1
+
+
+def statuses(broadcast_id):
+    return Counter(status for status, in Outbox.select(Outbox.status).where(
+        Outbox.broadcast == broadcast_id).tuples())
+
+
+def test_everyone_gets_it_once(database, bot):
+    populate(subscribers=SUBSCRIBERS)
+    bot.blocked = BLOCKED
+    broadcast_id = plan_broadcast('reminder:test', 'Время проголосовать')
+    assert plan_broadcast('reminder:test', 'Время проголосовать') == broadcast_id
+    assert statuses(broadcast_id) == {'pending': SUBSCRIBERS}
+
+    stats = deliver(bot, broadcast_id, rate=100000, workers=4)
+    assert stats is not None
+    assert Counter(bot.sent) == Counter(set(range(1, SUBSCRIBERS + 1)) - BLOCKED)
+    assert statuses(broadcast_id) == {'sent': SUBSCRIBERS - len(BLOCKED), 'blocked': len(BLOCKED)}
+    assert Broadcasts.get_by_id(broadcast_id).finished is not None
+    assert unfinished_broadcasts() == []
+    # The users who have blocked the bot are unsubscribed
+    assert SubscibedUsers.select().where(SubscibedUsers.user.in_(BLOCKED)).count() == 0
+
+    # A finished broadcast isn't sent again
+    assert deliver(bot, broadcast_id) is None
+    assert len(bot.sent) == SUBSCRIBERS - len(BLOCKED)
+
+
+def test_the_rest_is_sent_after_a_stop(database, bot):
+    populate(subscribers=SUBSCRIBERS)
+    broadcast_id = plan_broadcast('reminder:test', 'Время проголосовать')
+    # A sender stopped after a part of them, its lease expired
+    sent = list(range(1, 51))
+    Outbox.update(status='sent').where(Outbox.user.in_(sent)).execute()
+    assert unfinished_broadcasts() == [broadcast_id]
+
+    deliver(bot, broadcast_id, rate=100000, workers=4)
+    assert sorted(bot.sent) == list(range(51, SUBSCRIBERS + 1))
+    assert statuses(broadcast_id) == {'sent': SUBSCRIBERS}
+    assert unfinished_broadcasts() == []
+
+
+def stub_bot(base_url):
+    return Bot('123:stub', base_url=base_url, request=Request(con_pool_size=4))
+
+
+def sender(path, base_url, broadcast_id):
+    init_database({'path': path})
+    db.connect()
+    deliver(stub_bot(base_url), broadcast_id, rate=100000, workers=4, lease_ttl=LEASE_TTL)
+
+
+# The sender is killed while the Bot API hasn't answered its last messages,
+# the next one sends them again
+def test_killed_sender(database):
+    populate(subscribers=SUBSCRIBERS)
+    broadcast_id = plan_broadcast('reminder:test', 'Время проголосовать')
+    stub = StubApi(hold_after=SUBSCRIBERS // 2).start()
+    try:
+        process = multiprocessing.get_context('spawn').Process(
+            target=sender, args=(db.obj.database, stub.base_url, broadcast_id))
+        process.start()
+        deadline = monotonic() + 30
+        while Deliveries.select().count() < SUBSCRIBERS // 2 and monotonic() < deadline:
+            sleep(0.05)
+        process.kill()
+        process.join()
+        left = statuses(broadcast_id)
+        assert left['sent'] == SUBSCRIBERS // 2 and left['sending'] > 0
+
+        stub.hold_after = None
+        sleep(LEASE_TTL)
+        deliver(stub_bot(stub.base_url), broadcast_id, rate=100000, workers=4)
+    finally:
+        stub.stop()
+    received = Counter(int(params['chat_id']) for _, params in stub.sent)
+    assert received == Counter(range(1, SUBSCRIBERS + 1))
+    assert statuses(broadcast_id) == {'sent': SUBSCRIBERS}
+    assert Deliveries.select().count() == SUBSCRIBERS
+
+
+# Telegram asks to wait longer than the lease lasts, nobody takes the broadcast
+# over meanwhile
+def test_lease_kept_while_waiting(database):
+    populate(subscribers=8)
+    broadcast_id = plan_broadcast('reminder:test', 'Время проголосовать')
+    bot = FakeBot(latency=0, rate_limit=5, retry_after=3)
+    sender = threading.Thread(target=withConnection(deliver), args=(bot, broadcast_id),
+                              kwargs={'rate': 100000, 'workers': 4, 'lease_ttl': LEASE_TTL})
+    sender.start()
+    deadline = monotonic() + 10
+    while bot.calls['429'] == 0 and monotonic() < deadline:
+        sleep(0.01)
+    sleep(LEASE_TTL * 1.5)
+    other = FakeBot(latency=0, rate_limit=None)
+    assert deliver(other, broadcast_id, lease_ttl=LEASE_TTL) is None and other.sent == []
+    sender.join()
+    assert Counter(bot.sent) == Counter(range(1, 9))
+    assert statuses(broadcast_id) == {'sent': 8}
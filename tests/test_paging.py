@@ -0,0 +1,179 @@
+import re
+import json
+import pytest
+from peewee import OperationalError
+from common import populate
+from stub_api import command_update, text_update, callback_update
+from tally_engines import ballots, insert
+
+from models import SuggestedTopics, ArchivedTopics
+from render import PAGE_SIZE, BODY_PREVIEW
+from conftest import ADMIN
+import devzen_bot
+import helpers
+
+USER = 10
+TITLE = re.compile(r'Topic number (\d+) ')
+VOTES = re.compile(r'олосов:</i> (\d+)')
+
+
+# Goes through the pages of command with the buttons, to the last one and
+# back. Returns the messages of the pages in the order they were shown
+def walk(stub, command, messages=1):
+    update_ids = iter(range(1, 10 ** 6))
+    stub.push_update(command_update(next(update_ids), USER, command))
+    pages = stub.wait_calls('sendMessage', messages)[-1:]
+    edits = 0
+    for direction in ('next', 'prev'):
+        while True:
+            buttons = _page_buttons(pages[-1])
+            if direction not in buttons:
+                break
+            stub.push_update(callback_update(next(update_ids), USER, buttons[direction],
+                                             reply_markup=json.loads(pages[-1]['reply_markup'])))
+            edits += 1
+            shown = stub.wait_calls('editMessageText', edits, timeout=5)
+            assert len(shown) == edits, f'{buttons[direction]} is not handled'
+            pages.append(shown[-1])
+    return pages
+
+
+def _page_buttons(message):
+    if 'reply_markup' not in message:
+        return {}
+    return {button['callback_data'].split('_')[1]: button['callback_data']
+            for row in json.loads(message['reply_markup'])['inline_keyboard'] for button in row
+            if button['callback_data'].startswith(('list_', 'vote_'))}
+
+
+# The topics of populate() are titled with their uid - 1
+def uids(message):
+    return [int(number) + 1 for number in TITLE.findall(message['text'])]
+
+
+def check_pages(pages, expected):
+    forward = pages[:len(pages) // 2 + 1]
+    assert all(len(uids(page)) <= PAGE_SIZE for page in pages)
+    assert [uid for page in forward for uid in uids(page)] == expected
+    assert [uids(page) for page in pages[len(forward):]] == \
+        [uids(page) for page in reversed(forward[:-1])]
+
+
+def test_list_pages_by_votes(serve):
+    populate(topics=30, voters=40, votes_per_voter=5)
+    stub = serve('threads')
+    pages = walk(stub, '/list')
+
+    ranked = list(SuggestedTopics.select(SuggestedTopics.uid, SuggestedTopics.votes).order_by(
+        SuggestedTopics.votes.desc(), SuggestedTopics.uid.desc()).tuples())
+    assert len(pages) == 7
+    check_pages(pages, [uid for uid, _ in ranked])
+    assert [int(votes) for page in pages[:4] for votes in VOTES.findall(page['text'])] == \
+        [votes for _, votes in ranked]
+
+
+@pytest.mark.parametrize('method', ['borda', 'schulze'])
+def test_list_pages_ranked(serve, config, method):
+    pytest.importorskip('numpy')
+    populate(topics=30)
+    insert(ballots(30, 200))
+    config['tally']['method'] = method
+    stub = serve('threads')
+    pages = walk(stub, '/list')
+
+    ranking = devzen_bot.tally.ranking()
+    assert len(pages) == 7
+    check_pages(pages, [uid for uid, _ in ranking])
+    places = re.compile(r'Место:</i> (\d+)')
+    assert [int(place) for page in pages[:4] for place in places.findall(page['text'])] == \
+        list(range(1, 31))
+
+
+def test_vote_pages_by_uid(serve):
+    populate(topics=20)
+    stub = serve('threads')
+    pages = walk(stub, '/vote', messages=2)
+    assert len(pages) == 5
+    check_pages(pages, list(range(1, 21)))
+
+
+def test_list_without_topics(serve):
+    stub = serve('threads')
+    stub.push_update(command_update(1, USER, '/list'))
+    message, = stub.wait_calls('sendMessage')
+    assert message['text'].startswith('К сожалению, пока никто не предложил тем')
+
+
+# A page button of an older message (here with a cursor of an older version)
+# while a topic waits for the confirmation
+def test_stray_button_keeps_the_draft(serve):
+    stub = serve('threads')
+    for update in (command_update(1, USER, '/propose'), text_update(2, USER, 'Title'),
+                   text_update(3, USER, 'Body of the topic')):
+        stub.push_update(update)
+    assert any(message['text'].startswith('Спасибо! Тема выглядит')
+               for message in stub.wait_calls('sendMessage', 4))
+    stub.push_update(callback_update(4, USER, 'list_next_4'))
+    stub.push_update(callback_update(5, USER, '0'))
+    answer, = stub.wait_calls('editMessageText')
+    assert answer['text'] == 'Ваша тема принята, спасибо.'
+    assert SuggestedTopics.select().count() == 1
+
+
+def _long_body(uid):
+    body = f'The whole body of {uid}. ' + 'More and more words. ' * 40 + 'The end.'
+    SuggestedTopics.update(body=body).where(SuggestedTopics.uid == uid).execute()
+    return body
+
+
+# Only the beginning of a long body is on the pages, 📖 sends the whole topic
+def test_show_topic(serve):
+    populate(topics=3)
+    body = _long_body(2)
+    stub = serve('threads')
+    stub.push_update(command_update(1, USER, '/list'))
+    page, = stub.wait_calls('sendMessage')
+    assert body[:BODY_PREVIEW // 2] in page['text'] and 'The end.' not in page['text']
+    rows = json.loads(page['reply_markup'])['inline_keyboard']
+    assert rows[0] == [{'text': '📖 Topic number 1 about something interesting',
+                        'callback_data': 'topic_2'}]
+
+    stub.push_update(command_update(2, USER, '/vote'))
+    ballot = stub.wait_calls('sendMessage', 3)[-1]
+    assert [[button['callback_data'] for button in row]
+            for row in json.loads(ballot['reply_markup'])['inline_keyboard']][:3] == \
+        [['1'], ['2', 'topic_2'], ['3']]
+
+    stub.push_update(callback_update(3, USER, 'topic_2'))
+    topic = stub.wait_calls('sendMessage', 4)[-1]
+    assert topic['text'].endswith(body)
+
+
+# /archive shows every topic in full before asking for the episode
+def test_archive_review(serve):
+    populate(topics=30)
+    bodies = [_long_body(uid) for uid in (1, 30)]
+    stub = serve('threads')
+    stub.push_update(command_update(1, ADMIN, '/archive'))
+    count = len(devzen_bot._review_messages()) + 2
+    messages = [message['text'] for message in stub.wait_calls('sendMessage', count)]
+    assert messages[-1].startswith('К какому эпизоду')
+    shown = '\n\n'.join(messages[1:-1])
+    assert sorted(uids({'text': shown})) == list(range(1, 31))
+    assert all(body in shown for body in bodies)
+
+
+# A failed archive is rolled back as a whole and says so
+def test_archive_failed(serve, monkeypatch):
+    def count_archived(*args):
+        raise OperationalError('disk I/O error')
+    monkeypatch.setattr(helpers, 'count_archived', count_archived)
+    populate(topics=3)
+    stub = serve('threads')
+    stub.push_update(command_update(1, ADMIN, '/archive'))
+    stub.wait_calls('sendMessage', len(devzen_bot._review_messages()) + 2)
+    stub.push_update(text_update(2, ADMIN, '42'))
+    stub.push_update(callback_update(3, ADMIN, '42_0'))
+    edit, = stub.wait_calls('editMessageText')
+    assert edit['text'].startswith('Не удалось архивировать темы, ничего не изменилось')
+    assert SuggestedTopics.select().count() == 3 and ArchivedTopics.select().count() == 0
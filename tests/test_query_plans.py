@@ -0,0 +1,21 @@
+import pytest
+from common import populate
+from query_plans import hot_queries, migrate_oldest, query_plan, plan_problem
+
+
+@pytest.fixture(params=['fresh', 'migrated'])
+def schema(request, database):
+    if request.param == 'migrated':
+        migrate_oldest()
+    populate(topics=100, voters=100, votes_per_voter=10)
+
+
+@pytest.mark.parametrize('name', list(hot_queries()))
+def test_uses_indexes(schema, name):
+    plan = query_plan(hot_queries()[name])
+    assert plan_problem(name, plan) is None, ' / '.join(plan)
+
+
+def test_everything_is_checked():
+    assert {name.split(':')[0] for name in hot_queries()} >= {
+        'page', 'outbox', 'lease', 'stats'}
@@ -0,0 +1,54 @@
+import json
+from common import populate
+from stub_api import command_update, callback_update
+
+from models import ArchivedTopics
+from search import search_topics
+
+ARCHIVED = 3000
+
+
+# The best match is the oldest archived topic, thousands of newer topics match too
+def test_oldest_best_match_comes_first(database):
+    ArchivedTopics.insert(user=1, username='old', title='Discussed postgres',
+                          body='Postgres replication', votes=1, episode=1).execute()
+    populate(topics=20, archived=ARCHIVED)
+    hits, more = search_topics('discussed', limit=5)
+    assert hits[0]['username'] == 'old' and more
+
+    # Every match is reachable page by page, each once
+    seen, offset = [], 0
+    while True:
+        hits, more = search_topics('discussed', offset=offset, limit=500)
+        seen.extend(hit['username'] for hit in hits)
+        if not more:
+            break
+        offset += len(hits)
+    assert len(seen) == len(set(seen)) == ARCHIVED + 1
+
+
+def test_live_and_archived(database):
+    populate(topics=20, archived=20)
+    hits, more = search_topics('Topic number 7')
+    assert not more and [hit['episode'] for hit in hits] == [None]
+    assert hits[0]['snippet'].startswith('Lorem ipsum') and hits[0]['snippet'].endswith(' …')
+    assert search_topics('   ') == ([], False)
+
+
+# The page buttons go on after a restart, on another instance too
+def test_pages_after_restart(serve):
+    populate(archived=30)
+    stub = serve('threads')
+    stub.push_update(command_update(1, 10, '/search discussed'))
+    message, = stub.wait_calls('sendMessage')
+    markup = json.loads(message['reply_markup'])
+    assert message['text'].startswith('Результаты поиска «discussed»:\n\n1. ')
+
+    restarted = serve('threads')
+    restarted.push_update(callback_update(
+        1, 10, markup['inline_keyboard'][0][0]['callback_data'], reply_markup=markup))
+    restarted.push_update(callback_update(2, 10, 'search_10'))
+    # Handled in parallel, the outdated one may come first
+    outdated, page = sorted(edit['text'] for edit in restarted.wait_calls('editMessageText', 2))
+    assert page.startswith('Результаты поиска «discussed»:\n\n11. ')
+    assert outdated == 'Поиск устарел, повторите его с /search'
@@ -0,0 +1,114 @@
+import random
+import pytest
+from common import populate
+
+from models import SuggestedTopics
+from helpers import _toggle_vote
+from tally import CountTally, BordaTally, SchulzeTally, create_tally, _pairwise
+
+pytest.importorskip('numpy')
+
+from tally_engines import (ballots, insert, python_pairwise, python_schulze,  # noqa: E402
+                           _ballots_from_db)
+
+TOPICS = 30
+VOTERS = 300
+
+
+@pytest.fixture
+def voted(database):
+    populate(topics=TOPICS)
+    insert(ballots(TOPICS, VOTERS))
+
+
+# Random taps through the database and the engines
+def tap(engines, count=1000):
+    rnd = random.Random(1)
+    for _ in range(count):
+        user, uid = rnd.randint(1, VOTERS + 20), rnd.randint(1, TOPICS)
+        voted = _toggle_vote(user, uid)
+        for tally in engines:
+            tally.vote(user, uid, voted)
+
+
+def walk(tally, size=7):
+    pages, cursor = [], None
+    while True:
+        rows, has_prev, has_next = tally.page(size, after=cursor)
+        assert has_prev == (cursor is not None)
+        pages.append(rows)
+        if not has_next:
+            return pages
+        cursor = tally.cursor(rows[-1])
+
+
+def test_schulze_textbook():
+    # E > A > C > B > D, the example of the Schulze method on Wikipedia
+    groups = [(5, 'ACBED'), (5, 'ADECB'), (8, 'BEDAC'), (3, 'CABED'), (7, 'CAEBD'),
+              (2, 'CBADE'), (7, 'DCEBA'), (8, 'EBADC')]
+    tally = SchulzeTally()
+    d, votes = _pairwise(tally._np, [['ABCDE'.index(c) for c in order]
+                                     for count, order in groups for _ in range(count)], 5)
+    assert d[3][4] == 14 and d[4][3] == 31 and votes.tolist() == [45] * 5
+    assert tally.scores(d).tolist() == [3, 1, 2, 0, 4]
+
+
+@pytest.mark.parametrize('method', ['borda', 'schulze'])
+def test_votes_match_load(voted, method):
+    tally = create_tally(method)
+    tally.load()
+    tap([tally])
+    # Proposed after the votes, nobody has voted for it but the first user
+    SuggestedTopics.insert(uid=TOPICS + 1, user=1, username='user', title='New',
+                           body='New topic').execute()
+    tally.add(TOPICS + 1)
+    _toggle_vote(1, TOPICS + 1)
+    tally.vote(1, TOPICS + 1, True)
+
+    loaded = create_tally(method)
+    loaded.load()
+    n = TOPICS + 1
+    assert (tally._d[:n, :n] == loaded._d[:n, :n]).all()
+    assert tally.ranking() == loaded.ranking()
+
+    d = python_pairwise([[tally._rows[uid] for uid in ballot]
+                         for ballot in _ballots_from_db().values()], n)
+    assert tally._d[:n, :n].tolist() == d
+    scores = tally.scores(tally._d[:n, :n]).tolist()
+    assert scores == (python_schulze(d) if method == 'schulze' else [sum(line) for line in d])
+
+
+@pytest.mark.parametrize('method', ['borda', 'schulze'])
+def test_pages_follow_the_ranking(voted, method):
+    tally = create_tally(method)
+    tally.load()
+    ranking = tally.ranking()
+    pages = walk(tally)
+    rows = [row for page in pages for row in page]
+    assert [(uid, votes) for uid, votes, _ in rows] == ranking
+    assert [place for _, _, place in rows] == list(range(1, len(ranking) + 1))
+
+    back, cursor = [], tally.cursor(pages[-1][0])
+    while True:
+        page, has_prev, has_next = tally.page(7, before=cursor)
+        assert has_next
+        back.insert(0, page)
+        if not has_prev:
+            break
+        cursor = tally.cursor(page[0])
+    assert back == pages[:-1]
+
+
+def test_count_pages_by_votes(voted):
+    tap([])
+    rows = [row for page in walk(CountTally()) for row in page]
+    assert [(uid, votes) for uid, votes, _ in rows] == list(
+        SuggestedTopics.select(SuggestedTopics.uid, SuggestedTopics.votes).order_by(
+            SuggestedTopics.votes.desc(), SuggestedTopics.uid.desc()).tuples())
+
+
+def test_archive_clears(voted):
+    tally = BordaTally()
+    tally.load()
+    tally.clear()
+    assert tally.ranking() == [] and tally.page(7) == ([], False, False)